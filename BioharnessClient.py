@@ -6,11 +6,15 @@ Created on Mar 9, 2016
 import json
 import logging 
 from twisted.protocols.basic import LineReceiver
+from twisted.internet import defer, error
+from twisted.python import failure
 
+import zephyr
 from zephyr.collector import SignalPacketIterator
 from zephyr.bioharness import BioHarnessPacketHandler
 from zephyr.message import MessagePayloadParser, SummaryMessage, SignalSample, AccelerationSignalSample
-from zephyr.protocol import MessageFrameParser, create_message_frame
+from zephyr.protocol import BufferedMessageFrameParser, TimedDataRecorder, create_message_frame, read_timed_data
+from zephyr.util import ClockDifferenceEstimator
 from collections import deque
 from twisted.internet.serialport import SerialPort
 import sys
@@ -35,12 +39,20 @@ class BioharnessProtocol(LineReceiver):
                       "acceleration": AccelerationSignalSample._fields,                      
                       }
 
-    def __init__(self, processing_proxy, port, reactor):
+    def __init__(self, processing_proxy, port, reactor, device_id=None):
         self.rr_buffer = deque(maxlen=1024)
         self.processing_proxy = processing_proxy
         self.port = port
         self.reactor = reactor
+        self.device_id = device_id
         self.serial = None
+        self.summary_packet_transmit_interval = 1
+        self.acceleration_enabled = False
+        # Clock difference estimator factories per stream type, e.g. {"rr": WindowedMinimumClockAheadEstimator}
+        self.clock_estimator_factories = {}
+        # Local clock of the clock difference correction, zephyr.time if None
+        self.time_function = None
+        self.raw_data_recorder = None
 
     def send_device_command(self, message_id, payload):
         message_frame = create_message_frame(message_id, payload)
@@ -50,30 +62,43 @@ class BioharnessProtocol(LineReceiver):
     def set_stream_state(self, stream_id, state):
         self.send_device_command(self.message_ids[stream_id], [self.stream_states[state]])
 
+    def set_acceleration_enabled(self, enabled):
+        # Can be switched at runtime, the device is updated right away if connected
+        self.acceleration_enabled = enabled
+        if self.transport is not None and self.connected:
+            self.set_stream_state("acceleration", "ON" if enabled else "OFF")
+
     def disable_lifesign_timeout(self):
         self.send_device_command(self.message_ids["life_sign"], [0,0,0,0])    
 
+    def set_summary_packet_transmit_interval(self, seconds):
+        # The interval is sent as a little-endian 16 bit number of seconds
+        if not isinstance(seconds, (int, long)) or isinstance(seconds, bool) or not 1 <= seconds <= 0xFFFF:
+            raise ValueError("Summary packet transmit interval must be an integer number of seconds in 1..65535, got %r" % (seconds,))
+        self.send_device_command(self.message_ids["summary"], [seconds & 0xFF, seconds >> 8])
+
     def set_summary_packet_transmit_interval_to_one_second(self):
-        self.send_device_command(self.message_ids["summary"], [1, 0])
+        self.set_summary_packet_transmit_interval(1)
         
     def send_initialization_commands(self):
         self.set_stream_state("ecg", "ON")
         self.set_stream_state("breathing", "ON")
-        self.set_stream_state("acceleration", "OFF")
+        self.set_stream_state("acceleration", "ON" if self.acceleration_enabled else "OFF")
         self.set_stream_state("rr", "ON")
         self.disable_lifesign_timeout()
-        self.set_summary_packet_transmit_interval_to_one_second()
+        self.set_summary_packet_transmit_interval(self.summary_packet_transmit_interval)
         
     def default_signal_waveform_handler(self, signal_packet, start_new_stream):
-        samples_iterator = SignalPacketIterator(signal_packet).iterate_timed_samples()
-        for signal_sample in samples_iterator:
-            self.logger_of_stream[signal_sample.type].write_tuple_to_log_file(signal_sample)
-            
-            # send data for processing
-            if signal_sample.type == 'rr':
-                self.rr_buffer.append(signal_sample.sample)
+        packet_iterator = SignalPacketIterator(signal_packet)
+        sample_timestamps = packet_iterator.get_sample_timestamps()
+        self.logger_of_stream[signal_packet.type].write_columns_to_log_file(packet_iterator.get_sample_columns(sample_timestamps))
+        
+        # send data for processing
+        if signal_packet.type == 'rr':
+            for rr_value, sample_timestamp in zip(signal_packet.samples.tolist(), sample_timestamps.tolist()):
+                self.rr_buffer.append(rr_value)
                 if len(self.rr_buffer)==self.rr_buffer.maxlen:
-                    self.send_data_for_processing("rr_buffer",list(self.rr_buffer), signal_sample.timestamp)
+                    self.send_data_for_processing("rr_buffer",list(self.rr_buffer), sample_timestamp)
                     
                     #empty buffer partially
                     for _i in range(0,18):#self.rr_buffer.maxlen/12):
@@ -95,6 +120,8 @@ class BioharnessProtocol(LineReceiver):
         data = {"type":type}
         data["timestamp"] = timestamp
         data["value"] = value
+        if self.device_id is not None:
+            data["device_id"] = self.device_id
         self.processing_proxy.notifyAll(data)
            
     def set_event_callbacks(self, callbacks= None):
@@ -116,21 +143,42 @@ class BioharnessProtocol(LineReceiver):
         # Sending commands to enable relevant streams and summary messages
         self.send_initialization_commands()
         
-        self.signal_packet_handler_bh = BioHarnessPacketHandler(self.waveform_callbacks, self.event_callbacks)
+        clock_difference_correction = ClockDifferenceEstimator(estimator_factories=self.clock_estimator_factories,
+                                                               time_function=self.time_function)
+        self.signal_packet_handler_bh = BioHarnessPacketHandler(self.waveform_callbacks, self.event_callbacks,
+                                                                clock_difference_correction=clock_difference_correction)
         self.payload_parser = MessagePayloadParser([self.signal_packet_handler_bh.handle_packet])
-        self.message_parser = MessageFrameParser(self.payload_parser.handle_message)
+        self.message_parser = BufferedMessageFrameParser(self.payload_parser.handle_message)
+
+    def start_raw_data_recording(self, log_file_basepath):
+        """Record the bytes received from the device with their arrival times,
+        BioharnessReplayTransport can feed the recording back in."""
+        self.stop_raw_data_recording()
+        self.raw_data_recorder = TimedDataRecorder(log_file_basepath)
+        
+    def stop_raw_data_recording(self):
+        if self.raw_data_recorder is not None:
+            self.raw_data_recorder.close()
+            self.raw_data_recorder = None
 
     def rawDataReceived(self, data):
         if not data: return
-                     
-        for byte in data:
-            self.message_parser.parse_data(byte)
+        
+        if self.raw_data_recorder is not None:
+            self.raw_data_recorder(data)
+        
+        self.message_parser.parse_data(data)
     
     def set_serial(self, serial):
         self.serial = serial
         
     def connectionLost(self, reason):
-        logging.error("Bioharness - Lost connection (%s)" % reason)
+        if self.serial is None:
+            # Replayed recording, there is no serial port to reconnect
+            logging.info("Bioharness %s - Connection closed (%s)" % (self.port, reason.getErrorMessage()))
+            return
+        
+        logging.error("Bioharness %s - Lost connection (%s)" % (self.port, reason))
         logging.info("Bioharness - Reconnecting in 5 seconds...")
         self.serial._serial.close()
         self.retry = self.reactor.callLater(5, self.reconnect)
@@ -141,13 +189,138 @@ class BioharnessProtocol(LineReceiver):
                 self.serial = SerialPort(self, self.port, self.reactor, baudrate=115200)
             else:
                 self.serial.__init__(self, self.port, self.reactor, baudrate=115200)
-            logging.info("Bioharness - Reconnected")
+            logging.info("Bioharness %s - Reconnected" % self.port)
            
         except:
             logging.error("Bioharness - Error opening serial port %s (%s)" % (self.port, sys.exc_info()[1]))
             logging.info("Bioharness - Reconnecting in 5 seconds...")
             self.retry = self.reactor.callLater(5, self.reconnect)
+
+
+class BioharnessReplayTransport(object):
+    """Transport that feeds a raw data recording into a protocol, in the
+    recorded chunks. speed 1.0 replays in real time, 10.0 ten times as fast
+    and None as fast as possible. With use_recorded_time the clock of the
+    protocol returns the recorded arrival time of the chunk being fed, so that
+    its clock difference correction sees the timing of the recording at any
+    speed. zephyr.time is left alone, so replays can overlap each other and
+    live devices. finished is a Deferred fired when the replay is over."""
+    
+    # Chunks fed at once before the reactor gets control back when replaying as fast as possible
+    chunks_per_call = 100
+    
+    def __init__(self, protocol, reactor, log_file_basepath, speed=1.0, use_recorded_time=True):
+        self.protocol = protocol
+        self.reactor = reactor
+        self.speed = speed
+        self.use_recorded_time = use_recorded_time
+        self.timed_chunks = read_timed_data(log_file_basepath)
+        
+        self.chunk_i = 0
+        self.delayed_call = None
+        self.connected = False
+        self.written_data = []
+        self.finished = defer.Deferred()
+    
+    def start(self):
+        if self.use_recorded_time:
+            # Taken by the clock difference correction created on connection
+            self.protocol.time_function = self.get_recorded_time
+        
+        self.start_time = self.reactor.seconds()
+        self.connected = True
+        self.protocol.makeConnection(self)
+        self.feed_due_chunks()
+        return self.finished
+    
+    def get_recorded_time(self):
+        if not self.timed_chunks:
+            return zephyr.time()
+        
+        return self.timed_chunks[min(self.chunk_i, len(self.timed_chunks) - 1)][0]
+    
+    def feed_due_chunks(self):
+        self.delayed_call = None
+        chunks_fed = 0
+        
+        while self.connected and self.chunk_i < len(self.timed_chunks):
+            timestamp, chunk = self.timed_chunks[self.chunk_i]
             
+            if self.speed is None:
+                if chunks_fed >= self.chunks_per_call:
+                    self.delayed_call = self.reactor.callLater(0, self.feed_due_chunks)
+                    return
+            else:
+                due_time = self.start_time + (timestamp - self.timed_chunks[0][0]) / self.speed
+                delay = due_time - self.reactor.seconds()
+                
+                if delay > 0:
+                    self.delayed_call = self.reactor.callLater(delay, self.feed_due_chunks)
+                    return
+            
+            self.protocol.dataReceived(chunk)
+            self.chunk_i += 1
+            chunks_fed += 1
+        
+        self.loseConnection()
+    
+    def write(self, data):
+        # Commands sent to the device are kept for inspection
+        self.written_data.append(data)
+    
+    def writeSequence(self, data):
+        self.written_data.extend(data)
+    
+    def loseConnection(self):
+        if not self.connected:
+            return
+        
+        self.connected = False
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        
+        self.protocol.connectionLost(failure.Failure(error.ConnectionDone("Replay finished")))
+        self.finished.callback(self.chunk_i)
+
+
+class BioharnessDeviceManager(object):
+    """Several Bioharness devices in one reactor. Every device has its own
+    protocol, and with it its own parser chain, clock difference estimator,
+    rr buffer and loggers, so devices share no state while collecting."""
+    
+    def __init__(self, processing_proxy, reactor):
+        self.processing_proxy = processing_proxy
+        self.reactor = reactor
+        self.protocol_of_device = {}
+    
+    def add_device(self, device_id, port, acceleration_enabled=False):
+        protocol = BioharnessProtocol(self.processing_proxy, port, self.reactor, device_id)
+        protocol.set_event_callbacks()
+        protocol.set_waveform_callbacks()
+        protocol.set_acceleration_enabled(acceleration_enabled)
+        self.protocol_of_device[device_id] = protocol
+        return protocol
+    
+    def get_device_ids(self):
+        return sorted(self.protocol_of_device.keys())
+    
+    def set_data_loggers(self, loggers_of_device):
+        for device_id, protocol in self.protocol_of_device.items():
+            protocol.set_data_loggers(loggers_of_device[device_id])
+    
+    def start_raw_data_recording(self, log_file_basepath):
+        for device_id, protocol in self.protocol_of_device.items():
+            protocol.start_raw_data_recording("%s_%s" % (log_file_basepath, device_id))
+    
+    def stop_raw_data_recording(self):
+        for protocol in self.protocol_of_device.values():
+            protocol.stop_raw_data_recording()
+    
+    def connect_all(self):
+        # Every protocol reconnects its own serial port, a missing device does not hold up the others
+        for protocol in self.protocol_of_device.values():
+            protocol.reconnect()
+
 '''    
 class DataProcessingClientProtocol(protocol.Protocol):
     def connectionMade(self):
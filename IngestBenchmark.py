@@ -0,0 +1,358 @@
+'''
+Throughput benchmark for the Bioharness ingest chain:
+BufferedMessageFrameParser -> MessagePayloadParser -> BioHarnessPacketHandler -> SignalPacketIterator -> DataLogger
+
+Synthetic ECG, breathing, RR, acceleration and summary frames are generated with
+create_message_frame, including frames with a broken CRC and lost frames that
+break the sequence numbers. Every stage is measured on its own and the whole
+chain end to end. The end to end chain is also run for several devices at once,
+each with its own chain and loggers and chunks interleaved as the reactor would
+deliver them, to show how the cost grows with the number of devices. The
+results can be stored as JSON and compared between commits:
+
+python IngestBenchmark.py --output new.json --compare old.json
+'''
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import functools
+import itertools
+import tempfile
+import datetime
+import subprocess
+import collections
+
+from zephyr.benchmark import measure_rate
+from zephyr.bioharness import BioHarnessPacketHandler
+from zephyr.collector import SignalPacketIterator
+from zephyr.message import MessagePayloadParser, SignalPacket, SignalSample, AccelerationSignalSample, SummaryMessage
+from zephyr.protocol import BufferedMessageFrameParser, create_message_frame
+from zephyr.util import ClockDifferenceEstimator
+
+from Logger import DataLogger, WriteToLogLock
+
+
+StreamSpecification = collections.namedtuple("StreamSpecification", ["name", "message_id", "data_byte_count",
+                                                                     "samples_per_packet", "packet_period"])
+
+# Packet sizes of the Bioharness 3. The summary data includes the packing format version byte.
+STREAM_SPECIFICATIONS = [StreamSpecification("ecg", 0x22, 79, 63, 63 / 250.0),
+                         StreamSpecification("breathing", 0x21, 23, 18, 18 / 18.0),
+                         StreamSpecification("rr", 0x24, 36, 18, 18 / 18.0),
+                         StreamSpecification("acceleration", 0x25, 75, 20, 20 / 50.0),
+                         StreamSpecification("summary", 0x2B, 62, 1, 1.0)]
+
+COLUMNS_OF_STREAMS = {"summary": SummaryMessage._fields,
+                      "breathing": SignalSample._fields,
+                      "ecg": SignalSample._fields,
+                      "rr": SignalSample._fields,
+                      "acceleration": AccelerationSignalSample._fields}
+
+SESSION_DATE = datetime.date(2016, 6, 15)
+
+
+def create_timestamp_bytes(session_seconds):
+    day_milliseconds = int(session_seconds * 1000) + 9 * 3600 * 1000
+    return ([SESSION_DATE.year & 0xFF, SESSION_DATE.year >> 8, SESSION_DATE.month, SESSION_DATE.day] +
+            [(day_milliseconds >> shift) & 0xFF for shift in [0, 8, 16, 24]])
+
+
+def create_session_frames(duration, seed=0, corrupt_fraction=0.01, lost_fraction=0.01):
+    """Return the frames of a synthetic session of the given duration in seconds,
+    ordered by time."""
+    generator = random.Random(seed)
+    timed_frames = []
+    
+    for stream_specification in STREAM_SPECIFICATIONS:
+        packet_count = int(duration / stream_specification.packet_period)
+        
+        for packet_i in range(packet_count):
+            if generator.random() < lost_fraction:
+                continue
+            
+            packet_time = packet_i * stream_specification.packet_period
+            data_bytes = [generator.randint(0, 255) for byte_i in range(stream_specification.data_byte_count)]  #@UnusedVariable
+            
+            if stream_specification.name == "summary":
+                data_bytes[0] = 2
+            
+            payload = [packet_i % 256] + create_timestamp_bytes(packet_time) + data_bytes
+            message_frame = create_message_frame(stream_specification.message_id, payload)
+            
+            if generator.random() < corrupt_fraction:
+                message_frame = message_frame[:-2] + chr(ord(message_frame[-2]) ^ 0xFF) + message_frame[-1]
+            
+            timed_frames.append((packet_time, message_frame))
+    
+    timed_frames.sort(key=lambda timed_frame: timed_frame[0])
+    return [message_frame for packet_time, message_frame in timed_frames]  #@UnusedVariable
+
+
+def split_into_chunks(data_string, chunk_length):
+    return [data_string[position:position + chunk_length] for position in range(0, len(data_string), chunk_length)]
+
+
+def count_samples(packets):
+    sample_count = 0
+    for packet in packets:
+        if isinstance(packet, SignalPacket):
+            sample_count += len(packet.samples)
+        else:
+            sample_count += 1
+    return sample_count
+
+
+def count_retained_objects(function):
+    """Net number of objects the function leaves alive, allocations minus
+    deallocations, not the number of allocations. tracemalloc counts memory
+    blocks where it is available. Python 2 has no allocation tracing, there the
+    count of garbage collector tracked objects (lists, tuples, namedtuples,
+    dicts, instances) is used instead."""
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    
+    gc.collect()
+    gc.disable()
+    try:
+        if tracemalloc is not None:
+            tracemalloc.start()
+            snapshot_before = tracemalloc.take_snapshot()
+            function()
+            snapshot_after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            
+            return sum(statistic.count_diff for statistic in snapshot_after.compare_to(snapshot_before, "filename")), "tracemalloc_blocks"
+        
+        objects_before = gc.get_count()[0]
+        function()
+        return gc.get_count()[0] - objects_before, "gc_tracked_objects"
+    finally:
+        gc.enable()
+
+
+class LoggerSet:
+    def __init__(self, base_path, device_id="benchmark"):
+        write_to_log_lock = WriteToLogLock(None, 0)
+        write_to_log_lock.unlock_writing_to_log_file()
+        
+        self.loggers = dict((stream_type, DataLogger(os.path.join(base_path, device_id), "%s_%s" % (device_id, stream_type),
+                                                     columns, write_to_log_lock))
+                            for stream_type, columns in COLUMNS_OF_STREAMS.items())
+    
+    def handle_signal(self, signal_packet, starts_new_stream):
+        packet_iterator = SignalPacketIterator(signal_packet)
+        self.loggers[signal_packet.type].write_columns_to_log_file(packet_iterator.get_sample_columns())
+    
+    def handle_event(self, summary_packet):
+        self.loggers["summary"].write_tuple_to_log_file(summary_packet)
+    
+    def close(self):
+        for logger in self.loggers.values():
+            logger.close_log_file()
+
+
+class IngestBenchmark:
+    def __init__(self, duration, chunk_length, base_path, device_count=1):
+        self.base_path = base_path
+        
+        self.frames = create_session_frames(duration)
+        self.chunks = split_into_chunks("".join(self.frames), chunk_length)
+        
+        # Every simulated device sends its own session
+        self.chunks_of_devices = [self.chunks] + [split_into_chunks("".join(create_session_frames(duration, seed=device_i)), chunk_length)
+                                                  for device_i in range(1, device_count)]
+        
+        self.message_frames = []
+        BufferedMessageFrameParser(self.message_frames.append).parse_data("".join(self.frames))
+        
+        self.packets = []
+        payload_parser = MessagePayloadParser([self.packets.append])
+        for message_frame in self.message_frames:
+            payload_parser.handle_message(message_frame)
+        
+        self.signal_packets = [packet for packet in self.packets if isinstance(packet, SignalPacket)]
+        self.summary_packets = [packet for packet in self.packets if isinstance(packet, SummaryMessage)]
+        
+        self.frame_count = len(self.message_frames)
+        self.sample_count = count_samples(self.packets)
+    
+    def run_frame_parser(self):
+        message_parser = BufferedMessageFrameParser(lambda message_frame: None)
+        for chunk in self.chunks:
+            message_parser.parse_data(chunk)
+    
+    def run_payload_parser(self):
+        payload_parser = MessagePayloadParser([])
+        for message_frame in self.message_frames:
+            payload_parser.handle_message(message_frame)
+    
+    def run_packet_handler(self):
+        packet_handler = BioHarnessPacketHandler([lambda signal_packet, starts_new_stream: None],
+                                                 [lambda summary_packet: None])
+        for packet in self.packets:
+            packet_handler.handle_packet(packet)
+    
+    def run_packet_iterator(self):
+        for signal_packet in self.signal_packets:
+            SignalPacketIterator(signal_packet).get_sample_columns()
+    
+    def run_data_logger(self):
+        logger_set = LoggerSet(self.base_path)
+        
+        for signal_packet in self.signal_packets:
+            logger_set.handle_signal(signal_packet, False)
+        
+        for summary_packet in self.summary_packets:
+            logger_set.handle_event(summary_packet)
+        
+        logger_set.close()
+    
+    def create_device_chain(self, device_id):
+        logger_set = LoggerSet(self.base_path, device_id)
+        
+        packet_handler = BioHarnessPacketHandler([logger_set.handle_signal], [logger_set.handle_event],
+                                                 clock_difference_correction=ClockDifferenceEstimator())
+        payload_parser = MessagePayloadParser([packet_handler.handle_packet])
+        message_parser = BufferedMessageFrameParser(payload_parser.handle_message)
+        
+        return message_parser, logger_set
+    
+    def run_end_to_end(self):
+        message_parser, logger_set = self.create_device_chain("benchmark")
+        
+        for chunk in self.chunks:
+            message_parser.parse_data(chunk)
+        
+        logger_set.close()
+    
+    def run_devices(self, device_count):
+        device_chains = [self.create_device_chain("device_%d" % device_i) for device_i in range(device_count)]
+        
+        for device_chunks in itertools.izip_longest(*self.chunks_of_devices[:device_count]):
+            for (message_parser, logger_set), chunk in zip(device_chains, device_chunks):  #@UnusedVariable
+                if chunk is not None:
+                    message_parser.parse_data(chunk)
+        
+        for message_parser, logger_set in device_chains:  #@UnusedVariable
+            logger_set.close()
+    
+    def get_stages(self):
+        """Stage names, functions and the number of devices they process"""
+        stages = [("frame_parser", self.run_frame_parser, 1),
+                  ("payload_parser", self.run_payload_parser, 1),
+                  ("packet_handler", self.run_packet_handler, 1),
+                  ("packet_iterator", self.run_packet_iterator, 1),
+                  ("data_logger", self.run_data_logger, 1),
+                  ("end_to_end", self.run_end_to_end, 1)]
+        
+        device_count = 2
+        while device_count <= len(self.chunks_of_devices):
+            stages.append(("devices_%d" % device_count, functools.partial(self.run_devices, device_count), device_count))
+            device_count *= 2
+        
+        return stages
+    
+    def run(self, minimum_duration):
+        results = {}
+        
+        for stage_name, run_stage, device_count in self.get_stages():
+            runs_per_second = measure_rate(run_stage, 1, minimum_duration)
+            retained_objects, retained_object_metric = count_retained_objects(run_stage)
+            
+            # The sessions of the other devices have about as many frames as the first one
+            results[stage_name] = {"frames_per_second": runs_per_second * self.frame_count * device_count,
+                                   "samples_per_second": runs_per_second * self.sample_count * device_count,
+                                   "retained_objects_per_frame": retained_objects / float(self.frame_count * device_count),
+                                   "retained_object_metric": retained_object_metric}
+            
+            # Total throughput relative to a single device, 1.0 means linear scaling
+            if device_count > 1:
+                results[stage_name]["scaling_efficiency"] = (results[stage_name]["frames_per_second"] /
+                                                             results["end_to_end"]["frames_per_second"])
+        
+        return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous_results=None):
+    print "%-16s %14s %14s %14s %10s %10s" % ("stage", "frames/s", "samples/s", "retained/frame", "scaling", "vs. prev")
+    
+    for stage_name, stage_results in sorted(results.items()):
+        comparison = ""
+        if previous_results is not None and stage_name in previous_results:
+            comparison = "%.2fx" % (stage_results["frames_per_second"] / previous_results[stage_name]["frames_per_second"])
+        
+        scaling = ""
+        if "scaling_efficiency" in stage_results:
+            scaling = "%.2f" % stage_results["scaling_efficiency"]
+        
+        print "%-16s %14.0f %14.0f %14.2f %10s %10s" % (stage_name, stage_results["frames_per_second"],
+                                                        stage_results["samples_per_second"],
+                                                        stage_results["retained_objects_per_frame"], scaling, comparison)
+
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Bioharness ingest benchmark')
+    parser.add_argument("-d", "--duration", type=float, default=60.0,
+                        help="Seconds of synthetic session data")
+    parser.add_argument("-c", "--chunk_length", type=int, default=256,
+                        help="Size of the chunks fed to the frame parser, like serial reads")
+    parser.add_argument("-m", "--minimum_duration", type=float, default=1.0,
+                        help="Minimum measurement time per stage in seconds")
+    parser.add_argument("-n", "--devices", type=int, default=8,
+                        help="Maximum number of simulated devices, measured at powers of two")
+    parser.add_argument("-o", "--output", help="Store the results as JSON in this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    return parser.parse_args()
+
+
+def main(command_args):
+    # Lost and corrupted frames are expected, the warnings would only slow the benchmark down
+    logging.getLogger().setLevel(logging.ERROR)
+    
+    base_path = tempfile.mkdtemp(prefix="ingest_benchmark_")
+    try:
+        benchmark = IngestBenchmark(command_args.duration, command_args.chunk_length, base_path, command_args.devices)
+        results = benchmark.run(command_args.minimum_duration)
+    finally:
+        shutil.rmtree(base_path)
+    
+    previous_results = None
+    if command_args.compare:
+        with open(command_args.compare) as previous_file:
+            previous_results = json.load(previous_file)["results"]
+    
+    print_results(results, previous_results)
+    
+    if command_args.output:
+        output = {"commit": get_git_commit(),
+                  "python_version": sys.version.split()[0],
+                  "time": time.time(),
+                  "frame_count": benchmark.frame_count,
+                  "sample_count": benchmark.sample_count,
+                  "parameters": vars(command_args),
+                  "results": results}
+        
+        with open(command_args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    command_args = parse_commandline_arguments()
+    main(command_args)
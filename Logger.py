@@ -5,10 +5,25 @@ Created on Mar 8, 2016
 '''
 
 import os
+import re
+import time
+import gzip
+import zlib
+import struct
+import Queue
+import logging
 import datetime
 import json
+import threading
+import itertools
+import numpy
 from twisted.protocols import basic
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
 
@@ -39,9 +54,14 @@ class LoggingWebsocketControll(WebSocketServerProtocol):
         
     def handle_log_command(self, command):        
         log_files_prefix = "%s_%s" % (command["subject"],command["name"])
-        self.logger_container.write_to_log_lock.lock_writing_to_log_file()
-        self.logger_container.new_logging_session(log_files_prefix)
-        self.logger_container.write_to_log_lock.unlock_writing_to_log_file()
+        # The samples keep going to the current session until the new one is swapped in
+        rotation = self.logger_container.rotate_logging_session(log_files_prefix, command.get("format"))
+        # Logging stays as it was if the new session could not be opened
+        rotation.addCallbacks(lambda result: self.logger_container.write_to_log_lock.unlock_writing_to_log_file(),
+                              self.report_log_command_failure, errbackArgs=(log_files_prefix,))
+    
+    def report_log_command_failure(self, failure, log_files_prefix):
+        print("LoggingWebsocketControll: Failed to start logging %s - %s" % (log_files_prefix, failure.getErrorMessage()))
         
     def set_logger_container(self, logger_container):
         self.logger_container = logger_container
@@ -94,28 +114,428 @@ class WriteToLogLock(object):
         
 
 
+class LogFileWriter(threading.Thread):
+    """Writes the lines of DataLoggers from a background thread, so that the
+    reactor thread does not wait for the disk. Blocks of lines are queued per
+    logger file and written in batches, the files are flushed every
+    flush_interval seconds. When max_queued_blocks blocks are waiting the
+    loggers block until the writer catches up, rather than dropping samples.
+    An error in one item is logged and the thread goes on with the next items,
+    and the calls that wait for the thread return once it is no longer alive."""
+    
+    # Seconds between the checks that the thread is alive while waiting for it
+    alive_check_interval = 1.0
+    
+    def __init__(self, flush_interval=1.0, max_queued_blocks=10000):
+        threading.Thread.__init__(self, name="LogFileWriter")
+        self.daemon = True
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(max_queued_blocks)
+        self.unflushed_files = set()
+    
+    def write_lines(self, log_file, lines):
+        self.queue.put(("write", log_file, lines))
+    
+    def close_file(self, log_file, wait=True):
+        """Write the queued lines of the file and close it, wait until it is closed
+        unless wait is False"""
+        if wait:
+            self._put_and_wait("close", log_file)
+        else:
+            self.queue.put(("close", log_file, None))
+    
+    def drain(self):
+        """Wait until all queued lines are written and flushed"""
+        self._put_and_wait("drain", None)
+    
+    def stop(self):
+        """Write all queued lines and wait until the thread has ended"""
+        if not self.is_alive():
+            return
+        self.drain()
+        self.queue.put(("stop", None, None))
+        self.join()
+    
+    def _put_and_wait(self, operation, log_file):
+        # Called from the reactor thread, which must not block on a writer that has ended
+        if not self.is_alive():
+            logging.error("LogFileWriter - The writer thread is not running, not waiting to %s %s" % (operation, log_file))
+            return
+        
+        done = threading.Event()
+        self.queue.put((operation, log_file, done))
+        while not done.wait(self.alive_check_interval):
+            if not self.is_alive():
+                logging.error("LogFileWriter - The writer thread ended before it could %s %s" % (operation, log_file))
+                return
+    
+    def _flush_files(self):
+        for log_file in self.unflushed_files:
+            try:
+                log_file.flush()
+            except Exception, e:
+                logging.error("LogFileWriter - Error flushing log file %s (%s)" % (log_file, e))
+        self.unflushed_files.clear()
+    
+    def _get_queued_items(self, timeout):
+        # Everything that is queued is handled as one batch
+        queued_items = [self.queue.get(timeout=timeout)]
+        try:
+            while True:
+                queued_items.append(self.queue.get_nowait())
+        except Queue.Empty:
+            return queued_items
+    
+    def _handle_item(self, operation, log_file, argument):
+        if operation == "write":
+            log_file.writelines(argument)
+            self.unflushed_files.add(log_file)
+            return
+        
+        try:
+            if operation == "close":
+                self.unflushed_files.discard(log_file)
+                log_file.flush()
+                log_file.close()
+            elif operation == "drain":
+                self._flush_files()
+        finally:
+            if argument is not None:
+                argument.set()
+    
+    def run(self):
+        next_flush_time = time.time() + self.flush_interval
+        
+        while True:
+            try:
+                queued_items = self._get_queued_items(max(0.0, next_flush_time - time.time()))
+            except Queue.Empty:
+                queued_items = []
+            
+            for operation, log_file, argument in queued_items:
+                if operation == "stop":
+                    self._flush_files()
+                    return
+                
+                try:
+                    self._handle_item(operation, log_file, argument)
+                except Exception, e:
+                    # An error in one file, e.g. a line that is not a string or a failed compression, does not stop the others
+                    logging.error("LogFileWriter - Error writing to log file %s (%s)" % (log_file, e))
+            
+            if time.time() >= next_flush_time:
+                self._flush_files()
+                next_flush_time = time.time() + self.flush_interval
+
+
+# Index entry (timestamp, byte offset, row number) of the sidecar written next to a log file
+LOG_INDEX_STRUCT = struct.Struct("<dQQ")
+LOG_INDEX_DTYPE = numpy.dtype([("timestamp", "<f8"), ("offset", "<u8"), ("row", "<u8")])
+LOG_INDEX_EXTENSION = ".idx"
+
+
+def find_timestamp_column(columns_list):
+    """Index of the timestamp column, named "timestamp" in any case (E4 streams use "TIMESTAMP"), or None"""
+    for column_i, column in enumerate(columns_list):
+        if column.lower() == "timestamp":
+            return column_i
+    return None
+
+
+class GzipLogFile(gzip.GzipFile):
+    """Gzip file that compresses a block of lines at once"""
+    
+    def writelines(self, lines):
+        self.write("".join(lines))
+
+
+class ZstdLogFile(object):
+    """Write-only file that compresses its lines into a single zstd frame. A
+    flush ends the current block, so that the flushed rows can be read while
+    the file is still written."""
+    
+    def __init__(self, path, level=3):
+        self.name = path
+        self.raw_file = open(path, "wb")
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    
+    def write(self, data):
+        self.raw_file.write(self.compressor.compress(data))
+    
+    def writelines(self, lines):
+        self.write("".join(lines))
+    
+    def flush(self):
+        self.raw_file.write(self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+        self.raw_file.flush()
+    
+    def close(self):
+        self.raw_file.write(self.compressor.flush())
+        self.raw_file.close()
+
+
+# Extensions of the compressions of csv logs
+COMPRESSION_EXTENSIONS = {"gzip": ".gz",
+                          "zstd": ".zst"}
+
+
+class DecompressingLogReader(object):
+    """Reads the lines of a compressed csv log while decompressing it block by
+    block, so only about a block is held in memory. The compressed formats
+    have no random access, seek skips forward by decompressing and discarding
+    the content before the offset: an index saves parsing the rows before a
+    time range, but not decompressing them, so rotated segments should be kept
+    small. A file that is still being written is read as far as it is flushed."""
+    
+    block_size = 1 << 16
+    
+    def __init__(self, path, decompressor):
+        self.raw_file = open(path, "rb")
+        self.decompressor = decompressor
+        self.buffer = ""
+        self.buffer_i = 0
+        # Position of the start of the buffer in the uncompressed content
+        self.buffer_position = 0
+        self.end_of_file = False
+    
+    def read_block(self):
+        compressed_block = self.raw_file.read(self.block_size)
+        if not compressed_block:
+            self.end_of_file = True
+            return ""
+        return self.decompressor.decompress(compressed_block)
+    
+    def tell(self):
+        return self.buffer_position + self.buffer_i
+    
+    def seek(self, offset):
+        if offset < self.tell():
+            raise IOError("%s can only be read forward" % self.raw_file.name)
+        
+        while self.buffer_position + len(self.buffer) < offset and not self.end_of_file:
+            self.buffer_position += len(self.buffer)
+            self.buffer = self.read_block()
+        
+        self.buffer_i = min(offset - self.buffer_position, len(self.buffer))
+    
+    def readline(self):
+        line_end = self.buffer.find("\n", self.buffer_i)
+        while line_end < 0 and not self.end_of_file:
+            # The start of the line is kept and the next block appended
+            self.buffer_position += self.buffer_i
+            self.buffer = self.buffer[self.buffer_i:] + self.read_block()
+            self.buffer_i = 0
+            line_end = self.buffer.find("\n")
+        
+        line_start = self.buffer_i
+        self.buffer_i = line_end + 1 if line_end >= 0 else len(self.buffer)
+        return self.buffer[line_start:self.buffer_i]
+    
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+    
+    def close(self):
+        self.raw_file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+
+def open_log_file_for_reading(path):
+    """Uncompressed content of a csv log file as a file object with readline,
+    forward seek and line iteration"""
+    if path.endswith(COMPRESSION_EXTENSIONS["gzip"]):
+        return DecompressingLogReader(path, zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif path.endswith(COMPRESSION_EXTENSIONS["zstd"]):
+        return DecompressingLogReader(path, zstandard.ZstdDecompressor().decompressobj())
+    else:
+        return open(path, "rb")
+
+
+# Longer strings are cut off in binary logs
+STRING_COLUMN_LENGTH = 32
+
+
+def infer_column_dtype(value):
+    """NumPy type to store a column in, from one of its values"""
+    if isinstance(value, (bool, numpy.bool_)):
+        return numpy.dtype("?")
+    elif isinstance(value, (int, long, numpy.integer)):
+        return numpy.dtype("<i8")
+    elif isinstance(value, (float, numpy.floating)):
+        return numpy.dtype("<f8")
+    else:
+        return numpy.dtype("S%d" % STRING_COLUMN_LENGTH)
+
+
+def infer_stored_column_dtype(value):
+    """NumPy type of a column in binary logs, integers are stored as floats so
+    that a column that starts with an integer can take floats later"""
+    column_dtype = infer_column_dtype(value)
+    return numpy.dtype("<f8") if column_dtype.kind == "i" else column_dtype
+
+
+def parse_csv_value(text):
+    """Number or string of a csv field"""
+    for value_type in (int, float):
+        try:
+            return value_type(text)
+        except ValueError:
+            pass
+    return text
+
+
+class RowFormatter(object):
+    """Formats rows as csv lines with a single % operation per row. The row
+    format is compiled from the column names and the types of the values of
+    the first row: timestamp columns get timestamp_precision decimals, other
+    floats float_precision significant digits, and bools are written as 1/0
+    with bool_as_int. Rows that do not fit the format are joined with str."""
+    
+    def __init__(self, columns_list, float_precision=12, timestamp_precision=3, bool_as_int=False):
+        self.columns_list = columns_list
+        self.float_precision = float_precision
+        self.timestamp_precision = timestamp_precision
+        self.bool_as_int = bool_as_int
+        self.row_format = None
+    
+    def get_column_format(self, column, value):
+        value_kind = infer_column_dtype(value).kind
+        
+        if value_kind == "b":
+            return "%d" if self.bool_as_int else "%s"
+        elif value_kind == "f" and "timestamp" in column.lower():
+            return "%%.%df" % self.timestamp_precision
+        elif value_kind == "f":
+            return "%%.%dg" % self.float_precision
+        else:
+            # Integers and strings, %s also keeps a float in an integer column intact
+            return "%s"
+    
+    def compile(self, first_row):
+        column_formats = [self.get_column_format(column, value) for column, value in itertools.izip(self.columns_list, first_row)]
+        self.row_format = ",".join(column_formats) + "\r\n"
+    
+    def format_row(self, row):
+        if self.row_format is None:
+            self.compile(row)
+        
+        try:
+            return self.row_format % tuple(row)
+        except TypeError:
+            return ",".join(str(value) for value in row) + "\r\n"
+    
+    def format_rows(self, rows):
+        # A list, so that the rows can be formatted again if one does not fit the format
+        rows = list(rows)
+        if self.row_format is None:
+            self.compile(rows[0])
+        
+        row_format = self.row_format
+        try:
+            return [row_format % row for row in rows]
+        except TypeError:
+            return [self.format_row(row) for row in rows]
+
+
 class DataLogger(object):
-    def __init__(self, base_path, file_name, columns_list, write_to_log_lock):
-        current_time = datetime.datetime.now().strftime("%Y%m%d_%I%M%S")
+    """Writes rows as csv lines. With compression ("gzip" or "zstd") the lines
+    are compressed by the LogFileWriter thread. The log is split into segment
+    files once a segment holds max_file_bytes uncompressed bytes or is open for
+    max_file_seconds seconds. Every segment has its own header and index, and a
+    <file name>_<time>.manifest file lists the closed segments as JSON lines."""
+    file_extension = ""
+    file_mode = "wa"
+    # Rows between the entries of the timestamp index, None for no index
+    index_interval = 1000
+    
+    def __init__(self, base_path, file_name, columns_list, write_to_log_lock, log_writer=None, row_formatter=None,
+                 compression=None, max_file_bytes=None, max_file_seconds=None, session_time=None):
+        # The loggers of a session share its time, so that they write into one directory
+        if session_time is None:
+            session_time = datetime.datetime.now()
+        current_time = session_time.strftime("%Y%m%d_%I%M%S")
         self.create_directory_if_does_not_exist(base_path, current_time)
-        self.path = os.path.join(base_path + "_" + current_time, file_name + "_" + current_time)
-        self.log_file = open(self.path, "wa")
-        self.log_file.write(",".join(columns_list))
-        self.log_file.write("\r\n")
-        print "Logging incoming data into %s " % self.path
+        self.file_base_path = os.path.join(base_path + "_" + current_time, file_name + "_" + current_time)
         
         self.lock = write_to_log_lock
         self.columns_list = columns_list
+        # Without a LogFileWriter the lines are written right away
+        self.log_writer = log_writer
+        self.row_formatter = row_formatter if row_formatter is not None else RowFormatter(columns_list)
+        
+        if compression == "zstd" and zstandard is None:
+            logging.warning("DataLogger - zstandard is not installed, compressing %s with gzip" % self.file_base_path)
+            compression = "gzip"
+        self.compression = compression
+        self.max_file_bytes = max_file_bytes
+        self.max_file_seconds = max_file_seconds
+        
+        self.timestamp_column_i = find_timestamp_column(columns_list)
+        
+        self.manifest_file = None
+        if compression is not None or max_file_bytes is not None or max_file_seconds is not None:
+            self.manifest_file = open(self.file_base_path + ".manifest", "wb")
+        
+        self.segment_i = 0
+        self.open_log_file()
+    
+    def get_segment_path(self, segment_i):
+        path = self.file_base_path
+        if segment_i > 0:
+            path += "_part%03d" % segment_i
+        return path + self.file_extension + COMPRESSION_EXTENSIONS.get(self.compression, "")
+    
+    def open_log_file(self):
+        self.path = self.get_segment_path(self.segment_i)
+        if self.compression == "gzip":
+            self.log_file = GzipLogFile(self.path, "wb")
+        elif self.compression == "zstd":
+            self.log_file = ZstdLogFile(self.path)
+        else:
+            self.log_file = open(self.path, self.file_mode)
+        
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.segment_start_time = time.time()
+        self.first_timestamp = None
+        self.last_timestamp = None
+        
+        self.index_file = None
+        if self.index_interval is not None and self.timestamp_column_i is not None:
+            self.index_file = open(self.path + LOG_INDEX_EXTENSION, "wb")
+        
+        self.write_header()
+        print "Logging incoming data into %s " % self.path
+    
+    def write_header(self):
+        header_line = ",".join(self.columns_list) + "\r\n"
+        self.log_file.write(header_line)
+        self.bytes_written = len(header_line)
                 
     def create_directory_if_does_not_exist(self, base_path, current_time):
         if os.path.exists(base_path + "_" + current_time): return
-        os.makedirs(base_path + "_" + current_time)
+        try:
+            os.makedirs(base_path + "_" + current_time)
+        except OSError:
+            # Loggers of a session can be opened from another thread at the same time
+            if not os.path.isdir(base_path + "_" + current_time):
+                raise
         
     def write_tuple_to_log_file(self, values_in_tuple, show_on_screen=False):
-        tuple_to_list = [str(value) for value in values_in_tuple]
-        self.write_list_to_log_file(tuple_to_list, show_on_screen)
+        if self.lock.is_write_locked:
+            return
+        self.write_list_to_log_file(tuple(values_in_tuple), show_on_screen)
         
     def write_dict_to_log_file(self, values_in_dictionary, show_on_screen=False):
+        if self.lock.is_write_locked:
+            return
         dict_to_list = [values_in_dictionary[key] for key in self.columns_list]
         self.write_list_to_log_file(dict_to_list, show_on_screen)
         
@@ -123,21 +543,659 @@ class DataLogger(object):
         if self.lock.is_write_locked:
             return
         
-        line_to_write = ",".join(values_in_list) + "\r\n"
+        line_to_write = self.row_formatter.format_row(values_in_list)
 
-        self.log_file.write(line_to_write)
+        row_timestamps = None
+        if self.timestamp_column_i is not None:
+            row_timestamps = [values_in_list[self.timestamp_column_i]]
+        self.write_rows_to_log_file([line_to_write], row_timestamps)
         
         if show_on_screen:
             print line_to_write
             
+    def write_columns_to_log_file(self, columns, show_on_screen=False):
+        """Write a block of rows given as columns. A column is either a list or an
+        array with one value per row, or a single value shared by all rows."""
+        if self.lock.is_write_locked:
+            return
+        
+        row_count = 0
+        column_values = []
+        
+        row_timestamps = None
+        if self.timestamp_column_i is not None:
+            row_timestamps = columns[self.timestamp_column_i]
+        
+        for column in columns:
+            if isinstance(column, numpy.ndarray):
+                column = column.tolist()
+            
+            if isinstance(column, list):
+                column_values.append(column)
+                row_count = len(column)
+            else:
+                column_values.append(itertools.repeat(column))
+        
+        if not row_count:
+            return
+        
+        lines_to_write = self.row_formatter.format_rows(itertools.izip(*column_values))
+        
+        if not isinstance(row_timestamps, (numpy.ndarray, list)) and row_timestamps is not None:
+            row_timestamps = [row_timestamps] * row_count
+        self.write_rows_to_log_file(lines_to_write, row_timestamps)
+        
+        if show_on_screen:
+            print "".join(lines_to_write)
+            
     def write_line(self, line):
         if self.lock.is_write_locked:
             return
-        self.log_file.write(line + "\r\n") 
+        self.write_rows_to_log_file([line + "\r\n"], None)
+    
+    def write_rows_to_log_file(self, lines, row_timestamps):
+        """Write the lines of rows and add the rows that are due to the timestamp
+        index, row_timestamps is a list or array with the timestamp of every row,
+        or None. A full segment is rotated before the lines are written."""
+        if self.is_rotation_due():
+            self.rotate_log_file()
+        
+        if row_timestamps is not None and len(lines):
+            if self.first_timestamp is None:
+                self.first_timestamp = float(row_timestamps[0])
+            self.last_timestamp = float(row_timestamps[len(lines) - 1])
+        
+        if self.index_file is not None and row_timestamps is not None:
+            first_index_line_i = -self.rows_written % self.index_interval
+            
+            if first_index_line_i < len(lines):
+                index_entries = []
+                line_offset = self.bytes_written
+                previous_line_i = 0
+                
+                for line_i in range(first_index_line_i, len(lines), self.index_interval):
+                    line_offset += sum(itertools.imap(len, lines[previous_line_i:line_i]))
+                    previous_line_i = line_i
+                    index_entries.append(LOG_INDEX_STRUCT.pack(float(row_timestamps[line_i]), line_offset,
+                                                                self.rows_written + line_i))
+                
+                self.write_lines_to_file(self.index_file, index_entries)
+        
+        self.rows_written += len(lines)
+        self.bytes_written += sum(itertools.imap(len, lines))
+        self.write_lines_to_log_file(lines)
+    
+    def write_lines_to_log_file(self, lines):
+        self.write_lines_to_file(self.log_file, lines)
+    
+    def write_lines_to_file(self, output_file, lines):
+        if self.log_writer is not None:
+            self.log_writer.write_lines(output_file, lines)
+        else:
+            output_file.writelines(lines)
+    
+    def is_rotation_due(self):
+        if not self.rows_written:
+            return False
+        elif self.max_file_bytes is not None and self.bytes_written >= self.max_file_bytes:
+            return True
+        elif self.max_file_seconds is not None and time.time() - self.segment_start_time >= self.max_file_seconds:
+            return True
+        return False
+    
+    def rotate_log_file(self):
+        """Close the current segment without waiting for the disk and continue in the next one"""
+        self.close_segment(wait=False)
+        self.segment_i += 1
+        self.open_log_file()
+    
+    def close_segment(self, wait=True):
+        for output_file in [self.log_file, self.index_file]:
+            if output_file is not None:
+                self.close_file(output_file, wait)
+        
+        if self.manifest_file is not None:
+            # The entry is queued after the segment, so a listed segment is complete
+            manifest_entry = {"segment": self.segment_i,
+                              "path": os.path.basename(self.path),
+                              "compression": self.compression,
+                              "rows": self.rows_written,
+                              "bytes": self.bytes_written,
+                              "start_time": self.segment_start_time,
+                              "end_time": time.time(),
+                              "first_timestamp": self.first_timestamp,
+                              "last_timestamp": self.last_timestamp}
+            self.write_lines_to_file(self.manifest_file, [json.dumps(manifest_entry, sort_keys=True) + "\n"])
+    
+    def close_file(self, output_file, wait=True):
+        if self.log_writer is not None:
+            self.log_writer.close_file(output_file, wait)
+        else:
+            output_file.flush()
+            output_file.close()
+    
+    def close_log_file(self, wait=True):
+        """Close the files, without waiting for the LogFileWriter to write them if wait is False"""
+        self.close_segment(wait)
+        if self.manifest_file is not None:
+            self.close_file(self.manifest_file, wait)
+
+
+class PreRollBuffer(object):
+    """Ring buffer of the last rows of a stream, kept while logging is locked.
+    Every row is one record of a NumPy structured array, so a row costs one
+    array write. Columns that start with a number hold floats, the others hold
+    the values themselves, so that the rows are kept without loss. The buffer
+    holds at most max_bytes of rows, counting 8 bytes for a value that is not a
+    number, and only the rows that arrived in the last duration seconds are
+    taken out of it. Rows that do not fit the columns, such as a string in a
+    number column, are dropped. They are converted before any of them is
+    written to the buffer, so that they never overwrite the rows it holds."""
+    
+    def __init__(self, columns_list, duration, max_bytes):
+        self.columns_list = columns_list
+        self.duration = duration
+        self.max_bytes = max_bytes
+        self.rows = None
+        # Rows appended since the buffer was last taken, including the overwritten ones
+        self.row_count = 0
+    
+    def allocate(self, first_row):
+        row_dtype = numpy.dtype([("f%d" % column_i, self.get_column_dtype(value)) for column_i, value in enumerate(first_row)] +
+                                [("arrival_time", "<f8")])
+        self.rows = numpy.zeros(max(1, self.max_bytes // row_dtype.itemsize), dtype=row_dtype)
     
-    def close_log_file(self):
-        self.log_file.flush()
-        self.log_file.close()
+    def get_column_dtype(self, value):
+        if infer_column_dtype(value).kind in "if":
+            return numpy.dtype("<f8")
+        return numpy.dtype("O")
+    
+    def append_row(self, values, arrival_time):
+        if self.rows is None:
+            self.allocate(values)
+        
+        try:
+            record = numpy.array(tuple(values) + (arrival_time,), dtype=self.rows.dtype)
+        except (ValueError, TypeError):
+            return
+        self.rows[self.row_count % len(self.rows)] = record
+        self.row_count += 1
+    
+    def append_columns(self, columns, arrival_time):
+        """Append a block of rows given as columns, as in DataLogger.write_columns_to_log_file"""
+        row_count = 0
+        for column in columns:
+            if isinstance(column, (numpy.ndarray, list)):
+                row_count = len(column)
+        
+        if not row_count:
+            return
+        
+        if self.rows is None:
+            self.allocate([column[0] if isinstance(column, (numpy.ndarray, list)) else column for column in columns])
+        
+        # Only the last rows of a block that is larger than the buffer are kept
+        skipped_row_count = max(0, row_count - len(self.rows))
+        positions = numpy.arange(self.row_count + skipped_row_count, self.row_count + row_count) % len(self.rows)
+        
+        block_rows = numpy.empty(len(positions), dtype=self.rows.dtype)
+        try:
+            if len(columns) != len(self.columns_list):
+                raise ValueError("%d columns instead of %d" % (len(columns), len(self.columns_list)))
+            for column_i, column in enumerate(columns):
+                if isinstance(column, (numpy.ndarray, list)):
+                    column = column[skipped_row_count:]
+                block_rows["f%d" % column_i] = column
+        except (ValueError, TypeError):
+            return
+        
+        block_rows["arrival_time"] = arrival_time
+        self.rows[positions] = block_rows
+        self.row_count += row_count
+    
+    def take_columns(self, now):
+        """Columns of the rows that arrived since now - duration, oldest first, and empty the buffer"""
+        stored_row_count = min(self.row_count, len(self.rows))
+        rows = self.rows[numpy.arange(self.row_count - stored_row_count, self.row_count) % len(self.rows)]
+        rows = rows[rows["arrival_time"] >= now - self.duration]
+        
+        self.row_count = 0
+        return [rows["f%d" % column_i] for column_i in range(len(self.columns_list))]
+
+
+class LazyDataLogger(object):
+    """Stands in for a logger that is only created by create_logger() when the
+    first row is written to it, so that no files are opened for the streams
+    that produce no data while logging is on. Rows written after the logger is
+    closed are dropped. Rows written while logging is locked are dropped too,
+    or kept in the pre_roll PreRollBuffer and written ahead of the first rows
+    after logging is unlocked."""
+    
+    def __init__(self, create_logger, write_to_log_lock, pre_roll=None):
+        self.create_logger = create_logger
+        self.lock = write_to_log_lock
+        self.pre_roll = pre_roll
+        self.logger = None
+        self.closed = False
+    
+    def get_logger(self):
+        if self.logger is None:
+            self.logger = self.create_logger()
+        return self.logger
+    
+    def get_logger_for_writing(self):
+        logger = self.get_logger()
+        if self.pre_roll is not None and self.pre_roll.row_count:
+            logger.write_columns_to_log_file(self.pre_roll.take_columns(time.time()))
+        return logger
+    
+    def is_writable(self):
+        return not (self.closed or self.lock.is_write_locked)
+    
+    def is_pre_rolling(self):
+        return self.pre_roll is not None and not self.closed
+    
+    def write_tuple_to_log_file(self, values_in_tuple, show_on_screen=False):
+        if self.is_writable():
+            self.get_logger_for_writing().write_tuple_to_log_file(values_in_tuple, show_on_screen)
+        elif self.is_pre_rolling():
+            self.pre_roll.append_row(tuple(values_in_tuple), time.time())
+    
+    def write_dict_to_log_file(self, values_in_dictionary, show_on_screen=False):
+        if self.is_writable():
+            self.get_logger_for_writing().write_dict_to_log_file(values_in_dictionary, show_on_screen)
+        elif self.is_pre_rolling():
+            self.pre_roll.append_row([values_in_dictionary[key] for key in self.pre_roll.columns_list], time.time())
+    
+    def write_list_to_log_file(self, values_in_list, show_on_screen=False):
+        if self.is_writable():
+            self.get_logger_for_writing().write_list_to_log_file(values_in_list, show_on_screen)
+        elif self.is_pre_rolling():
+            self.pre_roll.append_row(values_in_list, time.time())
+    
+    def write_columns_to_log_file(self, columns, show_on_screen=False):
+        if self.is_writable():
+            self.get_logger_for_writing().write_columns_to_log_file(columns, show_on_screen)
+        elif self.is_pre_rolling():
+            self.pre_roll.append_columns(columns, time.time())
+    
+    def write_line(self, line):
+        # Lines are not rows, they are never kept in the pre-roll
+        if self.is_writable():
+            self.get_logger_for_writing().write_line(line)
+    
+    def take_pre_roll(self, logger):
+        """Continue the pre-roll of the logger of the same stream in a previous session"""
+        if logger.pre_roll is not None and self.pre_roll is not None:
+            self.pre_roll, logger.pre_roll = logger.pre_roll, None
+    
+    def close_log_file(self, wait=True):
+        if self.is_writable() and self.pre_roll is not None and self.pre_roll.row_count:
+            # The stream stopped before writing rows after the unlock
+            self.get_logger_for_writing()
+        
+        self.closed = True
+        if self.logger is not None:
+            self.logger.close_log_file(wait)
+
+
+BINARY_LOG_MAGIC = "RSNVBIN1"
+BINARY_LOG_HEADER_STRUCT = struct.Struct("<8sI")
+BINARY_LOG_CHUNK_ROW_COUNT_DTYPE = "<u4"
+
+class BinaryDataLogger(DataLogger):
+    """Writes the rows as typed columns in chunks of chunk_rows rows instead of
+    text. The file starts with a JSON header with the column names and types,
+    the types are taken from the first row, with numbers stored as floats.
+    Later values that do not fit the type of their column safely are cast to
+    it, values that can not be cast are stored as NaN, or as False or an empty
+    string, and the first such value of every column is logged. Every chunk holds its row count and then chunk_rows values of every
+    column, only the last chunk of a file is partially filled. BinaryLog
+    memory-maps the files. Binary logs are neither compressed nor rotated."""
+    file_extension = ".bin"
+    file_mode = "wb"
+    chunk_rows = 1024
+    # The timestamps of the chunks are searched directly, see BinaryLog.get_time_range
+    index_interval = None
+    
+    def write_header(self):
+        # The header is written with the first row, once the column types are known
+        self.column_dtypes = None
+        # Indices of the columns whose cast values were logged
+        self.cast_column_indices = set()
+        self.pending_blocks = [[] for column in self.columns_list]  #@UnusedVariable
+        self.pending_row_count = 0
+    
+    def _write_binary_header(self):
+        header = json.dumps({"columns": list(self.columns_list),
+                             "dtypes": [column_dtype.str for column_dtype in self.column_dtypes],
+                             "chunk_rows": self.chunk_rows})
+        # Pad the header so that the chunks start 8 byte aligned
+        header += " " * (-(BINARY_LOG_HEADER_STRUCT.size + len(header)) % 8)
+        self.write_lines_to_log_file([BINARY_LOG_HEADER_STRUCT.pack(BINARY_LOG_MAGIC, len(header)), header])
+    
+    def write_tuple_to_log_file(self, values_in_tuple, show_on_screen=False):
+        self.write_list_to_log_file(list(values_in_tuple), show_on_screen)
+    
+    def set_column_dtypes(self, first_values):
+        self.column_dtypes = [infer_stored_column_dtype(value) for value in first_values]
+        self._write_binary_header()
+    
+    def cast_column_values(self, columns):
+        """The columns, a single value or a list or array of values each, with the
+        values that do not fit the type of their column without loss cast to it.
+        The rows come from the protocols of the sensors, a value of the wrong type
+        is logged rather than raised so that the samples keep going."""
+        cast_columns = list(columns)
+        
+        for column_i, (column, values, column_dtype) in enumerate(itertools.izip(self.columns_list, columns, self.column_dtypes)):
+            values = numpy.asarray(values)
+            if numpy.can_cast(values.dtype, column_dtype, "safe"):
+                continue
+            
+            if column_i not in self.cast_column_indices:
+                self.cast_column_indices.add(column_i)
+                logging.warning("BinaryDataLogger - column %s of %s holds %s values, casting %s values to it" %
+                                (column, self.path, column_dtype, values.dtype))
+            
+            try:
+                values = values.astype(column_dtype)
+            except (ValueError, TypeError):
+                missing_value = numpy.nan if column_dtype.kind == "f" else numpy.zeros((), column_dtype)
+                values = numpy.array([self.cast_value(value, column_dtype, missing_value) for value in values.flat],
+                                     dtype=column_dtype).reshape(values.shape)
+            cast_columns[column_i] = values if values.ndim else values[()]
+        
+        return cast_columns
+    
+    def cast_value(self, value, column_dtype, missing_value):
+        try:
+            return numpy.asarray(value).astype(column_dtype)[()]
+        except (ValueError, TypeError):
+            return missing_value
+    
+    def write_list_to_log_file(self, values_in_list, show_on_screen=False):
+        if self.lock.is_write_locked:
+            return
+        
+        if self.column_dtypes is None:
+            self.set_column_dtypes(values_in_list)
+        values_in_list = self.cast_column_values(values_in_list)
+        
+        for blocks, value in itertools.izip(self.pending_blocks, values_in_list):
+            # Rows are collected in a list block of their own
+            if blocks and isinstance(blocks[-1], list):
+                blocks[-1].append(value)
+            else:
+                blocks.append([value])
+        
+        self.pending_row_count += 1
+        self._write_full_chunks()
+        
+        if show_on_screen:
+            print values_in_list
+    
+    def write_columns_to_log_file(self, columns, show_on_screen=False):
+        if self.lock.is_write_locked:
+            return
+        
+        row_count = 0
+        for column in columns:
+            if isinstance(column, (numpy.ndarray, list)):
+                row_count = len(column)
+        
+        if not row_count:
+            return
+        
+        if self.column_dtypes is None:
+            self.set_column_dtypes([column[0] if isinstance(column, (numpy.ndarray, list)) else column for column in columns])
+        columns = self.cast_column_values(columns)
+        
+        for blocks, column in itertools.izip(self.pending_blocks, columns):
+            if isinstance(column, numpy.ndarray):
+                blocks.append(column)
+            elif isinstance(column, list):
+                blocks.append(column[:])
+            else:
+                blocks.append([column] * row_count)
+        
+        self.pending_row_count += row_count
+        self._write_full_chunks()
+        
+        if show_on_screen:
+            print columns
+    
+    def write_line(self, line):
+        # The fields of the csv line are written as a row
+        self.write_list_to_log_file([parse_csv_value(value) for value in line.rstrip("\r\n").split(",")])
+    
+    def _get_pending_columns(self):
+        return [numpy.concatenate([numpy.asarray(block, dtype=column_dtype) for block in blocks])
+                for blocks, column_dtype in itertools.izip(self.pending_blocks, self.column_dtypes)]
+    
+    def _write_chunk(self, columns, row_count):
+        chunk_parts = [numpy.array([row_count], dtype=BINARY_LOG_CHUNK_ROW_COUNT_DTYPE).tobytes()]
+        
+        for column, column_dtype in itertools.izip(columns, self.column_dtypes):
+            if len(column) < self.chunk_rows:
+                padded_column = numpy.zeros(self.chunk_rows, dtype=column_dtype)
+                padded_column[:len(column)] = column
+                column = padded_column
+            
+            chunk_parts.append(column.tobytes())
+        
+        self.write_lines_to_log_file(chunk_parts)
+    
+    def _write_full_chunks(self):
+        if self.pending_row_count < self.chunk_rows:
+            return
+        
+        columns = self._get_pending_columns()
+        
+        chunk_start = 0
+        while self.pending_row_count - chunk_start >= self.chunk_rows:
+            chunk_end = chunk_start + self.chunk_rows
+            self._write_chunk([column[chunk_start:chunk_end] for column in columns], self.chunk_rows)
+            chunk_start = chunk_end
+        
+        self.pending_blocks = [[column[chunk_start:]] for column in columns]
+        self.pending_row_count -= chunk_start
+    
+    def close_log_file(self, wait=True):
+        if self.pending_row_count:
+            columns = self._get_pending_columns()
+            self._write_chunk(columns, self.pending_row_count)
+        elif self.column_dtypes is None:
+            # Nothing was logged, the column types are unknown
+            self.set_column_dtypes([0.0 for column in self.columns_list])  #@UnusedVariable
+        
+        self.pending_blocks = [[] for column in self.columns_list]  #@UnusedVariable
+        self.pending_row_count = 0
+        
+        DataLogger.close_log_file(self, wait)
+
+
+class BinaryLog(object):
+    """Memory-mapped binary log written by BinaryDataLogger. The chunks
+    attribute is a structured array with a (chunk count, chunk rows) view of
+    every column, get_column returns one column as a flat array."""
+    
+    def __init__(self, path):
+        with open(path, "rb") as log_file:
+            magic, header_length = BINARY_LOG_HEADER_STRUCT.unpack(log_file.read(BINARY_LOG_HEADER_STRUCT.size))
+            if magic != BINARY_LOG_MAGIC:
+                raise ValueError("%s is not a binary log" % path)
+            header = json.loads(log_file.read(header_length))
+        
+        self.path = path
+        self.columns_list = [str(column) for column in header["columns"]]
+        self.column_dtypes = [numpy.dtype(str(column_dtype)) for column_dtype in header["dtypes"]]
+        self.chunk_rows = header["chunk_rows"]
+        
+        chunk_dtype = numpy.dtype([("row_count", BINARY_LOG_CHUNK_ROW_COUNT_DTYPE)] +
+                                  [(column, column_dtype, (self.chunk_rows,))
+                                   for column, column_dtype in itertools.izip(self.columns_list, self.column_dtypes)])
+        data_offset = BINARY_LOG_HEADER_STRUCT.size + header_length
+        # A chunk that was not written completely is ignored
+        chunk_count = (os.path.getsize(path) - data_offset) // chunk_dtype.itemsize
+        
+        if chunk_count:
+            self.chunks = numpy.memmap(path, chunk_dtype, "r", data_offset, (chunk_count,))
+        else:
+            self.chunks = numpy.zeros(0, chunk_dtype)
+        
+        self.row_count = int(self.chunks["row_count"].sum())
+    
+    def __len__(self):
+        return self.row_count
+    
+    def get_column(self, column):
+        return self.chunks[column].reshape(-1)[:self.row_count]
+    
+    def __getitem__(self, column):
+        return self.get_column(column)
+    
+    def get_time_range(self, start_timestamp, end_timestamp, timestamp_column=None):
+        """Columns of the rows with start_timestamp <= timestamp < end_timestamp.
+        Only the chunks around the range are read, found by their first
+        timestamps, so the rows have to be ordered by time."""
+        if timestamp_column is None:
+            timestamp_column_i = find_timestamp_column(self.columns_list)
+            if timestamp_column_i is None:
+                raise ValueError("%s has no timestamp column" % self.path)
+            timestamp_column = self.columns_list[timestamp_column_i]
+        
+        if not self.row_count:
+            return dict((column, self.get_column(column)) for column in self.columns_list)
+        
+        chunk_start_timestamps = self.chunks[timestamp_column][:, 0]
+        first_chunk_i = max(0, numpy.searchsorted(chunk_start_timestamps, start_timestamp, "right") - 1)
+        end_chunk_i = numpy.searchsorted(chunk_start_timestamps, end_timestamp, "left")
+        
+        chunks = self.chunks[first_chunk_i:end_chunk_i]
+        chunk_row_count = int(chunks["row_count"].sum())
+        
+        timestamps = chunks[timestamp_column].reshape(-1)[:chunk_row_count]
+        first_row_i = numpy.searchsorted(timestamps, start_timestamp, "left")
+        end_row_i = numpy.searchsorted(timestamps, end_timestamp, "left")
+        
+        return dict((column, chunks[column].reshape(-1)[first_row_i:end_row_i]) for column in self.columns_list)
+
+
+def load_log_index(log_path):
+    """Timestamp index of a csv log file as a LOG_INDEX_DTYPE array"""
+    index_path = log_path + LOG_INDEX_EXTENSION
+    if not os.path.exists(index_path):
+        return numpy.zeros(0, LOG_INDEX_DTYPE)
+    
+    index_entries = numpy.fromfile(index_path, LOG_INDEX_DTYPE)
+    return index_entries
+
+
+def read_csv_log_time_range(log_path, start_timestamp, end_timestamp):
+    """Columns of the rows of a csv log with start_timestamp <= timestamp < end_timestamp,
+    as lists of strings. The reading starts at the index entry before the range,
+    the offsets of the index are positions in the uncompressed content. Logs
+    without an index are read from the start."""
+    index_entries = load_log_index(log_path)
+    
+    with open_log_file_for_reading(log_path) as log_file:
+        columns_list = log_file.readline().rstrip("\r\n").split(",")
+        timestamp_column_i = find_timestamp_column(columns_list)
+        if timestamp_column_i is None:
+            raise ValueError("%s has no timestamp column" % log_path)
+        
+        index_entry_i = numpy.searchsorted(index_entries["timestamp"], start_timestamp, "left") - 1
+        if index_entry_i >= 0:
+            log_file.seek(int(index_entries["offset"][index_entry_i]))
+        
+        rows = []
+        for line in log_file:
+            if not line.endswith("\n"):
+                # The last row is still being written
+                break
+            
+            values = line.rstrip("\r\n").split(",")
+            row_timestamp = float(values[timestamp_column_i])
+            
+            if row_timestamp >= end_timestamp:
+                break
+            elif row_timestamp >= start_timestamp:
+                rows.append(values)
+    
+    columns = zip(*rows) if rows else [()] * len(columns_list)
+    return dict((column, list(values)) for column, values in zip(columns_list, columns))
+
+
+class SessionLogReader(object):
+    """Reads time ranges of the streams logged with one base path. DataLogger
+    writes its files into <base path>_<time> directories, named
+    <file name>_<time>, with the time of their session, and a base path that
+    was used for several sessions has several directories. Rotated logs
+    continue in <file name>_<time>_part<segment> files."""
+    
+    time_suffix_pattern = re.compile(r"_\d{8}_\d{6}$")
+    segment_suffix_pattern = re.compile(r"_part\d+$")
+    log_extensions = ("", BinaryDataLogger.file_extension) + tuple(COMPRESSION_EXTENSIONS.values())
+    
+    def __init__(self, base_path):
+        self.base_path = base_path
+        # Paths of the log files of each stream
+        self.log_paths_of_stream = {}
+        
+        parent_path, base_name = os.path.split(base_path)
+        for directory_name in os.listdir(parent_path or "."):
+            directory_path = os.path.join(parent_path, directory_name)
+            
+            if not (directory_name.startswith(base_name) and self.time_suffix_pattern.match(directory_name[len(base_name):])
+                    and os.path.isdir(directory_path)):
+                continue
+            
+            for file_name in os.listdir(directory_path):
+                log_name, extension = os.path.splitext(file_name)
+                log_name = self.segment_suffix_pattern.sub("", log_name)
+                match = self.time_suffix_pattern.search(log_name)
+                
+                if extension in self.log_extensions and match is not None:
+                    stream_name = log_name[:match.start()]
+                    self.log_paths_of_stream.setdefault(stream_name, []).append(os.path.join(directory_path, file_name))
+        
+        # The time in the names has a 12 hour clock, the files are ordered by their modification time instead,
+        # a segment is closed before the next one is written to the end
+        for log_paths in self.log_paths_of_stream.values():
+            log_paths.sort(key=lambda log_path: (os.path.getmtime(log_path), log_path))
+    
+    def get_stream_names(self):
+        return sorted(self.log_paths_of_stream.keys())
+    
+    def read_time_range(self, stream_name, start_timestamp, end_timestamp):
+        """Columns of the rows of the stream with start_timestamp <= timestamp < end_timestamp,
+        arrays for binary logs and lists of strings for csv logs."""
+        columns_of_logs = []
+        
+        for log_path in self.log_paths_of_stream[stream_name]:
+            if log_path.endswith(BinaryDataLogger.file_extension):
+                columns_of_logs.append(BinaryLog(log_path).get_time_range(start_timestamp, end_timestamp))
+            else:
+                columns_of_logs.append(read_csv_log_time_range(log_path, start_timestamp, end_timestamp))
+        
+        if len(columns_of_logs) == 1:
+            return columns_of_logs[0]
+        
+        columns = {}
+        for column in columns_of_logs[0]:
+            column_parts = [log_columns[column] for log_columns in columns_of_logs]
+            if isinstance(column_parts[0], numpy.ndarray):
+                columns[column] = numpy.concatenate(column_parts)
+            else:
+                columns[column] = list(itertools.chain.from_iterable(column_parts))
+        
+        return columns
+
+
+# Logger classes of the formats that can be chosen per logging session
+LOGGER_CLASSES = {"csv": DataLogger,
+                  "binary": BinaryDataLogger}
         
         
 if __name__ == "__main__":
@@ -8,17 +8,21 @@ import argparse
 import os
 import subprocess
 import logging
+import datetime
+from functools import partial
 
 from twisted.internet import reactor
 from twisted.internet.serialport import SerialPort
 from twisted.internet import stdio
+from twisted.internet import threads
+from twisted.internet import defer
 #from autobahn.twisted.websocket import WebSocketServerFactory
 from twisted.internet.protocol import ReconnectingClientFactory, Protocol
 
-from Logger import DataLogger, WriteToLogLock, LoggingUserControl, LoggingWebsocketControlFactory
+from Logger import LOGGER_CLASSES, LazyDataLogger, LogFileWriter, PreRollBuffer, RowFormatter, WriteToLogLock, LoggingUserControl, LoggingWebsocketControlFactory
 
 from E4BLEClient import E4ClientFactory
-from BioharnessClient import BioharnessProtocol
+from BioharnessClient import BioharnessProtocol, BioharnessDeviceManager
 from E4Commands import StreamMessagesDecoder
 from IntraFaceClient import InrafaceSample, IntraFaceClientFactory
 
@@ -36,12 +40,35 @@ def parse_commandline_arguments():
 
 class LoggersContainer(object):
 
-    def __init__(self, data_base_path, write_to_log_lock, E4_stream_decoder):
+    def __init__(self, data_base_path, write_to_log_lock, E4_stream_decoder, log_flush_interval=1.0, max_queued_log_blocks=10000):
         self.base_path = data_base_path
         self.write_to_log_lock = write_to_log_lock
         self.E4_stream_decoder = E4_stream_decoder
+        # All loggers write their files from one background thread
+        self.log_writer = LogFileWriter(log_flush_interval, max_queued_log_blocks)
+        self.log_writer.start()
         self.in_session = False
         self.loggers = {}
+        self.bioharness_device_ids = []
+        # Loggers are only set up for the enabled sensors
+        self.E4_client_ids = ["L", "R"]
+        self.intraface_enabled = True
+        # "csv" or "binary", can be changed for every session
+        self.log_format = "csv"
+        # Options of the RowFormatter of csv logs, e.g. {"float_precision": 6, "bool_as_int": True}
+        self.row_format_options = {}
+        # Compression and rotation of csv logs, e.g. {"compression": "gzip", "max_file_seconds": 600}
+        self.log_file_options = {}
+        # Seconds of rows every stream keeps while logging is locked, and the memory they may take per stream
+        self.pre_roll_seconds = 0.0
+        self.pre_roll_max_bytes = 1 << 20
+    
+    def set_bioharness_device_ids(self, device_ids):
+        self.bioharness_device_ids = device_ids
+    
+    def set_enabled_sensors(self, E4_client_ids, intraface_enabled):
+        self.E4_client_ids = E4_client_ids
+        self.intraface_enabled = intraface_enabled
         
     def set_setter_logger_pairs(self, setter_logger_pairs):
         self.setter_logger_pairs = setter_logger_pairs
@@ -50,54 +77,161 @@ class LoggersContainer(object):
         for setter, logger in self.setter_logger_pairs:
             setter(self.loggers[logger])
             
-    def new_logging_session(self, output_file_prefix):
+    def create_logger(self, output_file_prefix, file_prefix, columns_list, write_to_log_lock, session_time):
+        """The log file is only opened when the stream produces its first row, with
+        the time of its session in the names of its directory and file"""
+        logger_class = LOGGER_CLASSES[self.log_format]
+        # Binary logs are neither compressed nor rotated
+        log_file_options = self.log_file_options if self.log_format == "csv" else {}
+        create_logger = partial(logger_class, os.path.join(self.base_path, output_file_prefix), file_prefix,
+                                columns_list, write_to_log_lock, self.log_writer,
+                                RowFormatter(columns_list, **self.row_format_options), session_time=session_time,
+                                **log_file_options)
+        pre_roll = None
+        if self.pre_roll_seconds:
+            pre_roll = PreRollBuffer(columns_list, self.pre_roll_seconds, self.pre_roll_max_bytes)
+        return LazyDataLogger(create_logger, write_to_log_lock, pre_roll)
+            
+    def check_log_format(self, log_format):
+        if log_format is not None and log_format not in LOGGER_CLASSES:
+            raise ValueError("Unknown log format %s, the formats are %s" % (log_format, ", ".join(sorted(LOGGER_CLASSES))))
+    
+    def new_logging_session(self, output_file_prefix, log_format=None):
+        self.check_log_format(log_format)
+        if log_format is not None:
+            self.log_format = log_format
+        
+        session_loggers = self.create_session_loggers(output_file_prefix)
+        self.take_pre_rolls(session_loggers)
+        
         if self.in_session:
             self.close_logging_session()
-            
-        self.loggers["E4_loggers_L"] = self.create_loggers_for_E4_client(output_file_prefix, "L", self.E4_stream_decoder, self.write_to_log_lock)
-        self.loggers["E4_loggers_R"] = self.create_loggers_for_E4_client(output_file_prefix, "R", self.E4_stream_decoder, self.write_to_log_lock)
-        self.loggers["bioharness_loggers"] = self.create_loggers_for_bioharness(output_file_prefix, self.write_to_log_lock)
-        self.loggers["intraface_logger"] = self.create_logger_for_intraface(output_file_prefix, self.write_to_log_lock)
+        self.loggers = session_loggers
+        self.update_loggers_for_portocols()
+        self.in_session = True
+    
+    def rotate_logging_session(self, output_file_prefix, log_format=None):
+        """Switch to a new session without stopping the logging. The log files of
+        the streams that are in use are opened in a thread of the reactor, the
+        samples keep going to the current loggers until the new ones are swapped
+        in, and the current loggers are closed by the LogFileWriter. Returns a
+        Deferred that fires once the new session is in place, or fails with the
+        error that kept its log files from opening or with a ValueError for an
+        unknown log format."""
+        try:
+            self.check_log_format(log_format)
+        except ValueError:
+            return defer.fail()
+        
+        previous_log_format = self.log_format
+        if log_format is not None:
+            self.log_format = log_format
+        
+        session_loggers = self.create_session_loggers(output_file_prefix)
+        streams_in_use = set(logger_key for logger_key, logger in self.iterate_loggers(self.loggers)
+                             if logger.logger is not None or (logger.pre_roll is not None and logger.pre_roll.row_count))
         
+        rotation = threads.deferToThread(self.open_loggers, session_loggers, streams_in_use)
+        rotation.addCallbacks(self.swap_session_loggers, self.discard_session_loggers,
+                              errbackArgs=(session_loggers, previous_log_format))
+        return rotation
+    
+    def open_loggers(self, loggers, logger_keys):
+        for logger_key, logger in self.iterate_loggers(loggers):
+            if logger_key in logger_keys:
+                logger.get_logger()
+        return loggers
+    
+    def swap_session_loggers(self, session_loggers):
+        self.take_pre_rolls(session_loggers)
+        previous_loggers = self.loggers
+        self.loggers = session_loggers
         self.update_loggers_for_portocols()
+        
+        if self.in_session:
+            # Their queued lines are written before the files are closed
+            self.close_loggers(previous_loggers, wait=False)
         self.in_session = True
+    
+    def discard_session_loggers(self, failure, session_loggers, previous_log_format):
+        """The current session stays in place when the log files of the new one could not be opened"""
+        logging.error("LoggersContainer - Rotating the logging session failed, keeping the current session: %s" % failure.getErrorMessage())
+        self.log_format = previous_log_format
+        self.close_loggers(session_loggers, wait=False)
+        return failure
+    
+    def take_pre_rolls(self, session_loggers):
+        """Move the rows kept while logging is locked into the loggers of the new session"""
+        previous_logger_of_key = dict(self.iterate_loggers(self.loggers))
+        for logger_key, logger in self.iterate_loggers(session_loggers):
+            if logger_key in previous_logger_of_key:
+                logger.take_pre_roll(previous_logger_of_key[logger_key])
+    
+    def create_session_loggers(self, output_file_prefix):
+        # All files of the session go into one <base path>_<session time> directory
+        session_time = datetime.datetime.now()
+        
+        loggers = {}
+        for client_id in ["L", "R"]:
+            E4_loggers = {}
+            if client_id in self.E4_client_ids:
+                E4_loggers = self.create_loggers_for_E4_client(output_file_prefix, client_id, self.E4_stream_decoder, self.write_to_log_lock,
+                                                               session_time)
+            loggers["E4_loggers_%s" % client_id] = E4_loggers
+        loggers["bioharness_loggers"] = dict((device_id, self.create_loggers_for_bioharness(output_file_prefix, self.write_to_log_lock, device_id,
+                                                                                            session_time))
+                                             for device_id in self.bioharness_device_ids)
+        loggers["intraface_logger"] = None
+        if self.intraface_enabled:
+            loggers["intraface_logger"] = self.create_logger_for_intraface(output_file_prefix, self.write_to_log_lock, session_time)
+        return loggers
+    
+    def iterate_loggers(self, loggers, logger_key=()):
+        """(key path, logger) of the loggers in the nested logger dicts"""
+        for name, logger in loggers.items():
+            if isinstance(logger, dict):
+                for nested_logger in self.iterate_loggers(logger, logger_key + (name,)):
+                    yield nested_logger
+            elif logger is not None:
+                yield logger_key + (name,), logger
         
     def close_logging_session(self):
-        self.loggers["intraface_logger"].close_log_file()
-        self.close_loggers(self.loggers["bioharness_loggers"])
-        self.close_loggers(self.loggers["E4_loggers_R"])
-        self.close_loggers(self.loggers["E4_loggers_L"])
+        self.close_loggers(self.loggers)
+        self.log_writer.drain()
         self.in_session = False
+    
+    def shutdown(self):
+        """Close the session and wait until the LogFileWriter wrote everything and stopped"""
+        if self.in_session:
+            self.close_logging_session()
+        self.log_writer.stop()
 
-    def create_loggers_for_E4_client(self, output_file_prefix, client_id, stream_decoder, write_to_log_lock):
+    def create_loggers_for_E4_client(self, output_file_prefix, client_id, stream_decoder, write_to_log_lock, session_time):
         E4_loggers = {}
     
         for stream_type in self.E4_stream_decoder.possible_streams.keys():
             file_prefix = "%s_E4_%s_%s" % (output_file_prefix, client_id, stream_type)
             stream_columns =  self.E4_stream_decoder.possible_streams[stream_type].values
-            E4_loggers[stream_type] = DataLogger(os.path.join(self.base_path, output_file_prefix), file_prefix, 
-                                                 stream_columns, write_to_log_lock)
+            E4_loggers[stream_type] = self.create_logger(output_file_prefix, file_prefix, stream_columns, write_to_log_lock, session_time)
         return E4_loggers
 
-    def create_loggers_for_bioharness(self, output_file_prefix, write_to_log_lock):
+    def create_loggers_for_bioharness(self, output_file_prefix, write_to_log_lock, device_id, session_time):
         bioharness_loggers = {}
         for stream_type in BioharnessProtocol.columns_of_streams.keys():
-            file_prefix = "%s_BIO_%s" % (output_file_prefix, stream_type)
+            file_prefix = "%s_BIO_%s_%s" % (output_file_prefix, device_id, stream_type)
             stream_columns = BioharnessProtocol.columns_of_streams[stream_type]
-            bioharness_loggers[stream_type] = DataLogger(os.path.join(self.base_path, output_file_prefix), file_prefix, 
-                                                         stream_columns, write_to_log_lock)
+            bioharness_loggers[stream_type] = self.create_logger(output_file_prefix, file_prefix, stream_columns, write_to_log_lock, session_time)
         return bioharness_loggers
 
-    def create_logger_for_intraface(self, output_file_prefix, write_to_log_lock):
+    def create_logger_for_intraface(self, output_file_prefix, write_to_log_lock, session_time):
         file_prefix = "%s_INTRA" % (output_file_prefix)
         intraface_columns = InrafaceSample._fields
-        intraface_logger = DataLogger(os.path.join(self.base_path, output_file_prefix), file_prefix,
-                                           intraface_columns, write_to_log_lock) 
+        intraface_logger = self.create_logger(output_file_prefix, file_prefix, intraface_columns, write_to_log_lock, session_time)
         return intraface_logger
 
-    def close_loggers(self, loggers):
-        for logger in loggers.values():
-            logger.close_log_file()
+    def close_loggers(self, loggers, wait=True):
+        for logger_key, logger in self.iterate_loggers(loggers):  #@UnusedVariable
+            logger.close_log_file(wait)
  
 
 
@@ -127,12 +261,12 @@ class SensorProxyFactory(ReconnectingClientFactory):
 def main(command_args, start_logging = True):
     print("Started Sensor Collection Server")
     
-    # Edit here Bioharness Bluetooth port information 
+    # Edit here Bioharness Bluetooth port information, one entry per device ID
     # pair device with you computer, code 1234
     # ls /dev/cu.* find out with port it is connected to
-    #BIOHARNESS_COM_PORT = "/dev/cu.BHBHT502508A-iSerialPor"
-    #BIOHARNESS_COM_PORT = "/dev/cu.BHBHT011334-iSerialPort1"
-    BIOHARNESS_COM_PORT = "/dev/cu.BHBHT017270-iSerialPort1"
+    #BIOHARNESS_COM_PORTS = {"BHT502508": "/dev/cu.BHBHT502508A-iSerialPor",
+    #                        "BHT011334": "/dev/cu.BHBHT011334-iSerialPort1"}
+    BIOHARNESS_COM_PORTS = {"BHT017270": "/dev/cu.BHBHT017270-iSerialPort1"}
     
     # Edit here E4 Server information 
     E4_SERVER_IP = "18.85.59.169" 
@@ -147,6 +281,24 @@ def main(command_args, start_logging = True):
     
     # Edit here the pather where the collected data is store
     DATA_BASE_PATH = "./CollectedData/StudyGershon"
+    
+    # Edit here the format of the log files, "csv" or "binary"
+    LOG_FORMAT = "csv"
+    
+    # Edit here how often the log files are flushed to disk, and how many blocks of lines may wait for the disk
+    LOG_FLUSH_INTERVAL = 1.0
+    MAX_QUEUED_LOG_BLOCKS = 10000
+    
+    # Edit here the compression of csv log files, None, "gzip" or "zstd" (needs the zstandard package),
+    # and after how many uncompressed bytes or seconds a log file is continued in a new file (None for never)
+    LOG_COMPRESSION = None
+    LOG_MAX_FILE_BYTES = None
+    LOG_MAX_FILE_SECONDS = None
+    
+    # Edit here how many seconds of samples are kept while logging is paused, and written once it is resumed,
+    # and how much memory they may take per stream
+    PRE_ROLL_SECONDS = 10.0
+    PRE_ROLL_MAX_BYTES = 1 << 20
 
     # Edit here the port for signal processing server
     PROCESSING_SERVER_IP = "127.0.0.1"
@@ -156,6 +308,8 @@ def main(command_args, start_logging = True):
     use_E4_L = False
     use_E4_R = False
     use_Bioharness = True
+    use_Bioharness_acceleration = False
+    record_Bioharness_raw_data = False
     use_Intraface = False
     use_Intraface_only_record = False
     use_Muse = False
@@ -178,9 +332,18 @@ def main(command_args, start_logging = True):
     E4_stream_decoder = StreamMessagesDecoder()
 
     # Setting up data loggers (Note that these are not associated with a client yet)
-    loggers_container = LoggersContainer(DATA_BASE_PATH, write_to_log_lock, E4_stream_decoder)
+    loggers_container = LoggersContainer(DATA_BASE_PATH, write_to_log_lock, E4_stream_decoder,
+                                         LOG_FLUSH_INTERVAL, MAX_QUEUED_LOG_BLOCKS)
+    loggers_container.log_file_options = {"compression": LOG_COMPRESSION,
+                                          "max_file_bytes": LOG_MAX_FILE_BYTES,
+                                          "max_file_seconds": LOG_MAX_FILE_SECONDS}
+    loggers_container.pre_roll_seconds = PRE_ROLL_SECONDS
+    loggers_container.pre_roll_max_bytes = PRE_ROLL_MAX_BYTES
     loggers_container.set_setter_logger_pairs([])
-    loggers_container.new_logging_session(command_args.output_file_prefix)
+    loggers_container.set_bioharness_device_ids(sorted(BIOHARNESS_COM_PORTS.keys()) if use_Bioharness else [])
+    loggers_container.set_enabled_sensors([client_id for client_id, use_E4 in [("L", use_E4_L), ("R", use_E4_R)] if use_E4],
+                                          use_Intraface)
+    loggers_container.new_logging_session(command_args.output_file_prefix, LOG_FORMAT)
     
     # Initializing one E4 for the Right Hand 
     client_factory_R = E4ClientFactory()
@@ -194,11 +357,14 @@ def main(command_args, start_logging = True):
     client_factory_L.set_stream_decoder(E4_stream_decoder)
     client_factory_L.set_data_loggers(loggers_container.loggers["E4_loggers_L"])     
     
-    # Initializing the Bioharness
-    bioharness_protocol = BioharnessProtocol(real_time_processing_proxy_factory, BIOHARNESS_COM_PORT, reactor)
-    bioharness_protocol.set_data_loggers(loggers_container.loggers["bioharness_loggers"])
-    bioharness_protocol.set_event_callbacks() # Note: that would be the default callback, writing the sample to the appropriate logger
-    bioharness_protocol.set_waveform_callbacks() # Note: that would be the default callback, writing the sample to the appropriate logger
+    # Initializing the Bioharness devices, each with the default callbacks writing the samples to its own loggers
+    bioharness_device_manager = BioharnessDeviceManager(real_time_processing_proxy_factory, reactor)
+    for device_id in loggers_container.bioharness_device_ids:
+        bioharness_device_manager.add_device(device_id, BIOHARNESS_COM_PORTS[device_id], use_Bioharness_acceleration)
+    bioharness_device_manager.set_data_loggers(loggers_container.loggers["bioharness_loggers"])
+    if record_Bioharness_raw_data:
+        # The recordings can be replayed with BioharnessReplayTransport
+        bioharness_device_manager.start_raw_data_recording(os.path.join(DATA_BASE_PATH, "%s_BIO_raw" % command_args.output_file_prefix))
     
     # Initializing the Intraface
     intraface_factory = IntraFaceClientFactory(real_time_processing_proxy_factory)
@@ -222,10 +388,8 @@ def main(command_args, start_logging = True):
         E4_client_R = reactor.connectTCP(E4_SERVER_IP, E4_SERVER_PORT , client_factory_R)
 
     if use_Bioharness:   
-        # Connecting to the Bioharness
-        #ser = SerialPort(bioharness_protocol, BIOHARNESS_COM_PORT, reactor, baudrate=115200)
-        #bioharness_protocol.set_serial(ser)
-        bioharness_protocol.reconnect()
+        # Connecting to the Bioharness devices
+        bioharness_device_manager.connect_all()
         
     if use_Intraface:   
         intraface_factory.run_server()
@@ -242,11 +406,15 @@ def main(command_args, start_logging = True):
     # Initializing the LoggingWebsocketControl (Controllign logging from the a Webserver for computerized tests)
     loggers_container.set_setter_logger_pairs([(client_factory_R.update_data_loggers,"E4_loggers_R"),
                                                (client_factory_L.update_data_loggers,"E4_loggers_L"),
-                                               (bioharness_protocol.set_data_loggers,"bioharness_loggers"),
+                                               (bioharness_device_manager.set_data_loggers,"bioharness_loggers"),
                                                (intraface_factory.update_data_logger,"intraface_logger")])
     factory = LoggingWebsocketControlFactory(u"ws://127.0.0.1:%s" % LOGGING_WEB_CONTROL_PORT)
     factory.logger_container = loggers_container
     reactor.listenTCP(LOGGING_WEB_CONTROL_PORT, factory)
+    
+    # The queued log lines are written and the log files closed before the process exits
+    reactor.addSystemEventTrigger("before", "shutdown", bioharness_device_manager.stop_raw_data_recording)
+    reactor.addSystemEventTrigger("before", "shutdown", loggers_container.shutdown)
 
 
     try:
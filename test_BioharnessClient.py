@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+
+import zephyr
+from BioharnessClient import BioharnessProtocol, BioharnessReplayTransport, BioharnessDeviceManager
+from IngestBenchmark import create_session_frames, split_into_chunks
+from zephyr.protocol import TimedDataRecorder, create_message_frame
+
+
+class SummaryPacketTransmitIntervalTest(unittest.TestCase):
+    def setUp(self):
+        self.protocol = BioharnessProtocol(None, "/dev/null", None)
+        self.transport = StringTransport()
+        self.protocol.transport = self.transport
+    
+    def test_interval_payload(self):
+        self.protocol.set_summary_packet_transmit_interval(300)
+        self.assertEqual(self.transport.value(), create_message_frame(0xBD, [300 & 0xFF, 300 >> 8]))
+    
+    def test_invalid_intervals(self):
+        for seconds in [0, -1, 0x10000, 1.5, "1", None, True]:
+            self.assertRaises(ValueError, self.protocol.set_summary_packet_transmit_interval, seconds)
+        
+        self.assertEqual(self.transport.value(), "")
+
+
+class BioharnessReplayTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.system_time = zephyr.time
+        self.directory = tempfile.mkdtemp()
+        self.log_file_basepath = os.path.join(self.directory, "bioharness")
+        
+        # 20 seconds of frames, recorded in chunks arriving every 0.1 seconds
+        frames = create_session_frames(20.0, corrupt_fraction=0.0, lost_fraction=0.0)
+        self.frame_count = len(frames)
+        self.chunks = split_into_chunks("".join(frames), 256)
+        
+        recorder = TimedDataRecorder(self.log_file_basepath)
+        for chunk_i, chunk in enumerate(self.chunks):
+            zephyr.time = lambda: 1465948997.0 + chunk_i * 0.1
+            recorder(chunk)
+        recorder.close()
+        zephyr.time = self.system_time
+        
+        self.clock = Clock()
+        self.packets = []
+        self.protocol = BioharnessProtocol(None, None, self.clock)
+        self.protocol.set_event_callbacks([self.packets.append])
+        self.protocol.set_waveform_callbacks([lambda signal_packet, starts_new_stream: self.packets.append(signal_packet)])
+    
+    def tearDown(self):
+        zephyr.time = self.system_time
+        shutil.rmtree(self.directory)
+    
+    def test_real_time_replay(self):
+        transport = BioharnessReplayTransport(self.protocol, self.clock, self.log_file_basepath)
+        finished = transport.start()
+        chunk_counts = []
+        finished.addCallback(chunk_counts.append)
+        
+        self.assertEqual(transport.chunk_i, 1)
+        self.clock.advance(1.05)
+        self.assertEqual(transport.chunk_i, 11)
+        self.assertAlmostEqual(self.protocol.time_function(), 1465948997.0 + 1.1)
+        self.assertTrue(zephyr.time is self.system_time)
+        
+        self.clock.pump([0.1] * len(self.chunks))
+        
+        self.assertEqual(chunk_counts, [len(self.chunks)])
+        self.assertEqual(len(self.packets), self.frame_count)
+        self.assertTrue(transport.written_data)
+        self.assertTrue(zephyr.time is self.system_time)
+    
+    def test_overlapping_replays(self):
+        other_protocol = BioharnessProtocol(None, None, self.clock)
+        other_protocol.set_event_callbacks([])
+        other_protocol.set_waveform_callbacks([])
+        
+        transport = BioharnessReplayTransport(self.protocol, self.clock, self.log_file_basepath)
+        transport.start()
+        self.clock.advance(2.05)
+        other_transport = BioharnessReplayTransport(other_protocol, self.clock, self.log_file_basepath)
+        other_transport.start()
+        self.clock.advance(0.5)
+        
+        # Every protocol corrects its timestamps with the time of its own recording
+        clock_difference_correction = other_protocol.signal_packet_handler_bh.clock_difference_correction
+        self.assertAlmostEqual(self.protocol.time_function(), 1465948997.0 + 2.6)
+        self.assertAlmostEqual(clock_difference_correction.time_function(), 1465948997.0 + 0.6)
+        
+        # The first replay finishes while the other one is still going
+        self.clock.pump([0.1] * (len(self.chunks) - 10))
+        self.assertFalse(transport.connected)
+        self.assertTrue(other_transport.connected)
+        self.assertTrue(zephyr.time is self.system_time)
+        
+        self.clock.pump([0.1] * 20)
+        self.assertFalse(other_transport.connected)
+        self.assertTrue(zephyr.time is self.system_time)
+        self.assertEqual(len(self.packets), self.frame_count)
+    
+    def test_replay_as_fast_as_possible(self):
+        transport = BioharnessReplayTransport(self.protocol, self.clock, self.log_file_basepath, speed=None)
+        transport.chunks_per_call = 10
+        transport.start()
+        
+        self.assertEqual(transport.chunk_i, 10)
+        self.clock.pump([0] * len(self.chunks))
+        
+        self.assertFalse(transport.connected)
+        self.assertEqual(len(self.packets), self.frame_count)
+
+
+class BioharnessDeviceManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.device_manager = BioharnessDeviceManager(None, Clock())
+        for device_id in ["B", "A"]:
+            self.device_manager.add_device(device_id, "/dev/cu.BH%s" % device_id)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_loggers_of_devices(self):
+        self.assertEqual(self.device_manager.get_device_ids(), ["A", "B"])
+        
+        loggers_of_device = {"A": {"ecg": "logger A"}, "B": {"ecg": "logger B"}}
+        self.device_manager.set_data_loggers(loggers_of_device)
+        
+        for device_id, protocol in self.device_manager.protocol_of_device.items():
+            self.assertEqual(protocol.device_id, device_id)
+            self.assertTrue(protocol.logger_of_stream is loggers_of_device[device_id])
+    
+    def test_raw_data_recording(self):
+        log_file_basepath = os.path.join(self.directory, "raw")
+        self.device_manager.start_raw_data_recording(log_file_basepath)
+        
+        for protocol in self.device_manager.protocol_of_device.values():
+            protocol.raw_data_recorder(protocol.device_id * 10)
+        self.device_manager.stop_raw_data_recording()
+        
+        for device_id in ["A", "B"]:
+            with open("%s_%s.dat" % (log_file_basepath, device_id), "rb") as data_file:
+                self.assertEqual(data_file.read(), device_id * 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,471 @@
+import os
+import json
+import zlib
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from twisted.internet.task import Clock
+
+import Logger
+from Logger import LogFileWriter, WriteToLogLock, DataLogger, BinaryDataLogger, BinaryLog, \
+    RowFormatter, LOG_INDEX_EXTENSION, load_log_index, read_csv_log_time_range, DecompressingLogReader, \
+    SessionLogReader, PreRollBuffer, LazyDataLogger
+
+
+class LogFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lock = WriteToLogLock(Clock(), 0)
+        self.lock.unlock_writing_to_log_file()
+        self.log_writer = LogFileWriter(flush_interval=0.01)
+        self.log_writer.start()
+    
+    def tearDown(self):
+        self.log_writer.stop()
+        shutil.rmtree(self.directory)
+
+
+class LogFileWriterTest(LogFileTestCase):
+    def test_lines_written_in_order(self):
+        path = os.path.join(self.directory, "lines")
+        log_file = open(path, "wb")
+        
+        for block_i in range(100):
+            self.log_writer.write_lines(log_file, ["%d,%d\r\n" % (block_i, line_i) for line_i in range(10)])
+        self.log_writer.close_file(log_file)
+        
+        self.assertTrue(log_file.closed)
+        with open(path, "rb") as log_file:
+            self.assertEqual(log_file.read(), "".join("%d,%d\r\n" % (block_i, line_i) for block_i in range(100) for line_i in range(10)))
+    
+    def test_close_without_waiting(self):
+        path = os.path.join(self.directory, "lines")
+        log_file = open(path, "wb")
+        
+        self.log_writer.write_lines(log_file, ["a\r\n", "b\r\n"])
+        self.log_writer.close_file(log_file, wait=False)
+        self.log_writer.drain()
+        
+        self.assertTrue(log_file.closed)
+        with open(path, "rb") as log_file:
+            self.assertEqual(log_file.read(), "a\r\nb\r\n")
+    
+    def test_error_does_not_stop_writer(self):
+        path = os.path.join(self.directory, "lines")
+        log_file = open(path, "wb")
+        
+        self.log_writer.write_lines(log_file, ["a\r\n", None])
+        self.log_writer.write_lines(log_file, ["b\r\n"])
+        self.log_writer.close_file(log_file)
+        
+        self.assertTrue(self.log_writer.is_alive())
+        with open(path, "rb") as log_file:
+            self.assertEqual(log_file.read(), "b\r\n")
+    
+    def test_waiting_returns_without_writer_thread(self):
+        log_file = open(os.path.join(self.directory, "lines"), "wb")
+        self.log_writer.stop()
+        
+        self.log_writer.drain()
+        self.log_writer.close_file(log_file)
+        
+        # The thread ends while it is being waited for
+        log_writer = LogFileWriter()
+        log_writer.alive_check_interval = 0.01
+        log_writer.start()
+        log_writer.queue.put(("stop", None, None))
+        log_writer.drain()
+        self.assertFalse(log_writer.is_alive())
+        log_file.close()
+    
+    def test_stop_writes_queued_lines(self):
+        path = os.path.join(self.directory, "lines")
+        log_file = open(path, "wb")
+        
+        self.log_writer.write_lines(log_file, ["a\r\n"] * 1000)
+        self.log_writer.stop()
+        self.log_writer.stop()
+        
+        self.assertFalse(self.log_writer.is_alive())
+        with open(path, "rb") as log_file:
+            self.assertEqual(log_file.read(), "a\r\n" * 1000)
+
+
+class RowFormatterTest(unittest.TestCase):
+    def test_compiled_row_format(self):
+        row_formatter = RowFormatter(["timestamp", "value", "count", "label", "flag"], float_precision=6, bool_as_int=True)
+        
+        self.assertEqual(row_formatter.format_row((1465948997.123456, 0.1 + 0.2, 3, "ecg", True)),
+                         "1465948997.123,0.3,3,ecg,1\r\n")
+        self.assertEqual(row_formatter.row_format, "%.3f,%.6g,%s,%s,%d\r\n")
+    
+    def test_rows_that_do_not_fit_the_format(self):
+        row_formatter = RowFormatter(["timestamp", "value"])
+        rows = [(1000.0, 1.5), (1001.0, "text"), (1002.0, None), (1003.0, 2.5)]
+        
+        self.assertEqual(row_formatter.format_rows(iter(rows)),
+                         ["1000.000,1.5\r\n", "1001.0,text\r\n", "1002.0,None\r\n", "1003.000,2.5\r\n"])
+    
+    def test_csv_log_rows(self):
+        directory = tempfile.mkdtemp()
+        try:
+            lock = WriteToLogLock(Clock(), 0)
+            lock.unlock_writing_to_log_file()
+            logger = DataLogger(os.path.join(directory, "session"), "rr", ["type", "timestamp", "sample"], lock)
+            logger.write_columns_to_log_file(["rr", numpy.array([1000.0, 1000.5]), numpy.array([812, 790])])
+            logger.write_list_to_log_file(["rr", 1001.25, 801])
+            logger.close_log_file()
+            
+            with open(logger.path, "rb") as log_file:
+                self.assertEqual(log_file.read(), "type,timestamp,sample\r\nrr,1000.000,812\r\nrr,1000.500,790\r\nrr,1001.250,801\r\n")
+        finally:
+            shutil.rmtree(directory)
+
+
+class BinaryDataLoggerTest(LogFileTestCase):
+    def create_logger(self):
+        return BinaryDataLogger(os.path.join(self.directory, "session"), "ecg", ["timestamp", "sample", "label"],
+                                self.lock, self.log_writer)
+    
+    def test_round_trip(self):
+        logger = self.create_logger()
+        logger.chunk_rows = 64
+        
+        timestamps = 1000.0 + numpy.arange(1000) * 0.004
+        for block_start in range(0, 1000, 63):
+            block_end = min(block_start + 63, 1000)
+            logger.write_columns_to_log_file([timestamps[block_start:block_end],
+                                              numpy.arange(block_start, block_end, dtype=numpy.int32), "ecg"])
+        logger.write_tuple_to_log_file((1004.0, 1000, "last"))
+        logger.close_log_file()
+        
+        binary_log = BinaryLog(logger.path)
+        self.assertEqual(len(binary_log), 1001)
+        self.assertEqual(binary_log.column_dtypes, [numpy.dtype("<f8"), numpy.dtype("<f8"), numpy.dtype("S32")])
+        self.assertTrue(numpy.array_equal(binary_log["sample"], numpy.arange(1001)))
+        self.assertEqual(binary_log["label"][-2:].tolist(), ["ecg", "last"])
+        
+        time_range = binary_log.get_time_range(1001.0, 1002.0)
+        self.assertTrue(numpy.array_equal(time_range["sample"], numpy.arange(250, 500)))
+    
+    def test_write_line(self):
+        logger = self.create_logger()
+        logger.write_line("1000.5,3,first\r\n")
+        logger.write_list_to_log_file([1001.5, 4, "second"])
+        logger.close_log_file()
+        
+        binary_log = BinaryLog(logger.path)
+        self.assertEqual(binary_log["timestamp"].tolist(), [1000.5, 1001.5])
+        self.assertEqual(binary_log["sample"].tolist(), [3, 4])
+        self.assertEqual(binary_log["label"].tolist(), ["first", "second"])
+    
+    def test_integer_column_takes_floats(self):
+        logger = self.create_logger()
+        logger.write_line("1000,1,a")
+        logger.write_line("1000.5,1.5,b")
+        logger.write_columns_to_log_file([numpy.array([1001, 1002]), numpy.array([2.5, 3.5]), "c"])
+        logger.close_log_file()
+        
+        binary_log = BinaryLog(logger.path)
+        self.assertEqual(binary_log["timestamp"].tolist(), [1000.0, 1000.5, 1001.0, 1002.0])
+        self.assertEqual(binary_log["sample"].tolist(), [1.0, 1.5, 2.5, 3.5])
+    
+    def test_values_of_other_types_are_cast(self):
+        logger = self.create_logger()
+        logger.write_list_to_log_file([1000.0, 1, "a"])
+        logger.write_list_to_log_file([1001.0, "none", "x" * 40])
+        logger.write_columns_to_log_file([[1002.0, 1003.0], ["2", "?"], 4])
+        logger.close_log_file()
+        
+        binary_log = BinaryLog(logger.path)
+        self.assertEqual(len(binary_log), 4)
+        self.assertEqual(binary_log["sample"][[0, 2]].tolist(), [1.0, 2.0])
+        self.assertTrue(numpy.isnan(binary_log["sample"][[1, 3]]).all())
+        self.assertEqual(binary_log["label"].tolist(), ["a", "x" * 32, "4", "4"])
+        self.assertEqual(logger.cast_column_indices, set([1, 2]))
+    
+    def test_empty_log(self):
+        logger = self.create_logger()
+        logger.close_log_file()
+        
+        binary_log = BinaryLog(logger.path)
+        self.assertEqual(len(binary_log), 0)
+        self.assertEqual(len(binary_log.get_time_range(0, 1e10)["timestamp"]), 0)
+
+
+class CsvLogIndexTest(LogFileTestCase):
+    def write_bvp_log(self, row_count):
+        # E4 streams name their timestamp column in capitals and log the values as strings
+        logger = DataLogger(os.path.join(self.directory, "session"), "bvp", ["TIMESTAMP", "BVP"], self.lock, self.log_writer)
+        logger.index_interval = 100
+        
+        for row_i in range(row_count):
+            logger.write_tuple_to_log_file(("%.3f" % (1000 + row_i * 0.25), "%d" % row_i))
+        logger.close_log_file()
+        return logger.path
+    
+    def test_index_entries(self):
+        log_path = self.write_bvp_log(1000)
+        index_entries = load_log_index(log_path)
+        
+        self.assertEqual(index_entries["row"].tolist(), range(0, 1000, 100))
+        self.assertEqual(index_entries["timestamp"].tolist(), [1000 + row_i * 0.25 for row_i in range(0, 1000, 100)])
+        
+        with open(log_path, "rb") as log_file:
+            log_file.seek(int(index_entries["offset"][3]))
+            self.assertEqual(log_file.readline(), "1075.000,300\r\n")
+    
+    def test_read_time_range(self):
+        log_path = self.write_bvp_log(1000)
+        
+        columns = read_csv_log_time_range(log_path, 1100.0, 1110.0)
+        self.assertEqual(columns["BVP"], ["%d" % row_i for row_i in range(400, 440)])
+        self.assertEqual(columns["TIMESTAMP"][0], "1100.000")
+        
+        self.assertEqual(read_csv_log_time_range(log_path, 2000.0, 3000.0)["BVP"], [])
+    
+    def test_read_time_range_without_index(self):
+        log_path = self.write_bvp_log(1000)
+        os.remove(log_path + LOG_INDEX_EXTENSION)
+        
+        self.assertEqual(read_csv_log_time_range(log_path, 1100.0, 1110.0)["BVP"], ["%d" % row_i for row_i in range(400, 440)])
+
+
+class CompressedLogTest(LogFileTestCase):
+    def write_log(self, compression, row_count=5000, **log_file_options):
+        logger = DataLogger(os.path.join(self.directory, "session"), "ecg", ["timestamp", "sample"], self.lock,
+                            self.log_writer, compression=compression, **log_file_options)
+        
+        for block_start in range(0, row_count, 50):
+            logger.write_columns_to_log_file([[1000 + row_i * 0.004 for row_i in range(block_start, block_start + 50)],
+                                              range(block_start, block_start + 50)])
+        return logger
+    
+    def read_manifest(self, logger):
+        with open(logger.file_base_path + ".manifest", "rb") as manifest_file:
+            return [json.loads(line) for line in manifest_file]
+    
+    def check_round_trip(self, compression, extension):
+        logger = self.write_log(compression)
+        logger.close_log_file()
+        
+        self.assertTrue(logger.path.endswith(extension))
+        columns = SessionLogReader(os.path.join(self.directory, "session")).read_time_range("ecg", 1010.0, 1012.0)
+        self.assertEqual(columns["sample"], ["%d" % row_i for row_i in range(2500, 3000)])
+        
+        manifest = self.read_manifest(logger)
+        self.assertEqual([(entry["segment"], entry["compression"], entry["rows"]) for entry in manifest], [(0, compression, 5000)])
+        self.assertEqual((manifest[0]["first_timestamp"], manifest[0]["last_timestamp"]), (1000.0, 1000 + 4999 * 0.004))
+    
+    def test_gzip_round_trip(self):
+        self.check_round_trip("gzip", ".gz")
+    
+    @unittest.skipIf(Logger.zstandard is None, "zstandard is not installed")
+    def test_zstd_round_trip(self):
+        self.check_round_trip("zstd", ".zst")
+    
+    def test_zstd_falls_back_to_gzip(self):
+        zstandard = Logger.zstandard
+        Logger.zstandard = None
+        try:
+            logger = self.write_log("zstd", 100)
+        finally:
+            Logger.zstandard = zstandard
+        logger.close_log_file()
+        
+        self.assertEqual(logger.compression, "gzip")
+        self.assertTrue(logger.path.endswith(".gz"))
+    
+    def test_read_segment_being_written(self):
+        logger = self.write_log("gzip")
+        self.log_writer.drain()
+        
+        self.assertEqual(len(read_csv_log_time_range(logger.path, 0, 2000)["sample"]), 5000)
+        logger.close_log_file()
+    
+    def test_size_rotation(self):
+        logger = self.write_log("gzip", max_file_bytes=20000)
+        logger.close_log_file()
+        
+        manifest = self.read_manifest(logger)
+        self.assertTrue(len(manifest) > 2)
+        self.assertEqual([entry["segment"] for entry in manifest], range(len(manifest)))
+        self.assertEqual(manifest[1]["path"], os.path.basename(logger.file_base_path) + "_part001.gz")
+        self.assertEqual(sum(entry["rows"] for entry in manifest), 5000)
+        for entry, next_entry in zip(manifest, manifest[1:]):
+            self.assertTrue(entry["bytes"] >= 20000)
+            self.assertAlmostEqual(next_entry["first_timestamp"], entry["last_timestamp"] + 0.004)
+        
+        columns = SessionLogReader(os.path.join(self.directory, "session")).read_time_range("ecg", 0, 2000)
+        self.assertEqual(columns["sample"], ["%d" % row_i for row_i in range(5000)])
+    
+    def test_time_rotation(self):
+        logger = DataLogger(os.path.join(self.directory, "session"), "ecg", ["timestamp", "sample"], self.lock,
+                            self.log_writer, max_file_seconds=60.0)
+        logger.write_list_to_log_file([1000.0, 1])
+        logger.segment_start_time -= 60.0
+        logger.write_list_to_log_file([1001.0, 2])
+        logger.close_log_file()
+        
+        self.assertEqual([(entry["segment"], entry["rows"]) for entry in self.read_manifest(logger)], [(0, 1), (1, 1)])
+        with open(logger.path, "rb") as log_file:
+            self.assertEqual(log_file.read(), "timestamp,sample\r\n1001.000,2\r\n")
+
+
+class DecompressingLogReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lines = ["%d,%s\r\n" % (line_i, "x" * (line_i % 17)) for line_i in range(500)]
+        
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.path = os.path.join(self.directory, "lines.gz")
+        with open(self.path, "wb") as compressed_file:
+            compressed_file.write(compressor.compress("".join(self.lines)) + compressor.flush())
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def open_reader(self):
+        reader = DecompressingLogReader(self.path, zlib.decompressobj(16 + zlib.MAX_WBITS))
+        reader.block_size = 7
+        return reader
+    
+    def test_lines(self):
+        with self.open_reader() as reader:
+            self.assertEqual(list(reader), self.lines)
+    
+    def test_seek(self):
+        offset = len("".join(self.lines[:123]))
+        
+        with self.open_reader() as reader:
+            reader.readline()
+            reader.seek(offset)
+            self.assertEqual(reader.tell(), offset)
+            self.assertEqual(reader.readline(), self.lines[123])
+            self.assertRaises(IOError, reader.seek, 0)
+
+
+class PreRollBufferTest(unittest.TestCase):
+    def setUp(self):
+        # Records of a float, an int and the arrival time take 24 bytes
+        self.pre_roll = PreRollBuffer(["timestamp", "sample"], 5.0, 24 * 10)
+    
+    def take_timestamps(self, now):
+        return self.pre_roll.take_columns(now)[0].tolist()
+    
+    def test_memory_limit(self):
+        for row_i in range(25):
+            self.pre_roll.append_row((1000.0 + row_i, row_i), 100.0)
+        
+        self.assertEqual(len(self.pre_roll.rows), 10)
+        self.assertEqual(self.take_timestamps(100.0), [1000.0 + row_i for row_i in range(15, 25)])
+        self.assertEqual(self.pre_roll.row_count, 0)
+    
+    def test_duration(self):
+        for row_i in range(8):
+            self.pre_roll.append_row((1000.0 + row_i, row_i), 100.0 + row_i)
+        
+        self.assertEqual(self.take_timestamps(107.0), [1002.0, 1003.0, 1004.0, 1005.0, 1006.0, 1007.0])
+    
+    def test_columns(self):
+        self.pre_roll.append_row((999.0, -1), 100.0)
+        self.pre_roll.append_columns([1000.0 + numpy.arange(4), numpy.arange(4)], 100.0)
+        # Only the last rows of a block that is larger than the buffer are kept
+        self.pre_roll.append_columns([1004.0 + numpy.arange(30), numpy.arange(4, 34)], 100.0)
+        
+        timestamps, samples = self.pre_roll.take_columns(100.0)
+        self.assertEqual(timestamps.tolist(), [1000.0 + row_i for row_i in range(24, 34)])
+        self.assertEqual(samples.tolist(), range(24, 34))
+    
+    def test_rows_are_kept_without_loss(self):
+        pre_roll = PreRollBuffer(["timestamp", "sample", "label"], 5.0, 1 << 10)
+        pre_roll.append_row((1000, 2, "a"), 100.0)
+        pre_roll.append_row((1000.7, 2.9, "x" * 40), 100.0)
+        pre_roll.append_columns([[1001, 1002], numpy.array([3.5, 4.5]), True], 100.0)
+        
+        timestamps, samples, labels = pre_roll.take_columns(100.0)
+        self.assertEqual(timestamps.tolist(), [1000.0, 1000.7, 1001.0, 1002.0])
+        self.assertEqual(samples.tolist(), [2.0, 2.9, 3.5, 4.5])
+        self.assertEqual(labels.tolist(), ["a", "x" * 40, True, True])
+    
+    def test_rows_that_do_not_fit_keep_buffer(self):
+        for row_i in range(10):
+            self.pre_roll.append_row((1000.0 + row_i, row_i), 100.0)
+        
+        self.pre_roll.append_row(("late", 10), 100.0)
+        self.pre_roll.append_row((1010.0,), 100.0)
+        self.pre_roll.append_columns([1010.0 + numpy.arange(3), ["a", "b", "c"]], 100.0)
+        self.pre_roll.append_columns([1010.0 + numpy.arange(3), numpy.arange(2)], 100.0)
+        self.pre_roll.append_columns([1010.0 + numpy.arange(3)], 100.0)
+        
+        self.assertEqual(self.pre_roll.row_count, 10)
+        self.assertEqual(self.take_timestamps(100.0), [1000.0 + row_i for row_i in range(10)])
+
+
+class LazyDataLoggerTest(LogFileTestCase):
+    def setUp(self):
+        LogFileTestCase.setUp(self)
+        self.created_loggers = []
+        self.lock.lock_writing_to_log_file()
+    
+    def create_logger(self):
+        logger = DataLogger(os.path.join(self.directory, "session"), "ecg", ["timestamp", "sample"], self.lock, self.log_writer)
+        self.created_loggers.append(logger)
+        return logger
+    
+    def read_rows(self, logger):
+        with open(logger.logger.path, "rb") as log_file:
+            return [line.split(",") for line in log_file.read().splitlines()[1:]]
+    
+    def test_logger_created_on_first_row(self):
+        logger = LazyDataLogger(self.create_logger, self.lock)
+        logger.write_tuple_to_log_file((1000.0, 0))
+        self.assertEqual(self.created_loggers, [])
+        
+        self.lock.unlock_writing_to_log_file()
+        logger.write_tuple_to_log_file((1001.0, 1))
+        logger.write_tuple_to_log_file((1002.0, 2))
+        logger.close_log_file()
+        logger.write_tuple_to_log_file((1003.0, 3))
+        
+        self.assertEqual(len(self.created_loggers), 1)
+        self.assertEqual([row[1] for row in self.read_rows(logger)], ["1", "2"])
+    
+    def test_pre_roll_written_ahead_of_rows(self):
+        logger = LazyDataLogger(self.create_logger, self.lock, PreRollBuffer(["timestamp", "sample"], 60.0, 1 << 10))
+        logger.write_tuple_to_log_file((1000.0, 0))
+        logger.write_list_to_log_file([1001.0, 1])
+        logger.write_columns_to_log_file([1002.0 + numpy.arange(2), numpy.arange(2, 4)])
+        self.assertEqual(self.created_loggers, [])
+        
+        self.lock.unlock_writing_to_log_file()
+        logger.write_dict_to_log_file({"timestamp": 1004.0, "sample": 4})
+        logger.close_log_file()
+        
+        self.assertEqual([row[1] for row in self.read_rows(logger)], ["0", "1", "2", "3", "4"])
+    
+    def test_pre_roll_of_integers_and_floats(self):
+        logger = LazyDataLogger(self.create_logger, self.lock, PreRollBuffer(["timestamp", "sample"], 60.0, 1 << 10))
+        logger.write_tuple_to_log_file((1000, 1))
+        logger.write_tuple_to_log_file((1000.25, 1.5))
+        self.lock.unlock_writing_to_log_file()
+        logger.write_tuple_to_log_file((1001, 2))
+        logger.close_log_file()
+        
+        self.assertEqual([row[1] for row in self.read_rows(logger)], ["1", "1.5", "2"])
+        self.assertEqual([float(row[0]) for row in self.read_rows(logger)], [1000.0, 1000.25, 1001.0])
+    
+    def test_pre_roll_written_on_close(self):
+        logger = LazyDataLogger(self.create_logger, self.lock, PreRollBuffer(["timestamp", "sample"], 60.0, 1 << 10))
+        logger.write_tuple_to_log_file((1000.0, 0))
+        self.lock.unlock_writing_to_log_file()
+        logger.close_log_file()
+        
+        self.assertEqual([row[1] for row in self.read_rows(logger)], ["0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
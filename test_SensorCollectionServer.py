@@ -0,0 +1,211 @@
+import os
+import datetime
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import defer, threads
+from twisted.internet.task import Clock
+
+from E4Commands import StreamMessagesDecoder
+from Logger import WriteToLogLock, BinaryLog, SessionLogReader, LoggingWebsocketControll
+from SensorCollectionServer import LoggersContainer
+from zephyr.message import SummaryMessage
+
+
+class LoggersContainerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lock = WriteToLogLock(Clock(), 0)
+        self.lock.unlock_writing_to_log_file()
+        
+        self.loggers_container = LoggersContainer(os.path.join(self.directory, "study"), self.lock, StreamMessagesDecoder(), 0.01)
+        self.loggers_container.set_setter_logger_pairs([])
+        self.loggers_container.set_bioharness_device_ids(["A", "B"])
+        self.loggers_container.set_enabled_sensors(["R"], False)
+    
+    def tearDown(self):
+        self.loggers_container.shutdown()
+        shutil.rmtree(self.directory)
+    
+    def get_summary_row(self, timestamp):
+        return tuple(timestamp if column == "timestamp" else 1 for column in SummaryMessage._fields)
+    
+    def read_log_lines(self, log_path):
+        with open(log_path, "rb") as log_file:
+            return log_file.read().splitlines()
+
+
+class ShutdownTest(LoggersContainerTestCase):
+    def test_shutdown_writes_queued_rows(self):
+        self.loggers_container.new_logging_session("subject_task")
+        logger = self.loggers_container.loggers["bioharness_loggers"]["A"]["summary"]
+        
+        for row_i in range(1000):
+            logger.write_tuple_to_log_file(self.get_summary_row(1000.0 + row_i))
+        self.loggers_container.shutdown()
+        
+        self.assertFalse(self.loggers_container.log_writer.is_alive())
+        self.assertEqual(len(self.read_log_lines(logger.logger.path)), 1001)
+
+
+class PreRollTest(LoggersContainerTestCase):
+    def test_pre_roll_continues_in_next_session(self):
+        self.loggers_container.pre_roll_seconds = 60.0
+        self.lock.lock_writing_to_log_file()
+        self.loggers_container.new_logging_session("subject_first")
+        first_logger = self.loggers_container.loggers["bioharness_loggers"]["A"]["summary"]
+        for row_i in range(3):
+            first_logger.write_tuple_to_log_file(self.get_summary_row(1000.0 + row_i))
+        
+        self.loggers_container.new_logging_session("subject_second")
+        self.lock.unlock_writing_to_log_file()
+        second_logger = self.loggers_container.loggers["bioharness_loggers"]["A"]["summary"]
+        second_logger.write_tuple_to_log_file(self.get_summary_row(1003.0))
+        self.loggers_container.close_logging_session()
+        
+        self.assertEqual(first_logger.logger, None)
+        timestamp_i = SummaryMessage._fields.index("timestamp")
+        log_lines = self.read_log_lines(second_logger.logger.path)
+        self.assertEqual([float(line.split(",")[timestamp_i]) for line in log_lines[1:]], [1000.0, 1001.0, 1002.0, 1003.0])
+
+
+class SteppingDatetime(datetime.datetime):
+    """datetime whose now() advances by a minute on every call"""
+    now_count = 0
+    
+    @classmethod
+    def now(cls):
+        cls.now_count += 1
+        return cls(2016, 6, 14, 10, cls.now_count)
+
+
+class LazySessionTest(LoggersContainerTestCase):
+    def setUp(self):
+        LoggersContainerTestCase.setUp(self)
+        self.system_datetime = datetime.datetime
+        datetime.datetime = SteppingDatetime
+    
+    def tearDown(self):
+        datetime.datetime = self.system_datetime
+        LoggersContainerTestCase.tearDown(self)
+    
+    def get_session_directories(self):
+        study_path = os.path.join(self.directory, "study")
+        if not os.path.isdir(study_path):
+            return []
+        return [name for name in os.listdir(study_path) if name.startswith("subject_task")]
+    
+    def test_files_are_opened_on_first_row(self):
+        self.loggers_container.new_logging_session("subject_task")
+        
+        self.assertEqual(self.loggers_container.loggers["E4_loggers_L"], {})
+        self.assertEqual(self.loggers_container.loggers["intraface_logger"], None)
+        for _, logger in self.loggers_container.iterate_loggers(self.loggers_container.loggers):
+            self.assertEqual(logger.logger, None)
+        self.assertEqual(self.get_session_directories(), [])
+    
+    def test_streams_of_session_share_directory(self):
+        self.loggers_container.new_logging_session("subject_task")
+        bioharness_loggers = self.loggers_container.loggers["bioharness_loggers"]
+        
+        # The loggers open their files at different times of the session
+        bioharness_loggers["A"]["summary"].write_tuple_to_log_file(self.get_summary_row(1000.0))
+        bioharness_loggers["B"]["summary"].write_tuple_to_log_file(self.get_summary_row(1001.0))
+        bioharness_loggers["A"]["summary"].write_tuple_to_log_file(self.get_summary_row(1002.0))
+        self.loggers_container.close_logging_session()
+        
+        self.assertEqual(len(self.get_session_directories()), 1)
+        session_reader = SessionLogReader(os.path.join(self.directory, "study", "subject_task"))
+        stream_names = session_reader.get_stream_names()
+        self.assertEqual(len(stream_names), 2)
+        
+        timestamps_of_stream = [session_reader.read_time_range(stream_name, 0.0, 2000.0)["timestamp"] for stream_name in stream_names]
+        self.assertEqual(sorted(map(len, timestamps_of_stream)), [1, 2])
+
+
+class RotationTest(LoggersContainerTestCase):
+    def setUp(self):
+        LoggersContainerTestCase.setUp(self)
+        # The log files of the new session are opened right away instead of in a thread
+        self.defer_to_thread = threads.deferToThread
+        threads.deferToThread = defer.maybeDeferred
+        
+        self.loggers_container.new_logging_session("subject_first")
+        self.first_logger = self.loggers_container.loggers["bioharness_loggers"]["A"]["summary"]
+        for row_i in range(10):
+            self.first_logger.write_tuple_to_log_file(self.get_summary_row(1000.0 + row_i))
+    
+    def tearDown(self):
+        threads.deferToThread = self.defer_to_thread
+        LoggersContainerTestCase.tearDown(self)
+    
+    def fail_to_open_loggers(self, loggers, logger_keys):
+        raise IOError("No space left on device")
+    
+    def test_rotation_keeps_rows(self):
+        rotations = []
+        self.loggers_container.rotate_logging_session("subject_second", "binary").addCallback(rotations.append)
+        self.assertEqual(len(rotations), 1)
+        
+        second_loggers = self.loggers_container.loggers["bioharness_loggers"]
+        # Only the streams that were in use are opened ahead of their rows
+        self.assertNotEqual(second_loggers["A"]["summary"].logger, None)
+        self.assertEqual(second_loggers["B"]["summary"].logger, None)
+        self.assertTrue(self.first_logger.closed)
+        
+        for row_i in range(10, 20):
+            second_loggers["A"]["summary"].write_tuple_to_log_file(self.get_summary_row(1000.0 + row_i))
+        self.loggers_container.close_logging_session()
+        
+        self.assertEqual(len(self.read_log_lines(self.first_logger.logger.path)), 11)
+        second_columns = BinaryLog(second_loggers["A"]["summary"].logger.path).get_time_range(0.0, 2000.0)
+        self.assertEqual(list(second_columns["timestamp"]), [1000.0 + row_i for row_i in range(10, 20)])
+    
+    def test_failed_rotation_keeps_session(self):
+        self.loggers_container.open_loggers = self.fail_to_open_loggers
+        failures = []
+        self.loggers_container.rotate_logging_session("subject_second", "binary").addErrback(failures.append)
+        
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(IOError))
+        self.assertEqual(self.loggers_container.log_format, "csv")
+        self.assertTrue(self.loggers_container.loggers["bioharness_loggers"]["A"]["summary"] is self.first_logger)
+        self.assertFalse(self.first_logger.closed)
+    
+    def test_unknown_log_format(self):
+        failures = []
+        self.loggers_container.rotate_logging_session("subject_second", "xml").addErrback(failures.append)
+        
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(ValueError))
+        self.assertEqual(self.loggers_container.log_format, "csv")
+        self.assertTrue(self.loggers_container.loggers["bioharness_loggers"]["A"]["summary"] is self.first_logger)
+        self.assertRaises(ValueError, self.loggers_container.new_logging_session, "subject_second", "xml")
+        self.assertEqual(self.loggers_container.log_format, "csv")
+        
+        # The commands after the one with the unknown format still start logging
+        self.lock.lock_writing_to_log_file()
+        control = LoggingWebsocketControll()
+        control.set_logger_container(self.loggers_container)
+        control.handle_command({"type": "LOG", "subject": "subject", "name": "second", "format": "xml"})
+        self.assertTrue(self.lock.is_write_locked)
+        control.handle_command({"type": "LOG", "subject": "subject", "name": "second"})
+        self.assertFalse(self.lock.is_write_locked)
+    
+    def test_failed_log_command_keeps_lock(self):
+        self.loggers_container.open_loggers = self.fail_to_open_loggers
+        self.lock.lock_writing_to_log_file()
+        control = LoggingWebsocketControll()
+        control.set_logger_container(self.loggers_container)
+        
+        control.handle_command({"type": "LOG", "subject": "subject", "name": "second"})
+        self.assertTrue(self.lock.is_write_locked)
+        
+        del self.loggers_container.open_loggers
+        control.handle_command({"type": "LOG", "subject": "subject", "name": "second"})
+        self.assertFalse(self.lock.is_write_locked)
+
+
+if __name__ == "__main__":
+    unittest.main()
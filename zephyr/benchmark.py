@@ -0,0 +1,77 @@
+"""Micro benchmarks for the Bioharness decoding path.
+
+Run with: python -m zephyr.benchmark
+"""
+import random
+import timeit
+
+import zephyr.util
+import zephyr.message
+
+
+def create_random_signal_bytes(byte_count, seed=0):
+    generator = random.Random(seed)
+    return [generator.randint(0, 255) for byte_i in range(byte_count)]  #@UnusedVariable
+
+
+def measure_rate(function, items_per_call, minimum_duration=0.5):
+    call_count = 1
+    
+    while True:
+        duration = timeit.timeit(function, number=call_count)
+        if duration >= minimum_duration:
+            return items_per_call * call_count / duration
+        
+        call_count *= 2
+
+
+def benchmark_unpack_bit_packed_values():
+    # ECG and breathing packets carry 63 and 18 10-bit samples, RR packets 18 16-bit samples
+    cases = [("ecg", 79, 10, "uint"),
+             ("breathing", 23, 10, "uint"),
+             ("rr", 36, 16, "intbe")]
+    
+    implementations = [("bitstring", zephyr.util.bitstring_unpack_bit_packed_values),
+                       ("numpy", zephyr.util.unpack_bit_packed_values)]
+    
+    results = []
+    
+    for case_name, byte_count, value_nbits, dtype in cases:
+        signal_bytes = create_random_signal_bytes(byte_count)
+        sample_count = byte_count * 8 / value_nbits
+        
+        for implementation_name, unpack in implementations:
+            samples_per_second = measure_rate(lambda: unpack(signal_bytes, value_nbits, dtype), sample_count)
+            results.append((case_name, implementation_name, samples_per_second))
+    
+    return results
+
+
+def create_summary_payload(seed=0):
+    timestamp_bytes = [0xE0, 0x07, 6, 15, 0x10, 0x20, 0x30, 0x00]
+    return [0] + timestamp_bytes + [2] + create_random_signal_bytes(61, seed)
+
+
+def benchmark_parse_summary_packet():
+    payload = create_summary_payload()
+    
+    implementations = [("bitstring", zephyr.message.bitstring_parse_summary_packet),
+                       ("struct", zephyr.message.parse_summary_packet)]
+    
+    return [(implementation_name, measure_rate(lambda: parse(payload), 1))
+            for implementation_name, parse in implementations]
+
+
+def main():
+    print "%-10s %-10s %15s" % ("stream", "unpacker", "samples/s")
+    for case_name, implementation_name, samples_per_second in benchmark_unpack_bit_packed_values():
+        print "%-10s %-10s %15.0f" % (case_name, implementation_name, samples_per_second)
+    
+    print
+    print "%-10s %-10s %15s" % ("stream", "decoder", "packets/s")
+    for implementation_name, packets_per_second in benchmark_parse_summary_packet():
+        print "%-10s %-10s %15.0f" % ("summary", implementation_name, packets_per_second)
+
+
+if __name__ == "__main__":
+    main()
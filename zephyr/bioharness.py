@@ -31,13 +31,17 @@ class BioHarnessSignalAnalysis:
 
 
 class BioHarnessPacketHandler:
-    def __init__(self, signal_callbacks, event_callbacks, sequence_number_wraparound=256):
+    def __init__(self, signal_callbacks, event_callbacks, sequence_number_wraparound=256,
+                 clock_difference_correction=None):
         self.signal_callbacks = signal_callbacks
         self.event_callbacks = event_callbacks
         self.sequence_number_wraparound = sequence_number_wraparound
         
         self.sequence_numbers = {}
-        self.clock_difference_correction = zephyr.util.ClockDifferenceEstimator()
+        
+        if clock_difference_correction is None:
+            clock_difference_correction = zephyr.util.ClockDifferenceEstimator()
+        self.clock_difference_correction = clock_difference_correction
     
     def get_message_end_timestamp(self, signal_packet):
         temporal_message_length = (len(signal_packet.samples) - 1) / signal_packet.samplerate
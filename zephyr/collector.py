@@ -1,25 +1,70 @@
 
+import bisect
+import timeit
 import threading
+import itertools
 import collections
 
+import numpy
+
 import zephyr
 
 from zephyr.message import AccelerationSignalSample, SignalSample
 
 
+# Samples of a time range as arrays. discontinuities holds the indices of
+# the samples that start a new signal stream within the window.
+SignalWindow = collections.namedtuple("SignalWindow", ["timestamps", "samples", "discontinuities"])
+
+
+class EventStreamView(object):
+    """Range of the events of an EventStream. The view references the lists
+    of the stream without copying them, the stream only appends to them and
+    replaces them when compacting."""
+    
+    def __init__(self, timestamps, values, start_position, end_position):
+        self.timestamps = timestamps
+        self.values = values
+        self.start_position = start_position
+        self.end_position = end_position
+    
+    def __len__(self):
+        return self.end_position - self.start_position
+    
+    def __getitem__(self, index):
+        assert 0 <= index < len(self)
+        position = self.start_position + index
+        return self.timestamps[position], self.values[position]
+    
+    def __iter__(self):
+        return itertools.izip(self.iterate_timestamps(), self.iterate_values())
+    
+    def iterate_timestamps(self):
+        return itertools.islice(self.timestamps, self.start_position, self.end_position)
+    
+    def iterate_values(self):
+        return itertools.islice(self.values, self.start_position, self.end_position)
+
+
 class EventStream:
+    """Timestamped events in the order of their timestamps. The timestamps
+    and values are kept in parallel lists, so that ranges can be found with
+    bisect. Cleaned up events stay in the lists until they make up half of
+    them, then the lists are replaced by compacted copies."""
+    
     def __init__(self):
-        self.events = []
+        self._timestamps = []
+        self._values = []
+        self._start_position = 0
         self.events_cleaned_up = 0
         self.lock = threading.RLock()
     
     def __iter__(self):
-        with self.lock:
-            return iter(self.events[:])
+        return iter(self.get_view())
     
     def __len__(self):
         with self.lock:
-            corrected_length = len(self.events) + self.events_cleaned_up
+            corrected_length = len(self._timestamps) - self._start_position + self.events_cleaned_up
             return corrected_length
     
     def __getitem__(self, index):
@@ -27,46 +72,80 @@ class EventStream:
             assert 0 <= index < len(self)
             assert index >= self.events_cleaned_up
             
-            corrected_index = index - self.events_cleaned_up
-            return self.events[corrected_index]
+            position = index - self.events_cleaned_up + self._start_position
+            return self._timestamps[position], self._values[position]
     
     def append(self, value):
+        event_timestamp, event_value = value
         with self.lock:
-            self.events.append(value)
+            self._timestamps.append(event_timestamp)
+            self._values.append(event_value)
     
-    def clean_up_events_before(self, timestamp_lower_bound):
+    @property
+    def first_sample_index(self):
+        return self.events_cleaned_up
+    
+    def get_sample_timestamp(self, sample_index):
+        """Timestamp of the event with the given index, None if it has not
+        been appended yet."""
         with self.lock:
-            cutoff_index = 0
+            if sample_index >= len(self):
+                return None
             
-            for event_timestamp, event_value in self.events: #@UnusedVariable
-                if event_timestamp < timestamp_lower_bound:
-                    cutoff_index += 1
-                else:
-                    break
+            return self[max(sample_index, self.events_cleaned_up)][0]
+    
+    def get_view(self, from_index=None, to_end_timestamp=None):
+        """Return the events from the given index, or from the first kept
+        event, up to and including the given timestamp."""
+        with self.lock:
+            if from_index is None:
+                start_position = self._start_position
+            else:
+                start_position = max(self._start_position, from_index - self.events_cleaned_up + self._start_position)
+            
+            if to_end_timestamp is None:
+                end_position = len(self._timestamps)
+            else:
+                end_position = bisect.bisect_right(self._timestamps, to_end_timestamp, start_position)
             
-            if cutoff_index:
-                self.events = self.events[cutoff_index:]
-                self.events_cleaned_up += cutoff_index
+            return EventStreamView(self._timestamps, self._values, start_position, max(start_position, end_position))
     
-    def iterate_samples(self, from_sample_index, to_end_timestamp):
-        sample_index = from_sample_index
+    def get_time_range(self, start_timestamp, end_timestamp):
+        """Return the events with start_timestamp <= timestamp < end_timestamp."""
+        with self.lock:
+            start_position = bisect.bisect_left(self._timestamps, start_timestamp, self._start_position)
+            end_position = bisect.bisect_left(self._timestamps, end_timestamp, start_position)
+            
+            return EventStreamView(self._timestamps, self._values, start_position, end_position)
+    
+    def get_window(self, start_timestamp, end_timestamp):
+        """Return a SignalWindow with the events of the time range, events
+        have no discontinuities."""
+        event_view = self.get_time_range(start_timestamp, end_timestamp)
         
-        while True:
-            with self.lock:
-                if self.events_cleaned_up > sample_index:
-                    break
-                
-                last_item = self[sample_index] if len(self) > sample_index else None
+        return SignalWindow(numpy.fromiter(event_view.iterate_timestamps(), float, len(event_view)),
+                            numpy.array(list(event_view.iterate_values())), numpy.empty(0, dtype=int))
+    
+    def clean_up_events_before(self, timestamp_lower_bound):
+        with self.lock:
+            cutoff_position = bisect.bisect_left(self._timestamps, timestamp_lower_bound, self._start_position)
             
-            if last_item is not None:
-                event_timestamp, event_value = last_item
-                
-                if event_timestamp <= to_end_timestamp:
-                    yield event_value
-                    sample_index += 1
-                    continue
+            self.events_cleaned_up += cutoff_position - self._start_position
+            self._start_position = cutoff_position
+            
+            if self._start_position > len(self._timestamps) / 2:
+                # New lists, the views handed out keep referencing the old ones
+                self._timestamps = self._timestamps[self._start_position:]
+                self._values = self._values[self._start_position:]
+                self._start_position = 0
+    
+    def iterate_samples(self, from_sample_index, to_end_timestamp):
+        with self.lock:
+            if self.events_cleaned_up > from_sample_index:
+                return iter([])
             
-            break
+            return self.get_view(from_sample_index, to_end_timestamp).iterate_values()
+
 
 class SignalPacketIterator(object):
 
@@ -74,13 +153,33 @@ class SignalPacketIterator(object):
         self.signal_packet = signal_packet
         self.signal_type = signal_packet.type
         
-        self.samples = []
-        self.samples.extend(signal_packet.samples)
+        self.samples = numpy.asarray(signal_packet.samples)
         self.end_timestamp = signal_packet.timestamp + len(signal_packet.samples) / float(signal_packet.samplerate)
         
     @property
     def start_timestamp(self):
         return self.end_timestamp - len(self.samples) / float(self.signal_packet.samplerate)
+    
+    def get_sample_timestamps(self, skip_samples=0):
+        sample_period = 1.0 / self.signal_packet.samplerate
+        return self.start_timestamp + numpy.arange(skip_samples, len(self.samples)) * sample_period
+    
+    def get_sample_columns(self, sample_timestamps=None, skip_samples=0):
+        """Return the packet as columns in the order of the SignalSample or
+        AccelerationSignalSample fields. The timestamps and samples are arrays,
+        the values shared by all samples of the packet are single values."""
+        if sample_timestamps is None:
+            sample_timestamps = self.get_sample_timestamps(skip_samples)
+        
+        samples = self.samples[skip_samples:]
+        
+        if self.signal_packet.type == "acceleration":
+            sample_columns = [samples[:, 0], samples[:, 1], samples[:, 2]]
+        else:
+            sample_columns = [samples]
+        
+        return ([self.signal_packet.type, sample_timestamps, self.signal_packet.samplerate] +
+                sample_columns + [self.signal_packet.sequence_number])
 
     def iterate_timed_samples(self, skip_samples=0):
         start_timestamp = self.start_timestamp
@@ -96,65 +195,187 @@ class SignalPacketIterator(object):
 
 
 class SignalStream:
-    def __init__(self, signal_packet):
+    """Continuous signal kept in a preallocated ring buffer. Appending and
+    removing samples only moves the buffer positions, and the kept samples
+    can be read as at most two array views of the buffer."""
+    
+    def __init__(self, signal_packet, capacity):
         self.samplerate = signal_packet.samplerate
-        self.samples = []
         self.lock = threading.RLock()
         
+        first_samples = numpy.asarray(signal_packet.samples)
+        self.capacity = max(capacity, len(first_samples))
+        self._buffer = numpy.empty((self.capacity,) + first_samples.shape[1:], dtype=first_samples.dtype)
+        self._start_position = 0
+        self._sample_count = 0
+        
         self.end_timestamp = None
         self.append_signal_packet(signal_packet)
     
+    def __len__(self):
+        return self._sample_count
+    
     def append_signal_packet(self, signal_packet):
+        """Append the samples of the packet. Returns the number of the oldest
+        samples that were overwritten because the buffer was full."""
         with self.lock:
             assert signal_packet.samplerate == self.samplerate
             
-            self.samples.extend(signal_packet.samples)
-            self.end_timestamp = signal_packet.timestamp + len(signal_packet.samples) / float(signal_packet.samplerate)
+            new_samples = numpy.asarray(signal_packet.samples)
+            new_sample_count = len(new_samples)
+            
+            if new_sample_count > self.capacity:
+                new_samples = new_samples[-self.capacity:]
+            
+            write_position = (self._start_position + self._sample_count) % self.capacity
+            first_part_length = min(len(new_samples), self.capacity - write_position)
+            self._buffer[write_position:write_position + first_part_length] = new_samples[:first_part_length]
+            self._buffer[:len(new_samples) - first_part_length] = new_samples[first_part_length:]
+            
+            samples_overwritten = max(0, self._sample_count + new_sample_count - self.capacity)
+            if new_sample_count > self.capacity:
+                # The kept samples of the packet fill the buffer from the write position
+                self._sample_count = self.capacity
+                self._start_position = write_position
+            else:
+                self._sample_count += new_sample_count - samples_overwritten
+                self._start_position = (self._start_position + samples_overwritten) % self.capacity
+            
+            self.end_timestamp = signal_packet.timestamp + new_sample_count / float(signal_packet.samplerate)
+        
+        return samples_overwritten
     
     def remove_samples_before(self, timestamp_lower_bound):
         with self.lock:
             samples_to_remove = max(0, int((timestamp_lower_bound - self.start_timestamp) * self.samplerate))
+            samples_to_remove = min(samples_to_remove, self._sample_count)
             
             if samples_to_remove:
-                self.samples = self.samples[samples_to_remove:]
+                self._start_position = (self._start_position + samples_to_remove) % self.capacity
+                self._sample_count -= samples_to_remove
         
         return samples_to_remove
     
     @property
     def start_timestamp(self):
-        return self.end_timestamp - len(self.samples) / float(self.samplerate)
+        return self.end_timestamp - self._sample_count / float(self.samplerate)
+    
+    def get_segments(self, skip_samples=0, sample_count=None):
+        """Return the samples, after skipping the given number of the oldest
+        ones, as two views of the buffer. The second view is empty unless the
+        samples wrap around the end of the buffer."""
+        with self.lock:
+            skip_samples = min(skip_samples, self._sample_count)
+            if sample_count is None:
+                sample_count = self._sample_count - skip_samples
+            else:
+                sample_count = min(sample_count, self._sample_count - skip_samples)
+            
+            first_position = (self._start_position + skip_samples) % self.capacity
+            end_position = first_position + sample_count
+            
+            if end_position <= self.capacity:
+                return self._buffer[first_position:end_position], self._buffer[:0]
+            else:
+                return self._buffer[first_position:], self._buffer[:end_position - self.capacity]
+    
+    @property
+    def samples(self):
+        """Contiguous copy of the samples, use get_segments to avoid the copy."""
+        first_segment, second_segment = self.get_segments()
+        
+        if len(second_segment):
+            return numpy.concatenate((first_segment, second_segment))
+        else:
+            return first_segment.copy()
+    
+    def get_window(self, start_timestamp, end_timestamp):
+        """Return the timestamps and a copy of the samples with
+        start_timestamp <= timestamp < end_timestamp."""
+        with self.lock:
+            stream_start_timestamp = self.start_timestamp
+            first_sample_i = max(0, int(numpy.ceil((start_timestamp - stream_start_timestamp) * self.samplerate)))
+            end_sample_i = min(self._sample_count, int(numpy.ceil((end_timestamp - stream_start_timestamp) * self.samplerate)))
+            end_sample_i = max(first_sample_i, end_sample_i)
+            
+            first_segment, second_segment = self.get_segments(first_sample_i, end_sample_i - first_sample_i)
+            samples = numpy.concatenate((first_segment, second_segment))
+        
+        timestamps = stream_start_timestamp + numpy.arange(first_sample_i, end_sample_i) * (1.0 / self.samplerate)
+        return timestamps, samples
     
     def iterate_timed_samples(self, skip_samples=0):
         with self.lock:
             start_timestamp = self.start_timestamp
             sample_period = 1.0 / self.samplerate
             
-            for sample_i, sample in enumerate(self.samples[skip_samples:], start=skip_samples):
-                sample_timestamp = start_timestamp + sample_i * sample_period
-                yield sample_timestamp, sample
+            sample_i = skip_samples
+            for segment in self.get_segments(skip_samples):
+                for sample in segment:
+                    sample_timestamp = start_timestamp + sample_i * sample_period
+                    yield sample_timestamp, sample
+                    sample_i += 1
 
 
 class SignalStreamHistory:
-    def __init__(self):
+    def __init__(self, buffer_length_seconds=30.0):
         self._signal_streams = []
+        # Start timestamps of the streams when they were created, for bisect
+        self._stream_start_timestamps = []
+        self.buffer_length_seconds = buffer_length_seconds
         
         self.samples_cleaned_up = 0
     
     def append_signal_packet(self, signal_packet, starts_new_stream):
         if starts_new_stream or not len(self._signal_streams):
-            signal_stream = SignalStream(signal_packet)
+            capacity = int(signal_packet.samplerate * self.buffer_length_seconds) + 1
+            signal_stream = SignalStream(signal_packet, capacity)
             self._signal_streams.append(signal_stream)
+            self._stream_start_timestamps.append(signal_stream.start_timestamp)
         else:
             signal_stream = self._signal_streams[-1]
-            signal_stream.append_signal_packet(signal_packet)
+            samples_overwritten = signal_stream.append_signal_packet(signal_packet)
+            
+            if samples_overwritten:
+                # The buffer wrapped around before the cleanup. The streams before
+                # this one are even older, so they are dropped as well.
+                for older_signal_stream in self._signal_streams[:-1]:
+                    self.samples_cleaned_up += len(older_signal_stream)
+                
+                del self._signal_streams[:-1]
+                del self._stream_start_timestamps[:-1]
+                self.samples_cleaned_up += samples_overwritten
     
     def get_signal_streams(self):
         return self._signal_streams
     
+    @property
+    def first_sample_index(self):
+        return self.samples_cleaned_up
+    
+    def get_sample_timestamp(self, sample_index):
+        """Timestamp of the sample with the given index, None if it has not
+        been appended yet."""
+        sample_index = sample_index - self.samples_cleaned_up
+        
+        signal_stream_start_index = 0
+        for signal_stream in self._signal_streams:
+            next_signal_stream_start_index = signal_stream_start_index + len(signal_stream)
+            
+            if sample_index < next_signal_stream_start_index:
+                sample_i = max(0, sample_index - signal_stream_start_index)
+                return signal_stream.start_timestamp + sample_i * (1.0 / signal_stream.samplerate)
+            
+            signal_stream_start_index = next_signal_stream_start_index
+        
+        return None
+    
     def _cleanup_signal_stream(self, signal_stream, timestamp_bound):
         if timestamp_bound >= signal_stream.end_timestamp:
-            self._signal_streams.remove(signal_stream)
-            samples_removed = len(signal_stream.samples)
+            stream_i = self._signal_streams.index(signal_stream)
+            del self._signal_streams[stream_i]
+            del self._stream_start_timestamps[stream_i]
+            samples_removed = len(signal_stream)
         else:
             samples_removed = signal_stream.remove_samples_before(timestamp_bound)
         
@@ -169,12 +390,43 @@ class SignalStreamHistory:
             
             self._cleanup_signal_stream(signal_stream, history_limit)
     
+    def get_window(self, start_timestamp, end_timestamp):
+        """Return a SignalWindow with the samples of the time range
+        start_timestamp <= timestamp < end_timestamp."""
+        signal_streams = self._signal_streams[:]
+        stream_start_timestamps = self._stream_start_timestamps[:]
+        
+        first_stream_i = max(0, bisect.bisect_right(stream_start_timestamps, start_timestamp) - 1)
+        end_stream_i = bisect.bisect_left(stream_start_timestamps, end_timestamp)
+        
+        timestamp_parts = []
+        sample_parts = []
+        discontinuities = []
+        window_sample_count = 0
+        
+        for signal_stream in signal_streams[first_stream_i:end_stream_i]:
+            timestamps, samples = signal_stream.get_window(start_timestamp, end_timestamp)
+            
+            if len(samples):
+                if sample_parts:
+                    discontinuities.append(window_sample_count)
+                
+                timestamp_parts.append(timestamps)
+                sample_parts.append(samples)
+                window_sample_count += len(samples)
+        
+        if not sample_parts:
+            return SignalWindow(numpy.empty(0), numpy.empty(0), numpy.empty(0, dtype=int))
+        
+        return SignalWindow(numpy.concatenate(timestamp_parts), numpy.concatenate(sample_parts),
+                            numpy.array(discontinuities, dtype=int))
+    
     def iterate_samples(self, from_sample_index, to_end_timestamp):
         from_sample_index = from_sample_index - self.samples_cleaned_up
         
         signal_stream_start_index = 0
         for signal_stream in self._signal_streams:
-            sample_count = len(signal_stream.samples)
+            sample_count = len(signal_stream)
             next_signal_stream_start_index = signal_stream_start_index + sample_count
             
             if from_sample_index < next_signal_stream_start_index:
@@ -190,18 +442,45 @@ class SignalStreamHistory:
 
 
 class MeasurementCollector:
+    cleanup_interval = 5.0
+    
     def __init__(self, history_length_seconds=20.0):
-        self._signal_stream_histories = collections.defaultdict(SignalStreamHistory)
+        # The ring buffers have room for the history plus the samples that
+        # arrive until the next cleanup
+        self.buffer_length_seconds = history_length_seconds + 2 * self.cleanup_interval
+        # The streams are added when they receive data, looking up a stream without data does not add it
+        self._signal_stream_histories = collections.defaultdict(lambda: SignalStreamHistory(self.buffer_length_seconds))
         self._event_streams = collections.defaultdict(EventStream)
         
         self.history_length_seconds = history_length_seconds
-        self.last_cleanup_time = 0.0
+        
+        # History limit up to which each stream was last cleaned up
+        self._cleanup_watermarks = {}
+        
+        self.cleanup_count = 0
+        self.cleanup_duration_total = 0.0
+        self.cleanup_duration_max = 0.0
+        
+        self.data_callbacks = []
+    
+    def add_data_callback(self, callback):
+        """The callback is called with the stream name after new samples or
+        events were added to the stream."""
+        self.data_callbacks.append(callback)
     
     def get_signal_stream_history(self, stream_type):
-        return self._signal_stream_histories[stream_type]
+        signal_stream_history = self._signal_stream_histories.get(stream_type)
+        if signal_stream_history is None:
+            # An empty history that is not kept
+            signal_stream_history = SignalStreamHistory(self.buffer_length_seconds)
+        return signal_stream_history
     
     def get_event_stream(self, stream_type):
-        return self._event_streams[stream_type]
+        event_stream = self._event_streams.get(stream_type)
+        if event_stream is None:
+            # An empty stream that is not kept
+            event_stream = EventStream()
+        return event_stream
     
     def iterate_signal_stream_histories(self):
         return self._signal_stream_histories.items()
@@ -209,24 +488,57 @@ class MeasurementCollector:
     def iterate_event_streams(self):
         return self._event_streams.items()
     
+    def get_stream(self, stream_name):
+        """Signal stream history or event stream with the given name, an empty
+        event stream if the stream has no data"""
+        if stream_name in self._signal_stream_histories:
+            return self._signal_stream_histories[stream_name]
+        else:
+            return self.get_event_stream(stream_name)
+    
+    def get_window(self, stream_type, start_timestamp, end_timestamp):
+        """Return a SignalWindow with the samples or events of the stream
+        with start_timestamp <= timestamp < end_timestamp."""
+        return self.get_stream(stream_type).get_window(start_timestamp, end_timestamp)
+    
     def handle_signal(self, signal_packet, starts_new_stream):
         signal_stream_history = self._signal_stream_histories[signal_packet.type]
         signal_stream_history.append_signal_packet(signal_packet, starts_new_stream)
-        self.cleanup_if_needed()
+        self.clean_up_stream_if_needed(signal_packet.type, signal_stream_history.clean_up_samples_before)
+        
+        for data_callback in self.data_callbacks:
+            data_callback(signal_packet.type)
     
     def handle_event(self, stream_name, value):
-        self._event_streams[stream_name].append(value)
-        self.cleanup_if_needed()
+        event_stream = self._event_streams[stream_name]
+        event_stream.append(value)
+        self.clean_up_stream_if_needed(stream_name, event_stream.clean_up_events_before)
+        
+        for data_callback in self.data_callbacks:
+            data_callback(stream_name)
     
-    def cleanup_if_needed(self):
-        now = zephyr.time()
+    def clean_up_stream_if_needed(self, stream_name, clean_up_before):
+        """Clean up only the stream that received data, once its history limit
+        has moved a cleanup interval past the watermark of the stream."""
+        history_limit = zephyr.time() - self.history_length_seconds
         
-        if self.last_cleanup_time < now - 5.0:
-            history_limit = now - self.history_length_seconds
-            for signal_stream_history in self._signal_stream_histories.values():
-                signal_stream_history.clean_up_samples_before(history_limit)
-            
-            for event_stream in self._event_streams.values():
-                event_stream.clean_up_events_before(history_limit)
-            
-            self.last_cleanup_time = now
+        if history_limit < self._cleanup_watermarks.get(stream_name, float("-inf")) + self.cleanup_interval:
+            return
+        
+        cleanup_start_time = timeit.default_timer()
+        clean_up_before(history_limit)
+        cleanup_duration = timeit.default_timer() - cleanup_start_time
+        
+        self._cleanup_watermarks[stream_name] = history_limit
+        
+        self.cleanup_count += 1
+        self.cleanup_duration_total += cleanup_duration
+        self.cleanup_duration_max = max(self.cleanup_duration_max, cleanup_duration)
+    
+    def get_cleanup_statistics(self):
+        mean_cleanup_duration = self.cleanup_duration_total / self.cleanup_count if self.cleanup_count else 0.0
+        
+        return {"cleanup_count": self.cleanup_count,
+                "cleanup_duration_total": self.cleanup_duration_total,
+                "cleanup_duration_mean": mean_cleanup_duration,
+                "cleanup_duration_max": self.cleanup_duration_max}
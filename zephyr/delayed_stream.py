@@ -1,45 +1,184 @@
 
+import heapq
 import threading
 import collections
-import itertools
-import time
 
 import zephyr
 
-class DelayedRealTimeStream(threading.Thread):
-    def __init__(self, signal_collector, callbacks, default_delay, specific_delays={}):
-        threading.Thread.__init__(self)
+
+class DelayedStreamScheduler(object):
+    """Releases the samples and events of a MeasurementCollector once they are
+    older than the delay of their stream. The release time of the next
+    sample of every stream with unreleased samples is kept in a heap, so only
+    the streams that are due are visited. The samples of a stream that are
+    due together are passed to the batch callbacks as one list, and one by
+    one to the callbacks."""
+    
+    def __init__(self, signal_collector, callbacks, default_delay, specific_delays={}, batch_callbacks=None):
         self.signal_collector = signal_collector
         self.callbacks = callbacks
+        self.batch_callbacks = batch_callbacks if batch_callbacks is not None else []
         self.default_delay = default_delay
         self.specific_delays = specific_delays
         
         self.stream_output_positions = collections.defaultdict(lambda: 0)
         
-        self.terminate_requested = False
+        self._release_times = []
+        self._scheduled_streams = set()
+        self.lock = threading.RLock()
+        
+        signal_collector.add_data_callback(self.handle_new_data)
     
     def add_callback(self, callback):
         self.callbacks.append(callback)
     
+    def add_batch_callback(self, callback):
+        self.batch_callbacks.append(callback)
+    
+    def get_delay(self, stream_name):
+        return self.specific_delays.get(stream_name, self.default_delay)
+    
+    def get_next_release_time(self):
+        with self.lock:
+            if self._release_times:
+                return self._release_times[0][0]
+            else:
+                return None
+    
+    def _schedule_stream(self, stream_name):
+        stream = self.signal_collector.get_stream(stream_name)
+        sample_index = max(self.stream_output_positions[stream_name], stream.first_sample_index)
+        sample_timestamp = stream.get_sample_timestamp(sample_index)
+        
+        if sample_timestamp is None:
+            return None
+        
+        release_time = sample_timestamp + self.get_delay(stream_name)
+        heapq.heappush(self._release_times, (release_time, stream_name))
+        self._scheduled_streams.add(stream_name)
+        return release_time
+    
+    def handle_new_data(self, stream_name):
+        """Schedule the stream if it has no pending release. Returns True if
+        that made the next release earlier."""
+        with self.lock:
+            if stream_name in self._scheduled_streams:
+                return False
+            
+            previous_release_time = self.get_next_release_time()
+            release_time = self._schedule_stream(stream_name)
+            
+            return release_time is not None and (previous_release_time is None or release_time < previous_release_time)
+    
+    def release_due_samples(self, now):
+        """Deliver the samples that are due at the given time. Returns the
+        time of the next release, or None if all samples were released."""
+        released_batches = []
+        
+        with self.lock:
+            while self._release_times and self._release_times[0][0] <= now:
+                release_time, stream_name = heapq.heappop(self._release_times)  #@UnusedVariable
+                self._scheduled_streams.discard(stream_name)
+                
+                stream = self.signal_collector.get_stream(stream_name)
+                from_sample = max(self.stream_output_positions[stream_name], stream.first_sample_index)
+                samples = list(stream.iterate_samples(from_sample, now - self.get_delay(stream_name)))
+                self.stream_output_positions[stream_name] = from_sample + len(samples)
+                
+                # Without released samples the stream waits for new data, so that
+                # it cannot be rescheduled for the same time again
+                if len(samples):
+                    released_batches.append((stream_name, samples))
+                    self._schedule_stream(stream_name)
+            
+            next_release_time = self.get_next_release_time()
+        
+        for stream_name, samples in released_batches:
+            for batch_callback in self.batch_callbacks:
+                batch_callback(stream_name, samples)
+            
+            for callback in self.callbacks:
+                for sample in samples:
+                    callback(stream_name, sample)
+        
+        return next_release_time
+
+
+class DelayedRealTimeStream(DelayedStreamScheduler, threading.Thread):
+    """Thread that sleeps until the next release time or until new data
+    makes an earlier release necessary. On Python 2 a Condition.wait with a
+    timeout polls with sleeps of up to 50 ms, so a release or a wakeup by new
+    data can come up to 50 ms late. ReactorDelayedStream releases on time."""
+    
+    def __init__(self, signal_collector, callbacks, default_delay, specific_delays={}, batch_callbacks=None):
+        threading.Thread.__init__(self)
+        self.wakeup_condition = threading.Condition()
+        self.terminate_requested = False
+        
+        DelayedStreamScheduler.__init__(self, signal_collector, callbacks, default_delay, specific_delays, batch_callbacks)
+    
+    def handle_new_data(self, stream_name):
+        with self.wakeup_condition:
+            if DelayedStreamScheduler.handle_new_data(self, stream_name):
+                self.wakeup_condition.notify()
+    
     def terminate(self):
-        self.terminate_requested = True
+        with self.wakeup_condition:
+            self.terminate_requested = True
+            self.wakeup_condition.notify()
     
     def run(self):
-        while not self.terminate_requested:
-            now = zephyr.time()
-            all_streams = itertools.chain(self.signal_collector.iterate_signal_stream_histories(),
-                                          self.signal_collector.iterate_event_streams())
-            
-            for signal_stream_name, signal_stream_history in all_streams:
-                print "stream name: %s history %s" % (signal_stream_name, signal_stream_history)
-                delay = self.specific_delays.get(signal_stream_name, self.default_delay)
+        while True:
+            with self.wakeup_condition:
+                if self.terminate_requested:
+                    break
                 
-                delayed_current_time = now - delay
+                next_release_time = self.get_next_release_time()
+                now = zephyr.time()
                 
-                from_sample = self.stream_output_positions[signal_stream_name]
-                for sample in signal_stream_history.iterate_samples(from_sample, delayed_current_time):
-                    self.stream_output_positions[signal_stream_name] += 1
-                    for callback in self.callbacks:
-                        callback(signal_stream_name, sample)
+                if next_release_time is None:
+                    self.wakeup_condition.wait()
+                elif next_release_time > now:
+                    self.wakeup_condition.wait(next_release_time - now)
             
-            time.sleep(0.01)
+            self.release_due_samples(zephyr.time())
+
+
+class ReactorDelayedStream(DelayedStreamScheduler):
+    """Releases the samples with reactor.callLater instead of a thread. The
+    collector has to be fed from the reactor thread."""
+    
+    def __init__(self, signal_collector, reactor, callbacks, default_delay, specific_delays={}, batch_callbacks=None):
+        self.reactor = reactor
+        self.delayed_call = None
+        self.running = False
+        
+        DelayedStreamScheduler.__init__(self, signal_collector, callbacks, default_delay, specific_delays, batch_callbacks)
+    
+    def start(self):
+        self.running = True
+        self._release_and_reschedule()
+    
+    def stop(self):
+        self.running = False
+        self._schedule_call(None)
+    
+    def handle_new_data(self, stream_name):
+        if DelayedStreamScheduler.handle_new_data(self, stream_name) and self.running:
+            self._schedule_call(self.get_next_release_time())
+    
+    def _schedule_call(self, release_time):
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        
+        if release_time is None:
+            self.delayed_call = None
+        else:
+            self.delayed_call = self.reactor.callLater(max(0.0, release_time - zephyr.time()), self._release_and_reschedule)
+    
+    def _release_and_reschedule(self):
+        self.delayed_call = None
+        next_release_time = self.release_due_samples(zephyr.time())
+        
+        if self.running:
+            self._schedule_call(next_release_time)
@@ -1,4 +1,5 @@
 
+import struct
 import collections
 
 import zephyr.util
@@ -59,26 +60,24 @@ SignalSample = collections.namedtuple("SignalSample", ["type", "timestamp", "sam
 #Reserved
 #Reserved
 
+HXM_MESSAGE_STRUCT = struct.Struct("<BB15H6x3H")
+
 def parse_hxm_message(payload):
-    heart_rate, heartbeat_number = payload[9:11]
-    
-    heartbeat_timestamp_bytes = payload[11:41]
+    hxm_values = HXM_MESSAGE_STRUCT.unpack_from(zephyr.util.as_byte_buffer(payload), 9)
     
-    movement_data_bytes = payload[47:53]
-    
-    distance, speed, strides = tuple(zephyr.util.parse_uint16_values_from_bytes(movement_data_bytes))
+    heart_rate, heartbeat_number = hxm_values[0:2]
+    heartbeat_milliseconds = list(hxm_values[2:17])
+    distance, speed, strides = hxm_values[17:20]
     
     distance = distance / 16.0
     speed = speed / 256.0
     
-    heartbeat_milliseconds = list(zephyr.util.parse_uint16_values_from_bytes(heartbeat_timestamp_bytes))
-    
     hxm_message = HxMMessage(heart_rate=heart_rate, heartbeat_number=heartbeat_number,
                              heartbeat_milliseconds=heartbeat_milliseconds, distance=distance,
                              speed=speed, strides=strides)
     return hxm_message
 
-def parse_summary_packet(payload):
+def bitstring_parse_summary_packet(payload):
     
     sequence_number = payload[0]    
     timestamp = zephyr.util.parse_timestamp(payload[1:9])
@@ -159,41 +158,151 @@ def parse_summary_packet(payload):
     return message
                                 
 
+# Layout of the summary packet following the packing format version byte
+# (payload index 9). Each field is (name, struct format, scale).
+SUMMARY_PACKET_FIELDS = [("heart_rate", "H", None),
+                         ("respiration_rate", "H", 0.1),
+                         ("skin_temperature", "h", 0.1),
+                         ("posture", "h", None),
+                         ("activity", "H", 0.01),
+                         ("peak_acceleration", "H", 0.01),
+                         ("battery_volatge", "H", 0.001),
+                         ("battery_level", "B", None),
+                         ("respiration_wave_amplitude", "H", None),
+                         ("respiration_wave_noise", "H", None),
+                         ("respiration_wave_confidence", "B", None),
+                         ("ecg_wave_amplitude", "H", 0.000001),
+                         ("ecg_wave_noise", "H", 0.000001),
+                         ("ecg_wave_confidence", "B", None),
+                         ("hrv", "H", None),
+                         ("system_confidence", "B", None),
+                         ("gsr", "H", None),
+                         ("rog", "H", None),
+                         ("accl_vertical_min", "h", 0.01),
+                         ("accl_vertical_peak", "h", 0.01),
+                         ("accl_lateral_min", "h", 0.01),
+                         ("accl_lateral_peak", "h", 0.01),
+                         ("accl_sagittal_min", "h", 0.01),
+                         ("accl_sagittal_peak", "h", 0.01),
+                         ("device_internal_temp", "h", 0.1),
+                         ("status_byte_0", "B", None),
+                         ("status_byte_1", "B", None),
+                         ("link_quality", "B", None),
+                         ("rssi", "b", None),
+                         ("tx_power", "b", None),
+                         ("estimated_core_temp", "H", 0.1)]
+
+# The two status bytes read from the most significant bit of the first byte.
+# Each field is (name, bit count).
+SUMMARY_STATUS_FIELDS = [("posture_unreliable", 1),
+                         ("skin_temperature_unreliable", 1),
+                         ("respiration_rate_unreliable", 1),
+                         ("heart_rate_unreliable", 1),
+                         ("not_fitted_to_garmet", 1),
+                         ("button_pressed", 1),
+                         ("device_worn_detection_level", 2),
+                         ("external_sensors_connected", 1),
+                         ("resting_stage_detection", 1),
+                         ("unused", 2),
+                         ("usb_connected_flag", 1),
+                         ("estimated_core_temp_unreliable", 1),
+                         ("hrv_unreliable", 1),
+                         ("activity_unreliable", 1)]
+
+
+def format_status_bits(value, nbits):
+    if nbits == 1:
+        return bool(value)
+    else:
+        return format(value, "0%db" % nbits)
+
+
+class SummaryPacketLayout:
+    """Summary packet decoder compiled once from the declarative field tables."""
+    
+    def __init__(self, fields, status_fields, payload_offset):
+        self.payload_offset = payload_offset
+        self.struct = struct.Struct("<" + "".join(field_format for name, field_format, scale in fields))  #@UnusedVariable
+        
+        field_names = [name for name, field_format, scale in fields]  #@UnusedVariable
+        self.scaled_fields = [(field_i, scale) for field_i, (name, field_format, scale) in enumerate(fields)  #@UnusedVariable
+                              if scale is not None]
+        self.status_byte_indices = (field_names.index("status_byte_0"), field_names.index("status_byte_1"))
+        
+        self.status_fields = []
+        status_bit_position = 16
+        for name, nbits in status_fields:
+            status_bit_position -= nbits
+            self.status_fields.append((status_bit_position, 2**nbits - 1, nbits))
+            field_names.append(name)
+        
+        # Positions of the decoded values in the order of SummaryMessage, after
+        # the sequence number and the timestamp
+        self.message_value_indices = [field_names.index(name) for name in SummaryMessage._fields[2:]]
+    
+    def decode(self, sequence_number, timestamp, payload):
+        values = list(self.struct.unpack_from(payload, self.payload_offset))
+        
+        for field_i, scale in self.scaled_fields:
+            values[field_i] = values[field_i] * scale
+        
+        status_byte_0_index, status_byte_1_index = self.status_byte_indices
+        status_word = (values[status_byte_0_index] << 8) + values[status_byte_1_index]
+        
+        for shift, mask, nbits in self.status_fields:
+            values.append(format_status_bits((status_word >> shift) & mask, nbits))
+        
+        message_values = [values[value_i] for value_i in self.message_value_indices]
+        return SummaryMessage(sequence_number, timestamp, *message_values)
+
+
+# We are skipping a byte (index = 9) that has the version number of the packing format (should equal 2).
+SUMMARY_PACKET_LAYOUT = SummaryPacketLayout(SUMMARY_PACKET_FIELDS, SUMMARY_STATUS_FIELDS, 10)
+
+
+SEQUENCE_NUMBER_STRUCT = struct.Struct("<B")
+
+def parse_summary_packet(payload):
+    payload = zephyr.util.as_byte_buffer(payload)
+    
+    sequence_number, = SEQUENCE_NUMBER_STRUCT.unpack_from(payload, 0)
+    timestamp = zephyr.util.parse_timestamp(payload, 1)
+    
+    return SUMMARY_PACKET_LAYOUT.decode(sequence_number, timestamp, payload)
+
+
 def signal_packet_payload_parser_factory(sample_parser, signal_code, samplerate):
     def parse_signal_packet(payload):
-        sequence_number = payload[0]
-        timestamp_bytes = payload[1:9]
-        signal_bytes = payload[9:]
+        payload = zephyr.util.as_byte_buffer(payload)
         
-        message_timestamp = zephyr.util.parse_timestamp(timestamp_bytes)
-        samples = sample_parser(signal_bytes)
+        sequence_number, = SEQUENCE_NUMBER_STRUCT.unpack_from(payload, 0)
+        message_timestamp = zephyr.util.parse_timestamp(payload, 1)
+        samples = sample_parser(payload, 9)
         
         signal_packet = zephyr.message.SignalPacket(signal_code, message_timestamp, samplerate, samples, sequence_number)
         return signal_packet
     
     return parse_signal_packet
 
-def parse_10_bit_signal_data(signal_bytes):
-    samples = zephyr.util.unpack_bit_packed_values(signal_bytes, 10, "uint")
+def parse_10_bit_signal_data(signal_bytes, offset=0):
+    samples = zephyr.util.unpack_bit_packed_values(signal_bytes, 10, "uint", offset)
     return samples
 
-def parse_rr_signal_data(signal_bytes):
-    samples = zephyr.util.unpack_bit_packed_values(signal_bytes, 16, "intbe")
+def parse_rr_signal_data(signal_bytes, offset=0):
+    samples = zephyr.util.unpack_bit_packed_values(signal_bytes, 16, "intbe", offset)
     return samples
 
 
-def parse_accelerometer_samples(signal_bytes):
-    interleaved_samples = parse_10_bit_samples(signal_bytes)
+def parse_accelerometer_samples(signal_bytes, offset=0):
+    interleaved_samples = parse_10_bit_signal_data(signal_bytes, offset)
     
     # 83 correspond to one g in the 14-bit acceleration
     # signal, and this of 1/4 of that
     one_g_value = 20.75
-    interleaved_samples = [value / one_g_value for value in interleaved_samples]
     
-    # Separating the X Y Z samples into tuples   
-    samples = zip(interleaved_samples[0::3],
-                        interleaved_samples[1::3],
-                        interleaved_samples[2::3])
+    # Separating the interleaved X Y Z samples into the rows of an (N, 3) array
+    xyz_sample_count = len(interleaved_samples) / 3
+    samples = interleaved_samples[:xyz_sample_count * 3].reshape(xyz_sample_count, 3) / one_g_value
     return samples
 
 
@@ -1,4 +1,5 @@
 
+import os
 import csv
 import time
 import logging
@@ -33,6 +34,59 @@ class MessageDataLogger:
         self.time_before = zephyr.time()
 
 
+class TimedDataRecorder:
+    """Records a byte stream in the format of MessageDataLogger, with a timing
+    row for every chunk. A timing row holds the arrival time of a chunk and
+    the stream position after it."""
+    
+    def __init__(self, log_file_basepath):
+        directory = os.path.dirname(log_file_basepath)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        
+        self.data_file = open(log_file_basepath + ".dat", "wb")
+        self.timing_file = open(log_file_basepath + "-timing.csv", "wb")
+        self.timing_file_csv_writer = csv.writer(self.timing_file)
+        
+        self.position = 0
+    
+    def __call__(self, stream_bytes):
+        self.data_file.write(stream_bytes)
+        self.position += len(stream_bytes)
+        
+        self.timing_file_csv_writer.writerow(("%.6f" % zephyr.time(), self.position))
+    
+    def close(self):
+        self.data_file.close()
+        self.timing_file.close()
+
+
+def read_timed_data(log_file_basepath):
+    """Return the chunks of a recording of MessageDataLogger or
+    TimedDataRecorder as (arrival time, bytes) tuples."""
+    with open(log_file_basepath + ".dat", "rb") as data_file:
+        stream_bytes = data_file.read()
+    
+    with open(log_file_basepath + "-timing.csv", "rb") as timing_file:
+        timings = [(float(timestamp_string), int(position_string))
+                   for timestamp_string, position_string in csv.reader(timing_file)]
+    
+    timed_chunks = []
+    chunk_start = 0
+    
+    for timestamp, position in timings:
+        if position > chunk_start:
+            timed_chunks.append((timestamp, stream_bytes[chunk_start:position]))
+            chunk_start = position
+    
+    # The bytes after the last timing row arrived after it
+    if chunk_start < len(stream_bytes):
+        last_timestamp = timings[-1][0] if timings else 0.0
+        timed_chunks.append((last_timestamp, stream_bytes[chunk_start:]))
+    
+    return timed_chunks
+
+
 class Protocol(threading.Thread):
     def __init__(self, connection, callbacks):
         super(Protocol, self).__init__()
@@ -113,8 +167,11 @@ class BioHarnessProtocol(Protocol):
     def disable_lifesign_timeout(self):
         self.add_initilization_message(0xA4, [0,0,0,0])
     
+    def set_summary_packet_transmit_interval(self, seconds):
+        self.add_initilization_message(0xBD, [seconds & 0xFF, seconds >> 8])
+    
     def set_summary_packet_transmit_interval_to_one_second(self):
-        self.add_initilization_message(0xBD, [1, 0])
+        self.set_summary_packet_transmit_interval(1)
     
     def enable_periodic_packets(self):
         #self.enable_ecg_waveform()
@@ -142,7 +199,7 @@ class MessageFrame:
         self.message_id = message_id
         self.length = None
         self.eom = None
-        self.payload = []
+        self.payload = bytearray()
     
     def set_length(self, length):
         assert self.length is None
@@ -167,6 +224,12 @@ class ProtocolError(Exception):
     pass
 
 
+class FrameProtocolError(ProtocolError):
+    def __init__(self, message, resume_position):
+        ProtocolError.__init__(self, message)
+        self.resume_position = resume_position
+
+
 class MessageFrameParser:
     def __init__(self, callback):
         self.callback = callback
@@ -232,3 +295,82 @@ class MessageFrameParser:
         self.message = None
         
         self.handler = self.handle_stx
+
+
+class BufferedMessageFrameParser:
+    """Message frame parser that handles whole received chunks at once rather
+    than dispatching every byte through a state machine. The produced frames
+    and the ProtocolError recovery are the same as in MessageFrameParser.
+    Incomplete frames are kept until the next chunk arrives."""
+    
+    status_dict = {0x03: "ETX", 0x06: "ACK", 0x15: "NAK"}
+    
+    def __init__(self, callback):
+        self.callback = callback
+        self.buffer = ""
+    
+    def parse_data(self, data_string):
+        if self.buffer:
+            buffer = self.buffer + data_string
+        else:
+            buffer = data_string
+        
+        buffer_length = len(buffer)
+        position = 0
+        
+        while position < buffer_length:
+            stx_position = buffer.find("\x02", position)
+            if stx_position < 0:
+                position = buffer_length
+                break
+            
+            try:
+                frame_end = self.parse_frame(buffer, stx_position)
+            except FrameProtocolError, e:
+                logging.warning("ProtocolError: %s", e)
+                position = e.resume_position
+                continue
+            
+            if frame_end is None:
+                position = stx_position
+                break
+            
+            position = frame_end
+        
+        self.buffer = buffer[position:]
+    
+    def parse_frame(self, buffer, stx_position):
+        """Parse the frame starting at the given start of message byte. Return
+        the position following the frame, or None if the frame is not complete
+        yet. Raises FrameProtocolError with the position where the byte-wise
+        parser would have continued scanning."""
+        header_end = stx_position + 3
+        if header_end > len(buffer):
+            return None
+        
+        payload_length = ord(buffer[stx_position + 2])
+        if not 0 <= payload_length <= 128:
+            raise FrameProtocolError("Incorrect data length", header_end)
+        
+        crc_position = header_end + payload_length
+        frame_end = crc_position + 2
+        if frame_end > len(buffer):
+            return None
+        
+        message = MessageFrame(ord(buffer[stx_position + 1]))
+        message.set_length(payload_length)
+        # The payload is a slice of the received string, which the payload
+        # parsers read in place with struct and numpy
+        message.payload = buffer[header_end:crc_position]
+        
+        if ord(buffer[crc_position]) != message.get_crc():
+            raise FrameProtocolError("CRC does not match", crc_position + 1)
+        
+        status = self.status_dict.get(ord(buffer[crc_position + 1]))
+        if status is None:
+            raise FrameProtocolError("Invalid ACK byte", frame_end)
+        
+        message.set_ack(status)
+        self.callback(message)
+        
+        return frame_end
@@ -0,0 +1,220 @@
+import unittest
+
+import numpy
+
+import zephyr
+from zephyr.collector import SignalPacketIterator, SignalStream, SignalStreamHistory, EventStream, MeasurementCollector
+from zephyr.message import SignalPacket
+
+
+class SignalPacketIteratorTest(unittest.TestCase):
+    def test_columns_match_timed_samples(self):
+        samples = numpy.arange(63, dtype=numpy.int32) * 7
+        signal_packet = SignalPacket("ecg", 1465948997.121, 250.0, samples, 12)
+        packet_iterator = SignalPacketIterator(signal_packet)
+        
+        for skip_samples in [0, 10]:
+            rows = zip(*[column if isinstance(column, numpy.ndarray) else [column] * (63 - skip_samples)
+                         for column in packet_iterator.get_sample_columns(skip_samples=skip_samples)])
+            
+            self.assertEqual(rows, [tuple(signal_sample) for signal_sample
+                                    in packet_iterator.iterate_timed_samples(skip_samples)])
+
+
+def create_signal_packets(packet_count, samples_per_packet=18, samplerate=18.0, start_timestamp=1000.0):
+    return [SignalPacket("breathing", start_timestamp + packet_i * samples_per_packet / samplerate, samplerate,
+                         numpy.arange(packet_i * samples_per_packet, (packet_i + 1) * samples_per_packet, dtype=numpy.int32),
+                         packet_i % 256)
+            for packet_i in range(packet_count)]
+
+
+class SignalStreamTest(unittest.TestCase):
+    def test_wraparound(self):
+        signal_packets = create_signal_packets(10)
+        signal_stream = SignalStream(signal_packets[0], 60)
+        
+        for signal_packet in signal_packets[1:3]:
+            self.assertEqual(signal_stream.append_signal_packet(signal_packet), 0)
+        
+        self.assertEqual(signal_stream.append_signal_packet(signal_packets[3]), 12)
+        self.assertEqual(len(signal_stream), 60)
+        self.assertEqual(signal_stream.samples.tolist(), range(12, 72))
+        self.assertAlmostEqual(signal_stream.start_timestamp, 1000.0 + 12 / 18.0)
+        
+        self.assertEqual(signal_stream.remove_samples_before(1000.0 + 30 / 18.0), 18)
+        self.assertEqual(signal_stream.samples.tolist(), range(30, 72))
+        
+        first_segment, second_segment = signal_stream.get_segments(5)
+        self.assertEqual(len(second_segment), 12)
+        self.assertEqual(numpy.concatenate((first_segment, second_segment)).tolist(), range(35, 72))
+        
+        timed_samples = list(signal_stream.iterate_timed_samples(5))
+        self.assertEqual([sample for sample_timestamp, sample in timed_samples], range(35, 72))  #@UnusedVariable
+        self.assertAlmostEqual(timed_samples[0][0], 1000.0 + 35 / 18.0)
+    
+    def test_packet_larger_than_buffer(self):
+        signal_stream = SignalStream(SignalPacket("ecg", 1000.0, 10.0, numpy.arange(100, 103), 0), 10)
+        self.assertEqual(signal_stream.append_signal_packet(SignalPacket("ecg", 1000.3, 10.0, numpy.arange(100, 115), 1)), 8)
+        
+        self.assertEqual(len(signal_stream), 10)
+        self.assertEqual(signal_stream.samples.tolist(), range(105, 115))
+        self.assertAlmostEqual(signal_stream.start_timestamp, 1000.8)
+        
+        signal_stream.append_signal_packet(SignalPacket("ecg", 1001.8, 10.0, numpy.arange(115, 118), 2))
+        self.assertEqual(signal_stream.samples.tolist(), range(108, 118))
+    
+    def test_acceleration_samples(self):
+        samples = numpy.arange(60, dtype=float).reshape(20, 3)
+        signal_stream = SignalStream(SignalPacket("acceleration", 1000.0, 50.0, samples, 0), 30)
+        signal_stream.append_signal_packet(SignalPacket("acceleration", 1000.4, 50.0, samples + 60, 1))
+        
+        self.assertEqual(signal_stream.samples.shape, (30, 3))
+        self.assertEqual(signal_stream.samples[0].tolist(), [30.0, 31.0, 32.0])
+
+
+class SignalStreamHistoryTest(unittest.TestCase):
+    def test_sample_indices_after_overwrite(self):
+        signal_stream_history = SignalStreamHistory(buffer_length_seconds=3.0)
+        signal_packets = create_signal_packets(6)
+        
+        signal_stream_history.append_signal_packet(signal_packets[0], True)
+        signal_stream_history.append_signal_packet(signal_packets[1], True)
+        for signal_packet in signal_packets[2:]:
+            signal_stream_history.append_signal_packet(signal_packet, False)
+        
+        self.assertEqual(len(signal_stream_history.get_signal_streams()), 1)
+        self.assertEqual(signal_stream_history.samples_cleaned_up, 18 + 17 + 18)
+        self.assertEqual(list(signal_stream_history.iterate_samples(60, float("inf"))), range(60, 108))
+    
+    def test_clean_up(self):
+        signal_stream_history = SignalStreamHistory()
+        for signal_packet in create_signal_packets(5):
+            signal_stream_history.append_signal_packet(signal_packet, False)
+        
+        signal_stream_history.clean_up_samples_before(1002.0)
+        
+        self.assertEqual(signal_stream_history.samples_cleaned_up, 36)
+        self.assertEqual(list(signal_stream_history.iterate_samples(0, 1003.0)), range(36, 55))
+
+
+class EventStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.event_stream = EventStream()
+        for event_i in range(100):
+            self.event_stream.append((1000.0 + event_i, event_i))
+    
+    def test_clean_up_keeps_indices(self):
+        view_before_cleanup = self.event_stream.get_view()
+        
+        self.event_stream.clean_up_events_before(1060.5)
+        
+        self.assertEqual(len(self.event_stream), 100)
+        self.assertEqual(self.event_stream.events_cleaned_up, 61)
+        self.assertEqual(self.event_stream[70], (1070.0, 70))
+        self.assertEqual(list(self.event_stream)[0], (1061.0, 61))
+        self.assertEqual(len(view_before_cleanup), 100)
+        
+        self.event_stream.append((1100.0, 100))
+        self.assertEqual(self.event_stream[100], (1100.0, 100))
+    
+    def test_iterate_samples(self):
+        self.assertEqual(list(self.event_stream.iterate_samples(10, 1020.0)), range(10, 21))
+        self.assertEqual(list(self.event_stream.iterate_samples(100, 2000.0)), [])
+        
+        self.event_stream.clean_up_events_before(1030.0)
+        self.assertEqual(list(self.event_stream.iterate_samples(10, 1020.0)), [])
+        self.assertEqual(list(self.event_stream.iterate_samples(40, 1042.0)), [40, 41, 42])
+    
+    def test_time_range(self):
+        event_view = self.event_stream.get_time_range(1010.0, 1015.5)
+        
+        self.assertEqual(len(event_view), 6)
+        self.assertEqual(event_view[0], (1010.0, 10))
+        self.assertEqual(list(event_view.iterate_values()), range(10, 16))
+
+
+class MeasurementCollectorWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.system_time = zephyr.time
+        zephyr.time = lambda: 1008.0
+        
+        self.collector = MeasurementCollector()
+        
+        for signal_packet in create_signal_packets(4):
+            self.collector.handle_signal(signal_packet, False)
+        
+        # lost packet 4, the history continues in a new stream
+        for signal_packet in create_signal_packets(8)[5:]:
+            self.collector.handle_signal(signal_packet, signal_packet.sequence_number == 5)
+        
+        self.collector.handle_event("heartbeat_interval", (1001.0, 0.8))
+        self.collector.handle_event("heartbeat_interval", (1001.8, 0.8))
+    
+    def tearDown(self):
+        zephyr.time = self.system_time
+    
+    def test_window_over_discontinuity(self):
+        signal_window = self.collector.get_window("breathing", 1003.5, 1005.5)
+        
+        self.assertEqual(signal_window.samples.tolist(), range(63, 72) + range(90, 99))
+        self.assertEqual(signal_window.discontinuities.tolist(), [9])
+        self.assertTrue(numpy.allclose(signal_window.timestamps, 1000.0 + signal_window.samples / 18.0))
+    
+    def test_window_within_stream(self):
+        signal_window = self.collector.get_window("breathing", 1001.0, 1001.5)
+        
+        self.assertEqual(signal_window.samples.tolist(), range(18, 27))
+        self.assertEqual(len(signal_window.discontinuities), 0)
+        self.assertEqual(len(self.collector.get_window("breathing", 990.0, 999.0).samples), 0)
+    
+    def test_event_window(self):
+        signal_window = self.collector.get_window("heartbeat_interval", 1000.0, 1001.5)
+        
+        self.assertEqual(signal_window.timestamps.tolist(), [1001.0])
+        self.assertEqual(signal_window.samples.tolist(), [0.8])
+    
+    def test_queries_do_not_add_streams(self):
+        self.assertEqual(len(self.collector.get_window("heartbeat_intervals", 1000.0, 1001.5).samples), 0)
+        self.assertEqual(len(self.collector.get_stream("respiration_rate")), 0)
+        self.assertEqual(len(self.collector.get_event_stream("respiration_rate")), 0)
+        self.assertEqual(self.collector.get_signal_stream_history("ecg").get_signal_streams(), [])
+        
+        self.assertEqual([stream_name for stream_name, event_stream in self.collector.iterate_event_streams()], ["heartbeat_interval"])  #@UnusedVariable
+        self.assertEqual([stream_type for stream_type, signal_stream_history in self.collector.iterate_signal_stream_histories()], ["breathing"])  #@UnusedVariable
+
+
+class MeasurementCollectorCleanupTest(unittest.TestCase):
+    def setUp(self):
+        self.system_time = zephyr.time
+        self.now = 1000.0
+        zephyr.time = lambda: self.now
+    
+    def tearDown(self):
+        zephyr.time = self.system_time
+    
+    def test_cleanup_per_stream(self):
+        collector = MeasurementCollector(history_length_seconds=10.0)
+        
+        for event_i in range(40):
+            self.now = 1000.0 + event_i
+            collector.handle_event("heartbeat_interval", (self.now, 0.8))
+            
+            if event_i < 2:
+                collector.handle_event("respiration_rate", (self.now, 15.0))
+        
+        # The cleanup runs once per interval, so at most one interval of
+        # events beyond the history is kept
+        heartbeat_interval_stream = collector.get_event_stream("heartbeat_interval")
+        self.assertTrue(10 < len(list(heartbeat_interval_stream)) <= 15)
+        self.assertEqual(len(heartbeat_interval_stream), 40)
+        
+        # Streams without new data are not visited
+        self.assertEqual(len(list(collector.get_event_stream("respiration_rate"))), 2)
+        
+        cleanup_statistics = collector.get_cleanup_statistics()
+        self.assertEqual(cleanup_statistics["cleanup_count"], 40 / 5 + 1)
+        self.assertTrue(cleanup_statistics["cleanup_duration_max"] >= cleanup_statistics["cleanup_duration_mean"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import time
+import unittest
+
+import numpy
+
+from twisted.internet.task import Clock
+
+import zephyr
+from zephyr.collector import MeasurementCollector
+from zephyr.delayed_stream import DelayedStreamScheduler, DelayedRealTimeStream, ReactorDelayedStream
+from zephyr.message import SignalPacket
+
+
+class DelayedStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.system_time = zephyr.time
+        self.clock = Clock()
+        self.clock.advance(1000.0)
+        zephyr.time = self.clock.seconds
+        
+        self.collector = MeasurementCollector()
+        self.batches = []
+        self.samples = []
+    
+    def tearDown(self):
+        zephyr.time = self.system_time
+    
+    def append_breathing_packet(self, packet_i):
+        samples = numpy.arange(packet_i * 18, (packet_i + 1) * 18, dtype=numpy.int32)
+        self.collector.handle_signal(SignalPacket("breathing", 1000.0 + packet_i, 18.0, samples, packet_i), False)
+    
+    def handle_batch(self, stream_name, samples):
+        self.batches.append((stream_name, samples))
+    
+    def handle_sample(self, stream_name, sample):
+        self.samples.append((stream_name, sample))
+
+
+class DelayedStreamSchedulerTest(DelayedStreamTestCase):
+    def test_release_times(self):
+        scheduler = DelayedStreamScheduler(self.collector, [self.handle_sample], 1.0, {"heartbeat_interval": 0.5},
+                                           [self.handle_batch])
+        self.assertEqual(scheduler.get_next_release_time(), None)
+        
+        self.append_breathing_packet(0)
+        self.collector.handle_event("heartbeat_interval", (1000.2, 0.8))
+        
+        self.assertEqual(scheduler.get_next_release_time(), 1000.7)
+        self.assertEqual(scheduler.release_due_samples(1000.69), 1000.7)
+        self.assertEqual(self.batches, [])
+        
+        self.assertEqual(scheduler.release_due_samples(1001.0), 1001.0 + 1 / 18.0)
+        self.assertEqual(self.batches, [("heartbeat_interval", [0.8]), ("breathing", [0])])
+        
+        self.assertEqual(scheduler.release_due_samples(1001.5), 1001.5 + 1 / 18.0)
+        self.assertEqual(self.batches[-1], ("breathing", range(1, 10)))
+        
+        self.assertEqual(scheduler.release_due_samples(1010.0), None)
+        self.assertEqual(len(self.samples), 19)
+        
+        self.append_breathing_packet(1)
+        self.assertEqual(scheduler.get_next_release_time(), 1002.0)
+
+
+class ReactorDelayedStreamTest(DelayedStreamTestCase):
+    def test_released_in_reactor(self):
+        delayed_stream = ReactorDelayedStream(self.collector, self.clock, [], 1.2, batch_callbacks=[self.handle_batch])
+        delayed_stream.start()
+        
+        for packet_i in range(3):
+            self.append_breathing_packet(packet_i)
+            self.clock.advance(1.0)
+        
+        self.assertEqual(sum(len(samples) for stream_name, samples in self.batches), 33)  #@UnusedVariable
+        
+        self.clock.advance(10.0)
+        released_samples = [sample for stream_name, samples in self.batches for sample in samples]  #@UnusedVariable
+        self.assertEqual(released_samples, range(54))
+        
+        delayed_stream.stop()
+        self.append_breathing_packet(3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class DelayedRealTimeStreamTest(DelayedStreamTestCase):
+    # Seconds a release can come late, the thread polls in sleeps of up to 50 ms
+    release_latency = 0.15
+    
+    def setUp(self):
+        DelayedStreamTestCase.setUp(self)
+        zephyr.time = self.system_time
+        self.release_times = []
+    
+    def handle_sample(self, stream_name, sample):
+        self.samples.append((stream_name, sample))
+        self.release_times.append(zephyr.time())
+    
+    def test_released_in_thread(self):
+        delayed_stream = DelayedRealTimeStream(self.collector, [self.handle_sample], 0.3, {"heartbeat_interval": 0.1})
+        delayed_stream.start()
+        
+        try:
+            start_time = zephyr.time()
+            self.collector.handle_signal(SignalPacket("breathing", start_time, 50.0, numpy.arange(10, dtype=numpy.int32), 0), False)
+            self.collector.handle_event("heartbeat_interval", (start_time + 0.05, 0.8))
+            time.sleep(0.8)
+        finally:
+            delayed_stream.terminate()
+            delayed_stream.join()
+        
+        self.assertEqual(self.samples, [("heartbeat_interval", 0.8)] + [("breathing", sample) for sample in range(10)])
+        
+        due_times = [start_time + 0.15] + [start_time + 0.3 + sample_i / 50.0 for sample_i in range(10)]
+        for release_time, due_time in zip(self.release_times, due_times):
+            self.assertTrue(due_time <= release_time < due_time + self.release_latency)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import random
+
+from zephyr import message, util
+
+
+def create_summary_payload(generator):
+    timestamp_bytes = [0xE0, 0x07, 6, 15] + [generator.randint(0, 255) for i in range(3)] + [0]  #@UnusedVariable
+    packet_bytes = [generator.randint(0, 255) for i in range(61)]  #@UnusedVariable
+    return [generator.randint(0, 255)] + timestamp_bytes + [2] + packet_bytes
+
+
+class SummaryPacketTest(unittest.TestCase):
+    def test_matches_bitstring_parser(self):
+        generator = random.Random(0)
+        
+        for payload_i in range(200):  #@UnusedVariable
+            payload = create_summary_payload(generator)
+            
+            # Comparing the representations also checks the value types
+            self.assertEqual(repr(message.parse_summary_packet(payload)),
+                             repr(message.bitstring_parse_summary_packet(payload)))
+
+
+class FramePayloadTest(unittest.TestCase):
+    def test_string_payload_matches_list_payload(self):
+        generator = random.Random(0)
+        
+        for message_id in [0x21, 0x22, 0x24, 0x2B]:
+            payload = create_summary_payload(generator)
+            payload_string = "".join(chr(byte) for byte in payload)
+            
+            parse = message.MESSAGE_TYPES[message_id]
+            self.assertEqual(repr(parse(payload_string)), repr(parse(payload)))
+    
+    def test_hxm_message(self):
+        heartbeat_timestamp_bytes = []
+        for heartbeat_milliseconds in range(1000, 16000, 1000):
+            heartbeat_timestamp_bytes += [heartbeat_milliseconds & 0xFF, heartbeat_milliseconds >> 8]
+        
+        payload = [0] * 9 + [72, 5] + heartbeat_timestamp_bytes + [0] * 6 + [32, 0, 0, 2, 7, 0] + [0, 0]
+        payload_string = "".join(chr(byte) for byte in payload)
+        
+        hxm_message = message.parse_hxm_message(payload_string)
+        
+        self.assertEqual(hxm_message, message.HxMMessage(heart_rate=72, heartbeat_number=5,
+                                                         heartbeat_milliseconds=range(1000, 16000, 1000),
+                                                         distance=2.0, speed=2.0, strides=7))
+
+
+class AccelerometerPacketTest(unittest.TestCase):
+    def test_matches_reference_unpacking(self):
+        generator = random.Random(0)
+        signal_bytes = [generator.randint(0, 255) for i in range(75)]  #@UnusedVariable
+        
+        interleaved_samples = [value / 20.75 for value in util.reference_unpack_bit_packed_values(signal_bytes, 10, False)]
+        expected_samples = zip(interleaved_samples[0::3], interleaved_samples[1::3], interleaved_samples[2::3])
+        
+        samples = message.parse_accelerometer_samples(signal_bytes)
+        
+        self.assertEqual(samples.shape, (20, 3))
+        self.assertEqual([tuple(sample) for sample in samples.tolist()], expected_samples)
+
+
+if __name__ == "__main__":
+    unittest.main()
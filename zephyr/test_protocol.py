@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+import random
+
+import zephyr
+from zephyr.protocol import MessageFrameParser, BufferedMessageFrameParser, create_message_frame, \
+    TimedDataRecorder, read_timed_data
+
+
+def create_test_stream(frame_count, seed):
+    generator = random.Random(seed)
+    stream_parts = []
+    
+    for frame_i in range(frame_count):
+        payload = [generator.randint(0, 255) for i in range(generator.randint(0, 128))]  #@UnusedVariable
+        message_frame = create_message_frame(generator.choice([0x21, 0x22, 0x2B, 0x02]), payload)
+        
+        corruption = generator.random()
+        if corruption < 0.05:
+            # broken CRC
+            message_frame = message_frame[:-2] + chr(ord(message_frame[-2]) ^ 0x01) + message_frame[-1]
+        elif corruption < 0.10:
+            # invalid end of message byte
+            message_frame = message_frame[:-1] + "\x04"
+        elif corruption < 0.15:
+            # invalid payload length
+            message_frame = message_frame[:2] + chr(generator.randint(129, 255)) + message_frame[3:]
+        elif corruption < 0.20:
+            # garbage between the frames
+            message_frame = "".join(chr(generator.randint(0, 255)) for i in range(generator.randint(1, 10))) + message_frame  #@UnusedVariable
+        
+        stream_parts.append(message_frame)
+    
+    return "".join(stream_parts)
+
+
+def split_into_chunks(data_string, seed):
+    generator = random.Random(seed)
+    position = 0
+    
+    while position < len(data_string):
+        chunk_length = generator.randint(1, 300)
+        yield data_string[position:position + chunk_length]
+        position += chunk_length
+
+
+class BufferedMessageFrameParserTest(unittest.TestCase):
+    def parse_with(self, parser_class, chunks):
+        messages = []
+        parser = parser_class(lambda message: messages.append((message.message_id, list(bytearray(message.payload)), message.eom)))
+        
+        for chunk in chunks:
+            parser.parse_data(chunk)
+        
+        return messages
+    
+    def test_same_messages_as_byte_parser(self):
+        for seed in range(10):
+            stream = create_test_stream(200, seed)
+            
+            expected_messages = self.parse_with(MessageFrameParser, stream)
+            messages = self.parse_with(BufferedMessageFrameParser, split_into_chunks(stream, seed))
+            
+            self.assertTrue(len(expected_messages) > 100)
+            self.assertEqual(messages, expected_messages)
+    
+    def test_frame_split_over_chunks(self):
+        message_frame = create_message_frame(0x22, range(50))
+        
+        for split_position in range(len(message_frame) + 1):
+            chunks = [message_frame[:split_position], message_frame[split_position:]]
+            messages = self.parse_with(BufferedMessageFrameParser, chunks)
+            
+            self.assertEqual(messages, [(0x22, range(50), "ETX")])
+
+
+class TimedDataRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.system_time = zephyr.time
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        zephyr.time = self.system_time
+        shutil.rmtree(self.directory)
+    
+    def test_recorded_chunks(self):
+        stream = create_test_stream(50, 0)
+        chunks = list(split_into_chunks(stream, 0))
+        
+        log_file_basepath = os.path.join(self.directory, "bioharness")
+        recorder = TimedDataRecorder(log_file_basepath)
+        
+        for chunk_i, chunk in enumerate(chunks):
+            zephyr.time = lambda: 1465948997.123456 + chunk_i * 0.25
+            recorder(chunk)
+        recorder.close()
+        
+        timed_chunks = read_timed_data(log_file_basepath)
+        
+        self.assertEqual([chunk for timestamp, chunk in timed_chunks], chunks)  #@UnusedVariable
+        self.assertAlmostEqual(timed_chunks[-1][0], 1465948997.123456 + (len(chunks) - 1) * 0.25, places=6)
+    
+    def test_directory_is_created(self):
+        log_file_basepath = os.path.join(self.directory, "study", "bioharness")
+        recorder = TimedDataRecorder(log_file_basepath)
+        recorder("data")
+        recorder.close()
+        
+        self.assertEqual(read_timed_data(log_file_basepath)[0][1], "data")
+
+
+if __name__ == "__main__":
+    unittest.main()
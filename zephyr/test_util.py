@@ -0,0 +1,193 @@
+import os
+import time
+import datetime
+import unittest
+import random
+
+import numpy
+
+import zephyr
+
+from zephyr import util
+
+
+class Crc8Test(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(0)
+        self.payloads = [[generator.randint(0, 255) for i in range(generator.randint(0, 128))]  #@UnusedVariable
+                         for payload_i in range(500)]  #@UnusedVariable
+    
+    def test_table_matches_reference(self):
+        for payload in self.payloads:
+            self.assertEqual(util.crc_8_digest(payload), util.reference_crc_8_digest(payload))
+    
+    def test_buffer_types(self):
+        for payload in self.payloads:
+            expected_crc = util.reference_crc_8_digest(payload)
+            payload_string = "".join(chr(byte) for byte in payload)
+            
+            self.assertEqual(util.crc_8_digest(bytearray(payload)), expected_crc)
+            self.assertEqual(util.crc_8_digest(payload_string), expected_crc)
+            self.assertEqual(util.crc_8_digest(memoryview(payload_string)), expected_crc)
+    
+    def test_incremental_update(self):
+        for payload in self.payloads:
+            split_position = len(payload) / 2
+            crc = util.crc_8_update(0, payload[:split_position])
+            crc = util.crc_8_update(crc, payload[split_position:])
+            
+            self.assertEqual(crc, util.reference_crc_8_digest(payload))
+
+
+class UnpackBitPackedValuesTest(unittest.TestCase):
+    def test_matches_reference(self):
+        generator = random.Random(0)
+        
+        for byte_count in range(1, 100):
+            data_bytes = [generator.randint(0, 255) for i in range(byte_count)]  #@UnusedVariable
+            
+            for value_nbits, dtype, twos_complement in [(10, "uint", False), (16, "intbe", True)]:
+                unpacked_values = util.unpack_bit_packed_values(data_bytes, value_nbits, dtype)
+                expected_values = util.reference_unpack_bit_packed_values(data_bytes, value_nbits, twos_complement)
+                
+                self.assertEqual(unpacked_values.tolist(), expected_values)
+    
+    def test_buffer_input(self):
+        data_bytes = range(0, 250, 3)
+        data_string = "".join(chr(byte) for byte in data_bytes)
+        
+        self.assertEqual(util.unpack_bit_packed_values(data_string, 10, "uint").tolist(),
+                         util.reference_unpack_bit_packed_values(data_bytes, 10, False))
+
+
+def uncached_parse_timestamp(timestamp_bytes):
+    year = timestamp_bytes[0] + (timestamp_bytes[1] << 8)
+    month = timestamp_bytes[2]
+    day = timestamp_bytes[3]
+    day_milliseconds = (timestamp_bytes[4] +
+                        (timestamp_bytes[5] << 8) +
+                        (timestamp_bytes[6] << 16) +
+                        (timestamp_bytes[7] << 24))
+    
+    date = datetime.date(year=year, month=month, day=day)
+    return time.mktime(date.timetuple()) + (day_milliseconds / 1000.0000)
+
+
+def create_timestamp_bytes(year, month, day, day_milliseconds):
+    return ([year & 0xFF, year >> 8, month, day] +
+            [(day_milliseconds >> shift) & 0xFF for shift in [0, 8, 16, 24]])
+
+
+class ParseTimestampTest(unittest.TestCase):
+    def setUp(self):
+        self.original_timezone = os.environ.get("TZ")
+        os.environ["TZ"] = "America/New_York"
+        time.tzset()
+        util.clear_midnight_timestamp_cache()
+        
+        # Midnight rollovers around the spring and autumn DST transitions
+        day_milliseconds_values = [0, 1, 7199999, 7200000, 43200000, 86399999]
+        dates = [(2016, 3, 12), (2016, 3, 13), (2016, 3, 14), (2016, 11, 5), (2016, 11, 6), (2016, 12, 31), (2017, 1, 1)]
+        
+        self.timestamp_bytes_list = [create_timestamp_bytes(year, month, day, day_milliseconds)
+                                     for year, month, day in dates
+                                     for day_milliseconds in day_milliseconds_values]
+    
+    def tearDown(self):
+        if self.original_timezone is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = self.original_timezone
+        
+        time.tzset()
+        util.clear_midnight_timestamp_cache()
+    
+    def test_cached_timestamps(self):
+        for repetition in range(2):  #@UnusedVariable
+            for timestamp_bytes in self.timestamp_bytes_list:
+                self.assertEqual(util.parse_timestamp(timestamp_bytes), uncached_parse_timestamp(timestamp_bytes))
+    
+    def test_batch_timestamps(self):
+        expected_timestamps = [uncached_parse_timestamp(timestamp_bytes) for timestamp_bytes in self.timestamp_bytes_list]
+        timestamp_records = sum(self.timestamp_bytes_list, [])
+        
+        record_string = "".join(chr(byte) for byte in timestamp_records)
+        self.assertEqual(util.parse_timestamps(record_string).tolist(), expected_timestamps)
+        
+        record_array = numpy.array(self.timestamp_bytes_list, dtype=numpy.uint8)
+        self.assertEqual(util.parse_timestamps(record_array).tolist(), expected_timestamps)
+
+
+class ClockAheadEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(0)
+        
+        # Device clock 2.5 s ahead and drifting 1 ms per minute, received with
+        # up to 200 ms of buffering delay
+        self.local_times = [1000.0 + 0.25 * update_i for update_i in range(2000)]
+        self.clock_ahead_values = [2.5 + (local_time - 1000.0) / 60000.0 - generator.uniform(0.0, 0.2)
+                                   for local_time in self.local_times]
+    
+    def test_mean_matches_window_mean(self):
+        estimator = util.MeanClockAheadEstimator(60)
+        
+        for update_i, (local_time, clock_ahead) in enumerate(zip(self.local_times, self.clock_ahead_values)):
+            window = self.clock_ahead_values[max(0, update_i - 59):update_i + 1]
+            self.assertAlmostEqual(estimator.update(local_time, clock_ahead), sum(window) / len(window), places=9)
+    
+    def test_windowed_minimum_matches_window_maxima(self):
+        estimator = util.WindowedMinimumClockAheadEstimator(60, 5)
+        window_maxima = []
+        
+        for update_i, (local_time, clock_ahead) in enumerate(zip(self.local_times, self.clock_ahead_values)):
+            window_maxima.append(max(self.clock_ahead_values[max(0, update_i - 59):update_i + 1]))
+            smoothed_maxima = window_maxima[-5:]
+            
+            self.assertAlmostEqual(estimator.update(local_time, clock_ahead),
+                                   sum(smoothed_maxima) / len(smoothed_maxima), places=9)
+    
+    def test_linear_drift_matches_polyfit(self):
+        estimator = util.LinearDriftClockAheadEstimator(300)
+        
+        for update_i, (local_time, clock_ahead) in enumerate(zip(self.local_times, self.clock_ahead_values)):
+            estimate = estimator.update(local_time, clock_ahead)
+            
+            if update_i >= 2:
+                window_start = max(0, update_i - 299)
+                slope, intercept = numpy.polyfit(self.local_times[window_start:update_i + 1],
+                                                 self.clock_ahead_values[window_start:update_i + 1], 1)
+                self.assertAlmostEqual(estimate, intercept + slope * local_time, places=6)
+
+
+class ClockDifferenceEstimatorTest(unittest.TestCase):
+    def setUp(self):
+        self.original_time = zephyr.time
+    
+    def tearDown(self):
+        zephyr.time = self.original_time
+    
+    def test_estimator_per_key(self):
+        estimator = util.ClockDifferenceEstimator(estimator_factories={"rr": lambda: util.WindowedMinimumClockAheadEstimator(10, 1)})
+        
+        for local_time, delay in [(100.0, 0.1), (101.0, 0.3), (102.0, 0.2)]:
+            zephyr.time = lambda: local_time + delay
+            device_timestamp = local_time + 5.0
+            
+            ecg_timestamp = estimator.estimate_and_correct_timestamp(device_timestamp, "ecg")
+            rr_timestamp = estimator.estimate_and_correct_timestamp(device_timestamp, "rr")
+        
+        # The mean follows the average delay, the windowed minimum the least delay
+        self.assertAlmostEqual(ecg_timestamp, 102.0 + 0.2)
+        self.assertAlmostEqual(rr_timestamp, 102.0 + 0.1)
+        
+        self.assertTrue(isinstance(estimator.get_estimator("ecg"), util.MeanClockAheadEstimator))
+    
+    def test_time_function(self):
+        zephyr.time = lambda: 500.0
+        estimator = util.ClockDifferenceEstimator(time_function=lambda: 100.0)
+        
+        self.assertAlmostEqual(estimator.estimate_and_correct_timestamp(105.0, "ecg"), 100.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -89,21 +89,21 @@ def visualize_measurements(signal_collector):
     
     breathing_stream_history = signal_collector.get_signal_stream_history("breathing")
     for breathing_stream in breathing_stream_history.get_signal_streams():
-        breathing_x_values = numpy.arange(len(breathing_stream.samples), dtype=float)
+        breathing_x_values = numpy.arange(len(breathing_stream), dtype=float)
         breathing_x_values /= breathing_stream.samplerate
         breathing_x_values += breathing_stream.start_timestamp
         ax1.plot(breathing_x_values, breathing_stream.samples)
     
     ecg_stream_history = signal_collector.get_signal_stream_history("ecg")
     for ecg_stream in ecg_stream_history.get_signal_streams():
-        ecg_x_values = numpy.arange(len(ecg_stream.samples), dtype=float)
+        ecg_x_values = numpy.arange(len(ecg_stream), dtype=float)
         ecg_x_values /= ecg_stream.samplerate
         ecg_x_values += ecg_stream.start_timestamp
         ax2.plot(ecg_x_values, ecg_stream.samples)
     
     acceleration_stream_history = signal_collector.get_signal_stream_history("acceleration")
     for acceleration_stream in acceleration_stream_history.get_signal_streams():
-        acceleration_x_values = numpy.arange(len(acceleration_stream.samples), dtype=float)
+        acceleration_x_values = numpy.arange(len(acceleration_stream), dtype=float)
         acceleration_x_values /= acceleration_stream.samplerate
         acceleration_x_values += acceleration_stream.start_timestamp
         ax3.plot(acceleration_x_values, numpy.array(acceleration_stream.samples))
@@ -1,9 +1,11 @@
 
 import time
+import struct
 import datetime
 import collections
 import bitstring
 import array
+import numpy
 
 
 import zephyr
@@ -33,7 +35,7 @@ def set_time_speed(simulation_speed):
     zephyr.sleep = FastSleep(simulation_speed)
 
 
-def crc_8_digest(values):
+def reference_crc_8_digest(values):
     crc = 0
     
     for byte in values:
@@ -47,6 +49,27 @@ def crc_8_digest(values):
     return crc
 
 
+CRC_8_TABLE = tuple(reference_crc_8_digest([byte]) for byte in range(256))
+
+
+def crc_8_update(crc, values):
+    """Continue the CRC calculation from a previous crc value. This allows
+    calculating the CRC of a payload incrementally as its bytes arrive."""
+    if not isinstance(values, (bytearray, list, tuple)):
+        # Strings, bytes and memoryviews are iterated as integers via bytearray
+        values = bytearray(values)
+    
+    table = CRC_8_TABLE
+    for byte in values:
+        crc = table[crc ^ byte]
+    
+    return crc
+
+
+def crc_8_digest(values):
+    return crc_8_update(0, values)
+
+
 def parse_uint16_values_from_bytes(byte_values):
     assert not len(byte_values) % 2
     
@@ -76,22 +99,72 @@ def parse_uint16_values_from_byte_sequence(ls_byte_indices, byte_sequence):
     return values
 
 
-def parse_timestamp(timestamp_bytes):
-    year = timestamp_bytes[0] + (timestamp_bytes[1] << 8)
-    month = timestamp_bytes[2]
-    day = timestamp_bytes[3]
-    day_milliseconds = (timestamp_bytes[4] +
-                        (timestamp_bytes[5] << 8) +
-                        (timestamp_bytes[6] << 16) +
-                        (timestamp_bytes[7] << 24))
+def as_byte_buffer(values):
+    """Return the values in a form usable with struct.unpack_from and
+    numpy.frombuffer. Strings and bytearrays are returned as they are."""
+    if isinstance(values, (list, tuple)):
+        return bytearray(values)
+    return values
+
+
+TIMESTAMP_STRUCT = struct.Struct("<HBBI")
+TIMESTAMP_DTYPE = numpy.dtype([("year", "<u2"), ("month", "u1"), ("day", "u1"), ("day_milliseconds", "<u4")])
+
+_midnight_timestamps = {}
+
+
+def clear_midnight_timestamp_cache():
+    _midnight_timestamps.clear()
+
+
+def get_midnight_timestamp(year, month, day):
+    """Return the local time epoch of the start of the day. The value is
+    cached per date, as it rarely changes during a session."""
+    date_key = (year, month, day)
+    midnight_timestamp = _midnight_timestamps.get(date_key)
+    
+    if midnight_timestamp is None:
+        date = datetime.date(year=year, month=month, day=day)
+        midnight_timestamp = time.mktime(date.timetuple())
+        
+        if len(_midnight_timestamps) > 1024:
+            _midnight_timestamps.clear()
+        
+        _midnight_timestamps[date_key] = midnight_timestamp
+    
+    return midnight_timestamp
+
+
+def parse_timestamp(timestamp_bytes, offset=0):
+    year, month, day, day_milliseconds = TIMESTAMP_STRUCT.unpack_from(as_byte_buffer(timestamp_bytes), offset)
     
-    date = datetime.date(year=year, month=month, day=day)
-    timestamp = time.mktime(date.timetuple()) + (day_milliseconds / 1000.0000)
+    timestamp = get_midnight_timestamp(year, month, day) + (day_milliseconds / 1000.0000)
     return timestamp
 
+
+def parse_timestamps(timestamp_records):
+    """Decode many timestamps at once, for example during replay or file
+    conversion. The records are the 8 timestamp bytes of each packet, given
+    either as an (N, 8) uint8 array or as a string of concatenated records.
+    Returns the same values as parse_timestamp in a float array."""
+    if isinstance(timestamp_records, numpy.ndarray):
+        records = numpy.ascontiguousarray(timestamp_records, dtype=numpy.uint8).view(TIMESTAMP_DTYPE).reshape(-1)
+    else:
+        records = numpy.frombuffer(as_byte_buffer(timestamp_records), dtype=TIMESTAMP_DTYPE)
     
+    date_keys = (records["year"].astype(numpy.int64) * 10000 +
+                 records["month"].astype(numpy.int64) * 100 +
+                 records["day"])
+    unique_date_keys, date_indices = numpy.unique(date_keys, return_inverse=True)
+    
+    midnight_timestamps = numpy.array([get_midnight_timestamp(int(date_key / 10000), int(date_key / 100 % 100), int(date_key % 100))
+                                       for date_key in unique_date_keys], dtype=float)
+    
+    return midnight_timestamps[date_indices] + records["day_milliseconds"] / 1000.0000
 
-def unpack_bit_packed_values(data_bytes, value_nbits, dtype):
+    
+
+def bitstring_unpack_bit_packed_values(data_bytes, value_nbits, dtype):
     total_bit_count = len(data_bytes) * 8
     number_of_samples = total_bit_count / value_nbits
     number_of_unused_bits =  total_bit_count % value_nbits
@@ -122,6 +195,59 @@ def unpack_bit_packed_values(data_bytes, value_nbits, dtype):
     
     
     
+_bit_unpacking_indices = {}
+
+
+def _get_bit_unpacking_indices(byte_count, value_nbits):
+    key = (byte_count, value_nbits)
+    indices = _bit_unpacking_indices.get(key)
+    
+    if indices is None:
+        value_count = byte_count * 8 / value_nbits
+        value_start_bits = numpy.arange(value_count) * value_nbits
+        value_start_bytes = value_start_bits >> 3
+        bit_offsets = (value_start_bits & 7).astype(numpy.uint32)
+        indices = (value_start_bytes, bit_offsets)
+        _bit_unpacking_indices[key] = indices
+    
+    return indices
+
+
+def unpack_bit_packed_values(data_bytes, value_nbits, dtype, offset=0):
+    """Unpack little endian bit packed values into an int32 array. The dtype
+    is either "uint" for unsigned or "intbe" for two's complement values.
+    Returns the same values as reference_unpack_bit_packed_values. Buffers
+    are read from the given offset without copying."""
+    assert 0 < value_nbits <= 16
+    
+    byte_values = numpy.frombuffer(as_byte_buffer(data_bytes), dtype=numpy.uint8, offset=offset)
+    
+    byte_count = len(byte_values)
+    
+    if value_nbits == 16:
+        value_count = byte_count / 2
+        value_dtype = "<u2" if dtype == "uint" else "<i2"
+        return byte_values[:value_count * 2].view(value_dtype).astype(numpy.int32)
+    
+    value_start_bytes, bit_offsets = _get_bit_unpacking_indices(byte_count, value_nbits)
+    
+    # Every value is contained in at most three consecutive bytes, so two bytes
+    # of padding let us read them without bounds checks.
+    padded_bytes = numpy.zeros(byte_count + 2, dtype=numpy.uint32)
+    padded_bytes[:byte_count] = byte_values
+    
+    words = (padded_bytes[value_start_bytes] |
+             (padded_bytes[value_start_bytes + 1] << 8) |
+             (padded_bytes[value_start_bytes + 2] << 16))
+    
+    unpacked_values = ((words >> bit_offsets) & (2**value_nbits - 1)).astype(numpy.int32)
+    
+    if dtype != "uint":
+        unpacked_values[unpacked_values >= 2**(value_nbits - 1)] -= 2**value_nbits
+    
+    return unpacked_values
+
+
 def reference_unpack_bit_packed_values(data_bytes, value_nbits, twos_complement):
     total_bit_count = len(data_bytes) * 8
     value_count = total_bit_count / value_nbits
@@ -150,19 +276,150 @@ def reference_unpack_bit_packed_values(data_bytes, value_nbits, twos_complement)
 
 DISABLE_CLOCK_DIFFERENCE_ESTIMATION = False
 
+
+class MeanClockAheadEstimator:
+    """Mean of the latest clock differences. The sum is updated as values enter
+    and leave the window, and recomputed once per window length so that
+    rounding errors do not accumulate."""
+    
+    def __init__(self, window_length=60):
+        self.window_length = window_length
+        self.clock_ahead_values = collections.deque()
+        self.clock_ahead_sum = 0.0
+        self.updates_until_resum = window_length
+    
+    def update(self, local_time, clock_ahead):
+        self.clock_ahead_values.append(clock_ahead)
+        self.clock_ahead_sum += clock_ahead
+        
+        if len(self.clock_ahead_values) > self.window_length:
+            self.clock_ahead_sum -= self.clock_ahead_values.popleft()
+        
+        self.updates_until_resum -= 1
+        if not self.updates_until_resum:
+            self.clock_ahead_sum = sum(self.clock_ahead_values)
+            self.updates_until_resum = self.window_length
+        
+        return self.clock_ahead_sum / len(self.clock_ahead_values)
+
+
+class WindowedMinimumClockAheadEstimator:
+    """Estimate based on the packets that were delayed the least, in the same way
+    as RelativeHeartbeatTimestampAnalysis does for the HxM. Transmission delays
+    only ever make the device clock look further behind, so the largest clock
+    difference in the window is the one with the least delay. The window maxima
+    of the latest updates are averaged to smooth the estimate."""
+    
+    def __init__(self, window_length=60, smoothing_length=5):
+        self.window_length = window_length
+        self.update_count = 0
+        
+        # Decreasing clock differences with the update number they were
+        # received at, so that the window maximum is always the first item
+        self.window_maxima = collections.deque()
+        
+        self.smoothing = MeanClockAheadEstimator(smoothing_length)
+    
+    def update(self, local_time, clock_ahead):
+        while self.window_maxima and self.window_maxima[-1][1] <= clock_ahead:
+            self.window_maxima.pop()
+        
+        self.window_maxima.append((self.update_count, clock_ahead))
+        
+        if self.window_maxima[0][0] <= self.update_count - self.window_length:
+            self.window_maxima.popleft()
+        
+        self.update_count += 1
+        
+        return self.smoothing.update(local_time, self.window_maxima[0][1])
+
+
+class LinearDriftClockAheadEstimator:
+    """Least squares line through the clock differences of the window, evaluated
+    at the latest local time. This follows a clock that drifts steadily over long
+    sessions. The sums are kept relative to the first local time to avoid
+    precision loss, and recomputed once per window length."""
+    
+    def __init__(self, window_length=300):
+        self.window_length = window_length
+        self.points = collections.deque()
+        self.time_origin = None
+        self.sums = [0.0] * 4
+        self.updates_until_resum = window_length
+    
+    def add_to_sums(self, point, sign):
+        relative_time, clock_ahead = point
+        self.sums[0] += sign * relative_time
+        self.sums[1] += sign * clock_ahead
+        self.sums[2] += sign * relative_time * relative_time
+        self.sums[3] += sign * relative_time * clock_ahead
+    
+    def update(self, local_time, clock_ahead):
+        if self.time_origin is None:
+            self.time_origin = local_time
+        
+        point = (local_time - self.time_origin, clock_ahead)
+        self.points.append(point)
+        self.add_to_sums(point, 1)
+        
+        if len(self.points) > self.window_length:
+            self.add_to_sums(self.points.popleft(), -1)
+        
+        self.updates_until_resum -= 1
+        if not self.updates_until_resum:
+            self.sums = [0.0] * 4
+            for window_point in self.points:
+                self.add_to_sums(window_point, 1)
+            self.updates_until_resum = self.window_length
+        
+        point_count = len(self.points)
+        time_sum, clock_ahead_sum, time_square_sum, product_sum = self.sums
+        
+        denominator = point_count * time_square_sum - time_sum * time_sum
+        if point_count < 2 or denominator <= 1e-9 * point_count * time_square_sum:
+            return clock_ahead_sum / point_count
+        
+        slope = (point_count * product_sum - time_sum * clock_ahead_sum) / denominator
+        intercept = (clock_ahead_sum - slope * time_sum) / point_count
+        
+        return intercept + slope * point[0]
+
+
 class ClockDifferenceEstimator:
-    def __init__(self):
-        self._clock_difference_deques = collections.defaultdict(lambda: collections.deque(maxlen=60))
+    """Corrects device timestamps for the difference between the device clock
+    and the local clock. Every key (usually a stream type) has its own
+    estimator. The estimator factory can be chosen per key, the default one is
+    used for the other keys. The local clock is time_function, zephyr.time if
+    it is None."""
+    
+    def __init__(self, default_estimator_factory=MeanClockAheadEstimator, estimator_factories=None, time_function=None):
+        self.default_estimator_factory = default_estimator_factory
+        self.estimator_factories = dict(estimator_factories or {})
+        self.time_function = time_function
+        self._estimators = {}
+    
+    def set_estimator_factory(self, key, estimator_factory):
+        self.estimator_factories[key] = estimator_factory
+        self._estimators.pop(key, None)
+    
+    def get_estimator(self, key):
+        estimator = self._estimators.get(key)
+        
+        if estimator is None:
+            estimator_factory = self.estimator_factories.get(key, self.default_estimator_factory)
+            estimator = estimator_factory()
+            self._estimators[key] = estimator
+        
+        return estimator
     
     def estimate_and_correct_timestamp(self, timestamp, key):
         if DISABLE_CLOCK_DIFFERENCE_ESTIMATION:
             return timestamp
         
-        instantaneous_zephyr_clock_ahead = timestamp - zephyr.time()
-        self._clock_difference_deques[key].append(instantaneous_zephyr_clock_ahead)
+        now = self.time_function() if self.time_function is not None else zephyr.time()
+        instantaneous_zephyr_clock_ahead = timestamp - now
         
-        clock_ahead_values = self._clock_difference_deques[key]
-        zephyr_clock_ahead_estimate = sum(clock_ahead_values) / float(len(clock_ahead_values))
+        zephyr_clock_ahead_estimate = self.get_estimator(key).update(now, instantaneous_zephyr_clock_ahead)
         
         corrected_timestamp = timestamp - zephyr_clock_ahead_estimate
         return corrected_timestamp